@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark for HTCondorTodoItem.copy, which happens once per cluster per update
+(in HTCondorUpdater.__init__). Reports the time to copy, and the time to copy and
+then move a fraction of the jobs, as a function of the number of jobs.
+
+The htcondor bindings are not needed for this and are mocked.
+"""
+
+import argparse, os, sys, tempfile, time
+import os.path as osp
+from unittest.mock import MagicMock
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', '--njobs', type=int, nargs='+', default=[1000, 10000, 100000, 1000000], help='Jobs in the cluster')
+parser.add_argument('--moved', type=float, default=.01, help='Fraction of jobs that change state after the copy')
+parser.add_argument('--repeat', type=int, default=5, help='Number of repetitions; the best time is reported')
+args = parser.parse_args()
+
+sys.modules['htcondor'] = MagicMock()
+os.environ.setdefault('CJM_DIR', tempfile.mkdtemp())
+sys.path.insert(0, osp.join(osp.dirname(osp.abspath(__file__)), '..'))
+import cjm
+cjm.logger.setLevel('WARNING')
+
+def best_of(func):
+    times = []
+    for i in range(args.repeat):
+        t0 = time.time()
+        func()
+        times.append(time.time() - t0)
+    return min(times)
+
+def main():
+    print('{0:>9} {1:>12} {2:>16} {3:>16}'.format('njobs', 'copy (ms)', 'copy+move (ms)', 'per moved (us)'))
+    for n_jobs in args.njobs:
+        encoded = cjm.utils.encode_ranges(range(n_jobs))
+        todoitem = cjm.HTCondorTodoItem.from_section(
+            '1', { 'cluster_id' : '1', 'submission_path' : '.', 'all' : encoded, 'running' : encoded }
+            )
+        n_moved = max(1, int(args.moved * n_jobs))
+        step = max(1, n_jobs // n_moved)
+
+        def copy_and_move():
+            new = todoitem.copy()
+            for proc_id in range(0, n_jobs, step):
+                new.jobstates.set_state(proc_id, 'done')
+
+        t_copy = best_of(todoitem.copy)
+        t_copy_move = best_of(copy_and_move)
+        print('{0:>9} {1:>12.3f} {2:>16.3f} {3:>16.3f}'.format(
+            n_jobs, 1000.*t_copy, 1000.*t_copy_move, 1e6*t_copy_move/n_moved
+            ))
+
+if __name__ == '__main__':
+    main()
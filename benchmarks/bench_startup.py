@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark for the startup time of the cjm command line tools. Every command is
+run in a fresh interpreter, as from a shell or cron; the best and median wall
+times are reported.
+
+Besides the bin/ entry points (with --help, so no schedd is contacted), it times
+a bare `import cjm`, and importing cjm and reading a todo list of --nclusters
+clusters. None of these should import htcondor or contact the collector.
+"""
+
+import argparse, os, sys, tempfile, time, subprocess
+import os.path as osp
+parser = argparse.ArgumentParser()
+parser.add_argument('--repeat', type=int, default=10, help='Number of runs per command')
+parser.add_argument('--nclusters', type=int, default=100, help='Clusters in the todo list that is read')
+args = parser.parse_args()
+
+repo_dir = osp.abspath(osp.join(osp.dirname(osp.abspath(__file__)), '..'))
+
+def make_env():
+    env = dict(os.environ)
+    env['CJM_DIR'] = tempfile.mkdtemp()
+    env['PYTHONPATH'] = os.pathsep.join([repo_dir] + ([env['PYTHONPATH']] if 'PYTHONPATH' in env else []))
+    return env
+
+def write_todofile(path, n_clusters):
+    with open(path, 'w') as f:
+        for cluster_id in range(n_clusters):
+            f.write(
+                '[{0}]\ncluster_id = {0}\nsubmission_path = .\nall = 0-99\nidle = 0-49\nrunning = 50-99\n\n'
+                .format(cluster_id)
+                )
+
+def time_command(command, env):
+    times = []
+    for i in range(args.repeat):
+        t0 = time.time()
+        subprocess.check_call(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.time() - t0)
+    times.sort()
+    return times[0], times[len(times)//2]
+
+def main():
+    env = make_env()
+    todofile = osp.join(env['CJM_DIR'], 'todo')
+    write_todofile(todofile, args.nclusters)
+    commands = [
+        ('python (no cjm)', [ sys.executable, '-c', 'pass' ]),
+        ('import cjm', [ sys.executable, '-c', 'import cjm' ]),
+        ('read todo list', [ sys.executable, '-c', 'import cjm; cjm.TodoList({0!r})'.format(todofile) ]),
+        ]
+    for script in sorted(os.listdir(osp.join(repo_dir, 'bin'))):
+        commands.append((script + ' --help', [ sys.executable, osp.join(repo_dir, 'bin', script), '--help' ]))
+    print('{0:<24} {1:>10} {2:>12}'.format('command', 'best (ms)', 'median (ms)'))
+    for name, command in commands:
+        best, median = time_command(command, env)
+        print('{0:<24} {1:>10.1f} {2:>12.1f}'.format(name, 1000.*best, 1000.*median))
+
+if __name__ == '__main__':
+    main()
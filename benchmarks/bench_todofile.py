@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark for reading, parsing and writing the todo file, comparing the old
+plain comma-list format of proc_ids with the compact range encoding.
+
+The htcondor bindings are not needed for this and are mocked.
+"""
+
+import argparse, os, sys, tempfile, time, configparser
+import os.path as osp
+from unittest.mock import MagicMock
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', '--njobs', type=int, nargs='+', default=[1000, 10000, 50000], help='Jobs per cluster')
+parser.add_argument('--nclusters', type=int, default=4, help='Number of clusters in the todo file')
+parser.add_argument('--repeat', type=int, default=3, help='Number of repetitions; the best time is reported')
+args = parser.parse_args()
+
+sys.modules['htcondor'] = MagicMock()
+os.environ.setdefault('CJM_DIR', tempfile.mkdtemp())
+sys.path.insert(0, osp.join(osp.dirname(osp.abspath(__file__)), '..'))
+import cjm
+cjm.logger.setLevel('WARNING')
+_encode_ranges = cjm.utils.encode_ranges
+
+def make_sections(n_jobs, n_clusters, encode):
+    """
+    Makes todo sections with mostly done jobs, some running and a few failed
+    """
+    sections = {}
+    for i_cluster in range(n_clusters):
+        cluster_id = str(1000000 + i_cluster)
+        proc_ids = list(range(n_jobs))
+        states = {
+            'done' : [ p for p in proc_ids if p % 100 < 90 ],
+            'running' : [ p for p in proc_ids if 90 <= p % 100 < 99 ],
+            'failed' : [ p for p in proc_ids if p % 100 == 99 ],
+            }
+        section = {
+            'cluster_id' : cluster_id,
+            'submission_path' : '/some/path',
+            'all' : encode(proc_ids),
+            }
+        for state, state_proc_ids in states.items():
+            section[state] = encode(state_proc_ids)
+        sections[cluster_id] = section
+    return sections
+
+def best_of(func):
+    times = []
+    for i in range(args.repeat):
+        t0 = time.time()
+        func()
+        times.append(time.time() - t0)
+    return min(times)
+
+def bench(n_jobs, encode):
+    path = tempfile.mktemp()
+    config = configparser.ConfigParser()
+    config.read_dict(make_sections(n_jobs, args.nclusters, encode))
+    with open(path, 'w') as f:
+        config.write(f)
+    size = osp.getsize(path)
+
+    def read_and_parse():
+        todolist = cjm.TodoList(path)
+        return [ todolist.get_todoitem(t) for t in todolist.get_section_titles() ]
+    todoitems = read_and_parse()
+
+    def write():
+        new_todo = configparser.ConfigParser()
+        for todoitem in todoitems:
+            new_todo[todoitem.cluster_id] = todoitem.parse_todoitem()
+        with open(path, 'w') as f:
+            new_todo.write(f)
+
+    t_read = best_of(read_and_parse)
+    # parse_todoitem writes through cjm.utils.encode_ranges; swap it to time the old format
+    try:
+        cjm.utils.encode_ranges = encode
+        t_write = best_of(write)
+    finally:
+        cjm.utils.encode_ranges = _encode_ranges
+    os.remove(path)
+    return size, t_read, t_write
+
+def main():
+    plain = lambda proc_ids: ','.join(str(p) for p in sorted(proc_ids))
+    print('{0:>8} {1:>8} {2:>12} {3:>10} {4:>10}'.format('njobs', 'format', 'size (kB)', 'read (s)', 'write (s)'))
+    for n_jobs in args.njobs:
+        for name, encode in [ ('plain', plain), ('ranges', _encode_ranges) ]:
+            size, t_read, t_write = bench(n_jobs, encode)
+            print('{0:>8} {1:>8} {2:>12.1f} {3:>10.4f} {4:>10.4f}'.format(n_jobs, name, size/1000., t_read, t_write))
+
+if __name__ == '__main__':
+    main()
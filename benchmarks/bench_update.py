@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Scale benchmark for the update pipeline. For each size, a synthetic todo file is
+generated with the jobs spread over many clusters, and fake schedds answer the
+queue and history queries with a realistic mix of job states (running, idle,
+completed, held for memory, failed). Then a full TodoList.update is run.
+
+Reported per phase (the phases of TodoList.update, plus loading the todo file
+and the copy and parse_todoitem of all todo items): wall time, how much the peak
+RSS of the process grew during the phase, and the peak and net bytes allocated
+(tracemalloc; disable with --no-trace-memory, since tracing slows everything
+down). Every size runs in a fresh process, so that the peak RSS of one size does
+not carry over to the next; the peak RSS of that process is reported per size.
+
+Results can be saved as json with --output, and two saved runs can be compared
+with --compare old.json new.json, which exits non-zero if any phase slowed down
+by more than --threshold.
+
+The htcondor bindings are not needed for this and are mocked.
+"""
+
+import argparse, os, sys, tempfile, time, json, random, shutil, subprocess
+import os.path as osp
+from unittest.mock import MagicMock
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', '--njobs', type=int, nargs='+', default=[1000, 10000, 100000, 1000000], help='Total number of jobs')
+parser.add_argument('--jobs-per-cluster', type=int, default=1000, help='Jobs per cluster')
+parser.add_argument('--nschedds', type=int, default=3, help='Number of fake schedds the clusters are spread over')
+parser.add_argument('--no-trace-memory', action='store_true', help='Do not trace allocations')
+parser.add_argument('--seed', type=int, default=1, help='Seed for the synthetic queue state')
+parser.add_argument('-o', '--output', type=str, help='Save the results as json to this file')
+parser.add_argument('--compare', type=str, nargs=2, metavar=('OLD', 'NEW'), help='Compare two saved runs instead of running')
+parser.add_argument('--threshold', type=float, default=1.2, help='Ratio new/old above which a phase counts as a regression')
+# Internal: run the first size only and write its results as json to this file
+parser.add_argument('--worker-output', type=str, help=argparse.SUPPRESS)
+args = parser.parse_args()
+
+# Fraction of jobs per queue state; completed jobs left the queue and are in the history
+QUEUE_MIX = [
+    ('running', .6),
+    ('idle', .2),
+    ('completed', .1),
+    ('held', .05),
+    ('failed', .05),
+    ]
+
+
+class FakeClassAd(dict):
+    pass
+
+
+class FakeSchedd(object):
+    """
+    Answers xquery and history from precomputed classads; edit and act are no-ops
+    """
+    def __init__(self, name):
+        self.name = name
+        self.queue = []
+        self.history_ads = []
+
+    def __repr__(self):
+        return '<FakeSchedd {0}>'.format(self.name)
+
+    def xquery(self, requirements=None, projection=None):
+        return [ FakeClassAd(ad) for ad in self.queue ]
+
+    def history(self, requirements=None, projection=None):
+        return [ FakeClassAd(ad) for ad in self.history_ads ]
+
+    def edit(self, *args):
+        pass
+
+    def act(self, *args):
+        pass
+
+
+def setup_cjm():
+    sys.modules['htcondor'] = MagicMock()
+    os.environ['CJM_DIR'] = tempfile.mkdtemp()
+    sys.path.insert(0, osp.join(osp.dirname(osp.abspath(__file__)), '..'))
+    import cjm
+    cjm.logger.setLevel('WARNING')
+    cjm.CONFIG.history_store_file = None
+    # Compile the email, but do not send it
+    cjm.email.Email.send_email = cjm.email.Email.compile_email_text
+    return cjm
+
+def make_scenario(cjm, n_jobs, workdir):
+    """
+    Writes a todo file for `n_jobs` jobs and fills fake schedds with their
+    queue and history classads. Returns the path to the todo file.
+    """
+    rng = random.Random(args.seed)
+    schedds = [ FakeSchedd('schedd{0}'.format(i)) for i in range(args.nschedds) ]
+    cjm.CONFIG.set_schedds(schedds)
+    cjm.todo.HTCondorClusterHistory.clear()
+    todo = cjm.todo.configparser.ConfigParser()
+    n_clusters = max(1, n_jobs // args.jobs_per_cluster)
+    states = [ state for state, fraction in QUEUE_MIX ]
+    weights = [ fraction for state, fraction in QUEUE_MIX ]
+    for i_cluster in range(n_clusters):
+        cluster_id = 1000 + i_cluster
+        schedd = schedds[i_cluster % len(schedds)]
+        n = args.jobs_per_cluster if i_cluster < n_clusters - 1 else n_jobs - i_cluster * args.jobs_per_cluster
+        todo[str(cluster_id)] = {
+            'cluster_id' : str(cluster_id),
+            'submission_path' : workdir,
+            'all' : '0-{0}'.format(n-1),
+            'idle' : '0-{0}'.format(n-1),
+            }
+        for proc_id, state in enumerate(rng.choices(states, weights, k=n)):
+            ad = { 'ClusterId' : cluster_id, 'ProcId' : proc_id, 'ServerTime' : 1576279734 }
+            if state == 'running':
+                ad['JobStatus'] = 2
+                schedd.queue.append(ad)
+            elif state == 'idle':
+                ad['JobStatus'] = 1
+                schedd.queue.append(ad)
+            elif state == 'held':
+                ad.update(JobStatus=5, HoldReasonCode=34, HoldReasonSubCode=0, MemoryUsage=3000, RequestMemory=2048)
+                schedd.queue.append(ad)
+            else:
+                ad.update(JobStatus=4, ExitCode=0 if state == 'completed' else 1)
+                schedd.history_ads.append(ad)
+    todofile = osp.join(workdir, 'todo')
+    with open(todofile, 'w') as f:
+        todo.write(f)
+    return todofile
+
+def run(cjm, n_jobs):
+    workdir = tempfile.mkdtemp()
+    try:
+        todofile = make_scenario(cjm, n_jobs, workdir)
+        profiler = cjm.profiling.Profiler(trace_memory=not args.no_trace_memory, name='bench', output_dir=workdir)
+        with profiler.phase('load'):
+            todolist = cjm.TodoList(todofile)
+        todoitems = [ todolist.get_todoitem(title) for title in todolist.get_section_titles() ]
+        with profiler.phase('copy'):
+            for todoitem in todoitems: todoitem.copy()
+        with profiler.phase('parse_todoitem'):
+            for todoitem in todoitems: todoitem.parse_todoitem()
+        todolist.update(profiler=profiler)
+    finally:
+        shutil.rmtree(workdir)
+    return {
+        phase : {
+            'time' : profiler.times[phase],
+            'rss_growth' : profiler.rss_growth.get(phase, None),
+            'peak_traced' : profiler.peak_memory.get(phase, None),
+            'allocated' : profiler.allocated.get(phase, None),
+            }
+        for phase in profiler.times
+        }, cjm.profiling.get_max_rss()
+
+def run_in_subprocess(n_jobs):
+    """
+    Runs the benchmark for one size in a fresh python process; returns the results
+    per phase and the peak RSS of that process
+    """
+    fd, output = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    try:
+        cmd = [
+            sys.executable, osp.abspath(__file__), '-n', str(n_jobs),
+            '--jobs-per-cluster', str(args.jobs_per_cluster), '--nschedds', str(args.nschedds),
+            '--seed', str(args.seed), '--worker-output', output,
+            ]
+        if args.no_trace_memory: cmd.append('--no-trace-memory')
+        subprocess.check_call(cmd)
+        with open(output) as f:
+            worker = json.load(f)
+    finally:
+        os.remove(output)
+    return worker['results'], worker['max_rss']
+
+def format_mb(n_bytes):
+    return '-' if n_bytes is None else '{0:.1f}'.format(n_bytes / 1e6)
+
+def print_results(results, max_rss):
+    print('{0:>9} {1:<16} {2:>10} {3:>16} {4:>17} {5:>16}'.format(
+        'njobs', 'phase', 'time (s)', 'RSS growth (MB)', 'peak traced (MB)', 'allocated (MB)'
+        ))
+    for n_jobs in sorted(results, key=int):
+        for phase, r in results[n_jobs].items():
+            print('{0:>9} {1:<16} {2:>10.3f} {3:>16} {4:>17} {5:>16}'.format(
+                n_jobs, phase, r['time'], format_mb(r['rss_growth']),
+                format_mb(r['peak_traced']), format_mb(r['allocated'])
+                ))
+    print('')
+    print('{0:>9} {1:>20}'.format('njobs', 'process peak RSS (MB)'))
+    for n_jobs in sorted(max_rss, key=int):
+        print('{0:>9} {1:>20}'.format(n_jobs, format_mb(max_rss[n_jobs])))
+
+def compare(old_file, new_file):
+    """
+    Prints the time ratio new/old per size and phase; returns the number of
+    phases that regressed beyond the threshold
+    """
+    with open(old_file) as f: old = json.load(f)['results']
+    with open(new_file) as f: new = json.load(f)['results']
+    n_regressions = 0
+    print('{0:>9} {1:<16} {2:>10} {3:>10} {4:>8}'.format('njobs', 'phase', 'old (s)', 'new (s)', 'ratio'))
+    for n_jobs in sorted(set(old) & set(new), key=int):
+        for phase in new[n_jobs]:
+            if not phase in old[n_jobs]: continue
+            t_old = old[n_jobs][phase]['time']
+            t_new = new[n_jobs][phase]['time']
+            ratio = t_new / t_old if t_old > 0 else float('inf')
+            # Ignore noise in phases that take next to no time
+            regressed = ratio > args.threshold and t_new - t_old > 0.01
+            if regressed: n_regressions += 1
+            print('{0:>9} {1:<16} {2:>10.3f} {3:>10.3f} {4:>8.2f}{5}'.format(
+                n_jobs, phase, t_old, t_new, ratio, '  REGRESSION' if regressed else ''
+                ))
+    return n_regressions
+
+def main():
+    if args.compare:
+        n_regressions = compare(*args.compare)
+        print('{0} regression(s)'.format(n_regressions))
+        sys.exit(1 if n_regressions else 0)
+    if args.worker_output:
+        results, max_rss = run(setup_cjm(), args.njobs[0])
+        with open(args.worker_output, 'w') as f:
+            json.dump({ 'results' : results, 'max_rss' : max_rss }, f)
+        return
+    results = {}
+    max_rss = {}
+    for n_jobs in args.njobs:
+        results[str(n_jobs)], max_rss[str(n_jobs)] = run_in_subprocess(n_jobs)
+    print_results(results, max_rss)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'time' : time.strftime('%Y-%m-%d %H:%M:%S'),
+                'python' : sys.version.split()[0],
+                'args' : vars(args),
+                'results' : results,
+                'max_rss' : max_rss,
+                }, f, indent=1, sort_keys=True)
+        print('Saved results to {0}'.format(args.output))
+
+if __name__ == '__main__':
+    main()
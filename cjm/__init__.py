@@ -10,8 +10,6 @@ if 'CJM_ROTFILEHANDLER' in os.environ:
     # emitted *during* the configuration
     add_rotating_file_handler(os.environ['CJM_ROTFILEHANDLER'], delete_other_handlers=True)
 
-from . import utils
-
 # Default dir to save files related to the module
 if 'CJM_DIR' in os.environ:
     CJM_DIR = os.environ['CJM_DIR']
@@ -48,14 +46,47 @@ if 'CJM_TODO_FILE' in os.environ:
     CJM_TODO_FILE = os.environ['CJM_TODO_FILE']
 
 # Utility to load a config
-from .config import ConfigCollection, Config
 def reload_config(config_name):
+    from .config import ConfigCollection
     configcollection = ConfigCollection(CJM_CONF_FILE)
     return configcollection.get_config(config_name)
 
-# Default config
-CONFIG = reload_config(CJM_CONF)
+# Submodules, and the classes exported at package level by the submodule defining
+# them; they are only imported on first access, to keep `import cjm` cheap
+_lazy_submodules = [
+    'utils', 'config', 'history', 'jobstates', 'storage', 'journal', 'daemon',
+    'eventlog', 'cluster', 'email', 'todo', 'profiling', 'simulator',
+    'metrics', 'aio',
+    ]
+_lazy_attributes = {
+    'ConfigCollection' : 'config',
+    'Config' : 'config',
+    'Cluster' : 'cluster',
+    'Email' : 'email',
+    'EventCodes' : 'email',
+    'TodoList' : 'todo',
+    'HTCondorTodoItem' : 'todo',
+    'HTCondorQueueState' : 'todo',
+    'HTCondorUpdater' : 'todo',
+    }
+
+def __getattr__(name):
+    """
+    Resolves the default config (CONFIG), submodules and the main classes on
+    first access, and stores them as regular module attributes
+    """
+    import importlib
+    if name == 'CONFIG':
+        # Default config
+        value = reload_config(CJM_CONF)
+    elif name in _lazy_submodules:
+        value = importlib.import_module('.' + name, __name__)
+    elif name in _lazy_attributes:
+        value = getattr(importlib.import_module('.' + _lazy_attributes[name], __name__), name)
+    else:
+        raise AttributeError('module {0!r} has no attribute {1!r}'.format(__name__, name))
+    globals()[name] = value
+    return value
 
-from .cluster import Cluster
-from .email import Email, EventCodes
-from .todo import TodoList, HTCondorTodoItem, HTCondorQueueState, HTCondorUpdater
+def __dir__():
+    return sorted(set(globals()) | set(_lazy_submodules) | set(_lazy_attributes) | set(['CONFIG']))
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+asyncio engine for the blocking I/O of an update cycle, used if `io_engine` is
+'asyncio' in the config. Queue and history queries and the side effects decided
+while processing jobs (edit/release calls, reading stderr tails) run as
+concurrent tasks; the blocking htcondor calls themselves run in an executor.
+Concurrency is bounded globally (`io_concurrency`) and per schedd
+(`io_concurrency_per_schedd`).
+
+The decisions about job states are made beforehand, in the usual deterministic
+order, so the engine only changes when the I/O happens, not what the outcome is.
+The functions without the _async suffix are synchronous wrappers, which run their
+coroutine in a fresh event loop; they can not be called from a running loop.
+"""
+import cjm
+import logging, time, asyncio
+from concurrent.futures import ThreadPoolExecutor
+logger = logging.getLogger('cjm')
+
+
+class Engine(object):
+    """
+    Runs blocking calls in an executor, within the global and per-schedd limits.
+    Must be created inside the event loop it is used in.
+
+    :param config: Config with the concurrency limits; defaults to cjm.CONFIG
+    :type config: cjm.config.Config, optional
+    """
+
+    def __init__(self, config=None):
+        super(Engine, self).__init__()
+        self.config = cjm.CONFIG if config is None else config
+        self.executor = ThreadPoolExecutor(max_workers=max(1, self.config.io_concurrency))
+        self.semaphore = asyncio.Semaphore(max(1, self.config.io_concurrency))
+        self.schedd_semaphores = {}
+
+    def get_schedd_semaphore(self, schedd):
+        name = self.config.get_schedd_name(schedd)
+        if not name in self.schedd_semaphores:
+            self.schedd_semaphores[name] = asyncio.Semaphore(max(1, self.config.io_concurrency_per_schedd))
+        return self.schedd_semaphores[name]
+
+    async def call(self, func, *args, schedd=None, timeout=None):
+        """
+        Runs `func(*args)` in the executor and returns its result. If `schedd` is
+        given, the call also counts against the limit of that schedd. Raises
+        asyncio.TimeoutError if the call takes longer than `timeout` seconds.
+        """
+        async with self.semaphore:
+            if schedd is None:
+                return await self._run(func, args, timeout)
+            async with self.get_schedd_semaphore(schedd):
+                return await self._run(func, args, timeout)
+
+    async def _run(self, func, args, timeout):
+        future = asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        if timeout is None: return await future
+        return await asyncio.wait_for(future, timeout)
+
+    def shutdown(self):
+        # Do not wait for hanging calls; their threads finish in the background
+        self.executor.shutdown(wait=False)
+
+
+def run(coroutine_function, *args, **kwargs):
+    """
+    Runs `coroutine_function(engine, *args, **kwargs)` in a new event loop with a new
+    Engine, and returns its result
+    """
+    config = kwargs.pop('config', None)
+    loop = asyncio.new_event_loop()
+    try:
+        async def main():
+            engine = Engine(config)
+            try:
+                return await coroutine_function(engine, *args, **kwargs)
+            finally:
+                engine.shutdown()
+        return loop.run_until_complete(main())
+    finally:
+        loop.close()
+
+
+async def fanout_schedds_async(engine, func, schedds, timeout, failures):
+    """
+    Calls `func(schedd)` for all schedds concurrently. Returns `(schedd, result,
+    seconds)` tuples in the order in which the schedds answered, and appends
+    failing schedds to `failures` as `(schedd, exception)` pairs.
+    """
+    answers = []
+
+    async def call_schedd(schedd):
+        t0 = time.time()
+        try:
+            result = await engine.call(func, schedd, schedd=schedd, timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.error('Schedd %s did not answer within %s s', schedd, timeout)
+            failures.append((schedd, cjm.utils.ScheddQueryError(
+                'Schedd {0} did not answer within {1} s'.format(schedd, timeout)
+                )))
+        except Exception as e:
+            logger.error('Query to schedd %s failed: %s', schedd, e)
+            failures.append((schedd, e))
+        else:
+            answers.append((schedd, result, time.time() - t0))
+
+    await asyncio.gather(*[ call_schedd(schedd) for schedd in schedds ])
+    return answers
+
+def fanout_schedds(func, schedds, timeout, failures, config=None):
+    return run(fanout_schedds_async, func, schedds, timeout, failures, config=config)
+
+
+async def run_actions_async(engine, actions):
+    """
+    Runs the DeferredActions concurrently. Returns a list with per action None if it
+    succeeded, or the exception it raised; a failing action does not stop the others.
+    """
+    async def run_action(action):
+        try:
+            await engine.call(action.run, schedd=action.schedd, timeout=engine.config.schedd_timeout)
+        except asyncio.TimeoutError:
+            logger.error('%s did not finish within %s s', action, engine.config.schedd_timeout)
+            return cjm.utils.ScheddQueryError('{0} timed out'.format(action))
+        except Exception as e:
+            logger.error('%s failed: %s', action, e)
+            return e
+        return None
+
+    t0 = time.time()
+    results = await asyncio.gather(*[ run_action(action) for action in actions ])
+    logger.info(
+        'Ran %s deferred actions in %.2f s (%s failed)',
+        len(actions), time.time() - t0, sum(1 for r in results if not r is None)
+        )
+    return results
+
+def run_actions(actions, config=None):
+    return run(run_actions_async, actions, config=config)
@@ -35,12 +35,11 @@ class Cluster(object):
     def xquery(self, projection=None, requirements=None):
         if projection is None: projection = self.projection
         if requirements is None: requirements = self.requirements
-        jobs = []
-        for schedd in self.config.schedds:
-            for job in schedd.xquery(
-                requirements=self.requirements,
-                projection=self.projection
-                ):
+        for schedd, jobs in cjm.utils.fanout_schedds(
+            lambda schedd: list(schedd.xquery(requirements=requirements, projection=projection)),
+            config=self.config, call='xquery'
+            ):
+            for job in jobs:
                 job.schedd = schedd  # append manually the scheduler the job belonged to
                 yield job
 
@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 import cjm
 import os.path as osp
-import logging, os, configparser, sys
+import logging, os, configparser, sys, json, time
 logger = logging.getLogger('cjm')
 
 class ConfigCollection(object):
@@ -72,6 +72,20 @@ class Config(object):
         else:
             self.set_todofile(osp.join(cjm.CJM_DIR, 'todo'))
 
+        # How the todo list is stored: 'ini' (one file) or 'sharded' (one file per cluster)
+        self.todo_storage = self.section.get('todo_storage', 'ini')
+
+        # Persistent store for the history of finished jobs; 'none' disables it
+        if 'history_store' in self.section:
+            self.history_store_file = self.section['history_store']
+            if self.history_store_file.lower() == 'none': self.history_store_file = None
+        else:
+            self.history_store_file = osp.join(cjm.CJM_DIR, 'history.sqlite')
+
+        # Located schedd ads are cached for this many seconds; 0 disables the cache
+        self.schedd_cache_ttl = float(self.section.get('schedd_cache_ttl', 86400.))
+        self.schedd_cache_file = osp.join(cjm.CJM_DIR, 'schedds.json')
+
         if 'notification_email' in self.section:
             self.notification_email = self.section['notification_email']
         else:
@@ -104,17 +118,71 @@ class Config(object):
             'LastRemoteHost',
             ]
 
+        # Concurrency of queries to the schedds
+        self.schedd_pool_size = int(self.section.get('schedd_pool_size', 8))
+        self.schedd_timeout = float(self.section.get('schedd_timeout', 60.))
+
+        # Only retrieve full classads for jobs that changed status since the previous poll
+        self.delta_polling = self.section.getboolean('delta_polling', False)
+        # Seconds subtracted from the local clock when it stands in for a schedd's ServerTime
+        self.delta_polling_margin = float(self.section.get('delta_polling_margin', 300.))
+
+        # How job states are updated: 'poll' queries the schedds, 'eventlog' follows the
+        # job event logs and only polls clusters without a (readable) log
+        self.update_engine = self.section.get('update_engine', 'poll')
+        if not self.update_engine in ['poll', 'eventlog']:
+            raise ValueError(
+                'Unknown update_engine {0}; choose from poll, eventlog'
+                .format(self.update_engine)
+                )
+
+        # How blocking I/O is done: 'sync', or 'asyncio', which runs queries and the
+        # side effects of processing (edit/release calls, stderr tails) as concurrent
+        # tasks, at most io_concurrency at once and io_concurrency_per_schedd per schedd
+        self.io_engine = self.section.get('io_engine', 'sync')
+        if not self.io_engine in ['sync', 'asyncio']:
+            raise ValueError(
+                'Unknown io_engine {0}; choose from sync, asyncio'
+                .format(self.io_engine)
+                )
+        self.io_concurrency = int(self.section.get('io_concurrency', self.schedd_pool_size))
+        self.io_concurrency_per_schedd = int(self.section.get('io_concurrency_per_schedd', 4))
+
+        # Maximum number of jobs edited and released with one call when resubmitting
+        self.resubmit_group_size = int(self.section.get('resubmit_group_size', 1000))
+
+        # Update cycles that take longer than this many seconds trigger a profile of
+        # the next cycle; 0 disables this
+        self.profile_slow_cycle = float(self.section.get('profile_slow_cycle', 0.))
+
+        # Poll every cluster at its own interval, depending on its activity
+        self.adaptive_polling = self.section.getboolean('adaptive_polling', False)
+        self.poll_interval_min = float(self.section.get('poll_interval_min', 300.))
+        self.poll_interval_max = float(self.section.get('poll_interval_max', 3600.))
+        # Factor by which the interval grows for each poll without any state transition
+        self.poll_backoff = float(self.section.get('poll_backoff', 2.))
+
+        # Metrics of every update cycle, as a Prometheus textfile and as json lines;
+        # 'none' disables either
+        self.metrics_prom_file = self.get_path_option('metrics_prom_file', osp.join(cjm.CJM_DIR, 'cjm.prom'))
+        self.metrics_jsonl_file = self.get_path_option('metrics_jsonl_file', osp.join(cjm.CJM_DIR, 'metrics.jsonl'))
+
         self.email_for_first_n_resubmissions = 10
         self.email_for_first_n_failures = 10
 
         self.append_htcondor_paths()
         self.init_condor_calls()
 
+    def get_path_option(self, key, default):
+        """
+        Returns the path for `key`, `default` if it is not set, or None if it is 'none'
+        """
+        path = self.section.get(key, default)
+        return None if path.lower() == 'none' else path
+
     def append_htcondor_paths(self):
-        if sys.version_info[0] == 3 and 'htcondor_paths_py3' in self.section:
+        if 'htcondor_paths_py3' in self.section:
             paths = self.section['htcondor_paths_py3'].split(',')
-        elif sys.version_info[0] == 2 and 'htcondor_paths_py2' in self.section:
-            paths = self.section['htcondor_paths_py2'].split(',')
         elif 'htcondor_paths' in self.section:
             paths = self.section['htcondor_paths'].split(',')
         else:
@@ -123,17 +191,148 @@ class Config(object):
         sys.path.extend(paths)
 
     def init_condor_calls(self):
-        # Verbose import of htcondor, to crash early if it doesn't exist
-        # This should be the first time htcondor is attempted to be imported
-        if 'htcondor' in sys.modules:
-            logger.info('Found htcondor: %s', sys.modules['htcondor'])
-        else:
-            logger.info('Will try to import htcondor')
+        # htcondor is only imported, and the collector and schedds are only
+        # contacted, when a schedd is first used
+        self._collector = None
+        self._schedd_ads = None
+        self._schedds = None
+        # Names of schedds whose handle was created from a cached ad, and of those
+        # for which a query failed, so that they should be located again
+        self._cached_schedd_names = set()
+        self._stale_schedd_names = set()
+
+    @property
+    def collector(self):
+        if self._collector is None:
+            if not 'htcondor' in sys.modules: logger.info('Will try to import htcondor')
+            import htcondor
+            logger.debug('Loaded htcondor module in cjm.config: %s', htcondor)
+            self._collector = htcondor.Collector()
+        return self._collector
+
+    @property
+    def schedd_ads(self):
+        if self._schedd_ads is None: self.resolve_schedds()
+        return self._schedd_ads
+
+    @property
+    def schedds(self):
+        if self._schedds is None: self.resolve_schedds()
+        return self._schedds
+
+    # Keys of a located schedd ad that are needed to contact the schedd
+    schedd_ad_keys = [ 'Name', 'Machine', 'MyAddress', 'AddressV1', 'CondorVersion', 'CondorPlatform' ]
+
+    def read_schedd_cache(self):
+        """
+        Returns the fresh entries of the schedd cache file, as a dict of schedd name
+        to { 'time' : <time located>, 'ad' : <dict> }
+        """
+        if self.schedd_cache_ttl <= 0 or not osp.isfile(self.schedd_cache_file): return {}
+        try:
+            with open(self.schedd_cache_file, 'r') as f:
+                cache = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            logger.warning('Could not read schedd cache %s: %s', self.schedd_cache_file, e)
+            return {}
+        now = time.time()
+        return { name : entry for name, entry in cache.items() if now - entry['time'] < self.schedd_cache_ttl }
+
+    def write_schedd_cache(self, cache):
+        if self.schedd_cache_ttl <= 0: return
+        try:
+            cjm.storage.atomic_write(self.schedd_cache_file, json.dumps(cache, sort_keys=True, indent=1))
+        except (IOError, OSError) as e:
+            logger.warning('Could not write schedd cache %s: %s', self.schedd_cache_file, e)
+
+    def locate_schedd(self, name, cache):
+        """
+        Locates a schedd via the collector and stores its ad in `cache`
+        """
+        import htcondor
+        logger.info('Locating schedd %s', name)
+        ad = self.collector.locate(htcondor.DaemonTypes.Schedd, name)
+        cache[name] = {
+            'time' : time.time(),
+            'ad' : { key : str(ad[key]) for key in self.schedd_ad_keys if key in ad },
+            }
+        return ad
+
+    def resolve_schedds(self):
+        """
+        Creates the schedd handles, from cached location ads where possible, and
+        by locating the schedds via the collector otherwise
+        """
+        import htcondor
+        try:
+            import classad
+        except ImportError:
+            classad = None
+        cache = self.read_schedd_cache()
+        n_cached = len(cache)
+        self._schedd_ads = []
+        self._cached_schedd_names = set()
+        for name in self.schedd_names:
+            if name in cache and not classad is None:
+                logger.debug('Using cached ad for schedd %s', name)
+                ad = classad.ClassAd(cache[name]['ad'])
+                self._cached_schedd_names.add(name)
+            else:
+                ad = self.locate_schedd(name, cache)
+            self._schedd_ads.append(ad)
+        self._schedds = [ htcondor.Schedd(ad) for ad in self._schedd_ads ]
+        if len(cache) != n_cached:
+            self.write_schedd_cache(cache)
+
+    def set_schedds(self, schedds, names=None):
+        """
+        Uses the given schedd handles instead of locating `schedd_names` (e.g.
+        simulated schedds from cjm.simulator)
+        """
+        self.schedd_names = [ getattr(s, 'name', str(s)) for s in schedds ] if names is None else list(names)
+        self._schedds = list(schedds)
+        self._schedd_ads = [ None for s in schedds ]
+        self._cached_schedd_names = set()
+        self._stale_schedd_names = set()
+
+    def mark_schedds_stale(self, schedds):
+        """
+        Called when queries to `schedds` failed: if their handles came from a cached
+        ad, the ad may be outdated, so it is removed from the cache and the schedds
+        are located again by `refresh_stale_schedds`.
+        """
+        names = [ self.get_schedd_name(schedd) for schedd in schedds ]
+        names = [ name for name in names if name in self._cached_schedd_names ]
+        if len(names) == 0: return
+        logger.warning('Query failed for schedd(s) %s with a cached ad; will locate them again', names)
+        self._stale_schedd_names.update(names)
+        cache = self.read_schedd_cache()
+        for name in names: cache.pop(name, None)
+        self.write_schedd_cache(cache)
+
+    def refresh_stale_schedds(self):
+        """
+        Locates the schedds marked stale again and replaces their handles.
+        Should be called between update cycles, not while schedd handles are in use.
+        """
+        if len(self._stale_schedd_names) == 0 or self._schedds is None: return
         import htcondor
-        logger.debug('Loaded htcondor module in cjm.config: %s', htcondor)
-        self.collector = htcondor.Collector()
-        self.schedd_ads = [ self.collector.locate(htcondor.DaemonTypes.Schedd, name) for name in self.schedd_names ]
-        self.schedds = [ htcondor.Schedd(ad) for ad in self.schedd_ads ]
+        cache = self.read_schedd_cache()
+        for name in sorted(self._stale_schedd_names):
+            i = self.schedd_names.index(name)
+            self._schedd_ads[i] = self.locate_schedd(name, cache)
+            self._schedds[i] = htcondor.Schedd(self._schedd_ads[i])
+            self._cached_schedd_names.discard(name)
+        self._stale_schedd_names = set()
+        self.write_schedd_cache(cache)
+
+    def get_schedd_name(self, schedd):
+        """
+        Returns the name (as in `schedd_names`) of a schedd handle
+        """
+        for name, other in zip(self.schedd_names, self.schedds):
+            if other is schedd: return name
+        return str(schedd)
 
     def set_todofile(self, todofile):
         self.todofile = todofile
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import cjm
+import os.path as osp
+import logging, os, signal, threading, time, fcntl
+from contextlib import contextmanager
+logger = logging.getLogger('cjm')
+
+
+@contextmanager
+def update_lock(todofile, blocking=True):
+    """
+    Holds an exclusive lock on `todofile`.lock, so that a cron-driven cjm-update
+    and a cjm-daemon never update the same todo list at the same time.
+    Yields whether the lock was acquired (always True if blocking).
+    """
+    lockfile = todofile + '.lock'
+    dirname = osp.dirname(osp.abspath(lockfile))
+    if not osp.isdir(dirname):
+        logger.info('Creating directory %s', dirname)
+        os.makedirs(dirname)
+    with open(lockfile, 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            logger.warning('%s is locked by another process', lockfile)
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class Daemon(object):
+    """
+    Runs TodoList.update in a loop within a single process.
+
+    Compared to running cjm-update from cron, the schedd handles (in cjm.CONFIG), the
+    history cache and the parsed todo list are kept alive between cycles. The todo
+    list is only re-read from disk if it was modified by another process (e.g. a
+    cjm-update run from cron), and new submissions are picked up from the journal
+    every cycle. The configuration is reloaded when the config file changes.
+    SIGTERM and SIGINT stop the daemon after the running cycle.
+
+    :param interval: Seconds between the start of two update cycles
+    :type interval: float
+    :param todofile: Path to the todo file (uses the config default if None)
+    :type todofile: str, optional
+    :param config_name: Name of the configuration to (re)load
+    :type config_name: str, optional
+    """
+
+    def __init__(self, interval=300., todofile=None, config_name=None):
+        super(Daemon, self).__init__()
+        self.interval = float(interval)
+        self.todofile_override = todofile
+        self.config_name = cjm.CJM_CONF if config_name is None else config_name
+        self.config_mtime = self.get_config_mtime()
+        self.todolist = None
+        self.signature = None
+        self.n_cycles = 0
+        self._stop = threading.Event()
+
+    @property
+    def todofile(self):
+        return cjm.CONFIG.todofile if self.todofile_override is None else self.todofile_override
+
+    def install_signal_handlers(self):
+        for signum in [ signal.SIGTERM, signal.SIGINT ]:
+            signal.signal(signum, self.handle_signal)
+
+    def handle_signal(self, signum, frame):
+        logger.info('Received signal %s; stopping after the current cycle', signum)
+        self.stop()
+
+    def stop(self):
+        self._stop.set()
+
+    def is_stopped(self):
+        return self._stop.is_set()
+
+    def get_config_mtime(self):
+        try:
+            return os.stat(cjm.CJM_CONF_FILE).st_mtime
+        except OSError:
+            return None
+
+    def reload_config_if_changed(self):
+        """
+        Reloads cjm.CONFIG if the config file was modified since the last check.
+        Returns True if the config was reloaded.
+        """
+        mtime = self.get_config_mtime()
+        if mtime == self.config_mtime: return False
+        logger.info('%s changed; reloading config %s', cjm.CJM_CONF_FILE, self.config_name)
+        try:
+            config = cjm.reload_config(self.config_name)
+        except Exception:
+            logger.exception('Could not reload config; keeping the current one')
+            return False
+        self.config_mtime = mtime
+        cjm.CONFIG = config
+        # The todo file or its storage kind may have changed
+        self.todolist = None
+        return True
+
+    def get_todolist(self):
+        """
+        Returns the todo list to update: the one kept from the previous cycle if the
+        stored state was not modified by another process, or a freshly read one
+        """
+        if self.todolist is not None and self.todolist.todofile != self.todofile:
+            self.todolist = None
+        if self.todolist is not None and self.todolist.storage.signature() != self.signature:
+            logger.info('%s was modified externally; re-reading', self.todolist.storage)
+            self.todolist = None
+        if self.todolist is None:
+            self.todolist = cjm.TodoList(self.todofile)
+        else:
+            self.todolist.fold_journal()
+        return self.todolist
+
+    def cycle(self):
+        """
+        Runs a single update cycle
+        """
+        self.reload_config_if_changed()
+        with update_lock(self.todofile):
+            todolist = self.get_todolist()
+            self.todolist = todolist.update()
+            self.signature = self.todolist.storage.signature()
+
+    def run(self, max_cycles=None):
+        """
+        Runs update cycles until stopped (or until `max_cycles` cycles ran). An
+        exception in a cycle is logged, and the next cycle re-reads all state.
+        """
+        logger.info('Starting cjm daemon (pid %s), interval %ss', os.getpid(), self.interval)
+        while not self.is_stopped():
+            t0 = time.time()
+            try:
+                self.cycle()
+            except Exception:
+                logger.exception('Update cycle failed')
+                self.todolist = None
+            self.n_cycles += 1
+            if max_cycles is not None and self.n_cycles >= max_cycles: break
+            self._stop.wait(max(0., self.interval - (time.time() - t0)))
+        logger.info('cjm daemon stopped after %s cycles', self.n_cycles)
@@ -122,8 +122,8 @@ class EmailTodoItemSection(object):
             return False
         message = [[ '', 'previous', 'now' ]]
         for state in self.todoitem.states:
-            old = str(len(kwargs['old_todoitem'].get_jobs_in_state(state)))
-            new = str(len(self.todoitem.get_jobs_in_state(state)))
+            old = str(kwargs['old_todoitem'].count_jobs_in_state(state))
+            new = str(self.todoitem.count_jobs_in_state(state))
             message.append([state, old, new])
         message = '\n'.join([ ' '.join(line) for line in message ])
         message = 'Cluster {0}\n'.format(self.todoitem.cluster_id) + message
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import cjm
+import os.path as osp
+import logging, os, re
+logger = logging.getLogger('cjm')
+
+# Event codes of the classic job event log (user log) format
+SUBMIT = 0
+EXECUTE = 1
+EVICTED = 4
+TERMINATED = 5
+ABORTED = 9
+HELD = 12
+RELEASED = 13
+
+# JobStatus a job is in after an event; other events do not change the status
+EVENT_JOBSTATUS = {
+    SUBMIT : 1,
+    EXECUTE : 2,
+    EVICTED : 1,
+    TERMINATED : 4,
+    ABORTED : 3,
+    HELD : 5,
+    RELEASED : 1,
+    }
+
+EVENT_HEADER = re.compile(r'^(\d{3}) \((\d+)\.(\d+)\.\d+\) (\S+ \S+)')
+RETURN_VALUE = re.compile(r'Normal termination \(return value (-?\d+)\)')
+SIGNAL = re.compile(r'Abnormal termination \(signal (\d+)\)')
+HOLD_CODE = re.compile(r'Code (-?\d+) Subcode (-?\d+)')
+
+
+class JobEvent(object):
+    """
+    A single event from a job event log
+    """
+
+    __slots__ = [ 'code', 'cluster_id', 'proc_id', 'time', 'lines' ]
+
+    @classmethod
+    def from_lines(cls, lines):
+        """
+        Parses the lines of one event (without the closing '...'). Returns None if
+        the header is not recognized.
+        """
+        match = EVENT_HEADER.match(lines[0]) if lines else None
+        if match is None:
+            logger.warning('Could not parse event log header %r', lines[0] if lines else '')
+            return None
+        code, cluster_id, proc_id, time = match.groups()
+        return cls(int(code), int(cluster_id), int(proc_id), time, lines[1:])
+
+    def __init__(self, code, cluster_id, proc_id, time, lines=None):
+        super(JobEvent, self).__init__()
+        self.code = code
+        self.cluster_id = cluster_id
+        self.proc_id = proc_id
+        self.time = time
+        self.lines = [] if lines is None else lines
+
+    def __repr__(self):
+        return '<JobEvent {0:03d} {1}.{2} {3}>'.format(self.code, self.cluster_id, self.proc_id, self.time)
+
+    @property
+    def jobstatus(self):
+        return EVENT_JOBSTATUS.get(self.code, None)
+
+    def search(self, regex):
+        for line in self.lines:
+            match = regex.search(line)
+            if match: return match
+        return None
+
+    def return_value(self):
+        """
+        Returns the return value of a normally terminated job, or None
+        """
+        match = self.search(RETURN_VALUE)
+        return None if match is None else int(match.group(1))
+
+    def signal(self):
+        """
+        Returns the signal that killed an abnormally terminated job, or None
+        """
+        match = self.search(SIGNAL)
+        return None if match is None else int(match.group(1))
+
+    def classad(self):
+        """
+        Returns a classad-like dict for the state of the job after this event, as
+        `HTCondorQueueState.query` would yield it
+        """
+        classad = EventClassAd(
+            ClusterId = self.cluster_id,
+            ProcId = self.proc_id,
+            JobStatus = self.jobstatus,
+            )
+        if self.code == HELD:
+            classad['HoldReason'] = self.lines[0].strip() if self.lines else ''
+            match = self.search(HOLD_CODE)
+            if match:
+                classad['HoldReasonCode'] = int(match.group(1))
+                classad['HoldReasonSubCode'] = int(match.group(2))
+        elif self.code == TERMINATED:
+            return_value = self.return_value()
+            if return_value is None:
+                classad['ExitBySignal'] = True
+                classad['ExitSignal'] = self.signal()
+            else:
+                classad['ExitBySignal'] = False
+                classad['ExitCode'] = return_value
+        return classad
+
+
+class EventClassAd(dict):
+    """
+    Classad-like dict built from a job event, with the helper attributes that
+    `HTCondorQueueState.query` sets on real classads. The schedd is not known.
+    """
+    def __init__(self, *args, **kwargs):
+        super(EventClassAd, self).__init__(*args, **kwargs)
+        self.schedd = None
+        self.proc_id = int(self['ProcId'])
+        self.state = int(self.get('JobStatus', -1))
+
+
+def read_events(path, offset=0):
+    """
+    Reads the events from a job event log starting at byte `offset`.
+    Only complete events (closed by a '...' line) are returned, so that an event
+    that is still being written is read in full next time.
+
+    :param path: Path to the job event log
+    :type path: str
+    :param offset: Byte offset to start reading at (the offset returned previously)
+    :type offset: int
+    :returns: list of JobEvent instances, and the offset up to which was read
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < offset:
+            logger.warning('%s is smaller than the stored offset %s; reading from the start', path, offset)
+            offset = 0
+        f.seek(offset)
+        data = f.read()
+    events = []
+    lines = []
+    position = 0
+    consumed = 0
+    for line in data.splitlines(True):
+        if not line.endswith(b'\n'): break # Incomplete line
+        position += len(line)
+        line = line.decode('utf-8', 'replace').rstrip('\r\n')
+        if line == '...':
+            event = JobEvent.from_lines(lines)
+            if event: events.append(event)
+            lines = []
+            consumed = position
+        else:
+            lines.append(line)
+    logger.debug('Read %s events from %s (bytes %s-%s)', len(events), path, offset, offset + consumed)
+    return events, offset + consumed
+
+
+class EventLogQueueState(object):
+    """
+    Queue state of a cluster derived from its job event log, instead of from a
+    schedd query. It has the interface of an HTCondorQueueState in delta mode:
+    classads only exist for jobs that had events since the previous read, and jobs
+    are listed until their terminate event.
+
+    :param cluster_id: The cluster
+    :type cluster_id: str
+    :param proc_ids: The proc_ids of the cluster that are not finished yet
+    :type proc_ids: iterable
+    :param events: JobEvent instances read from the log (of any cluster)
+    :type events: list
+    :param userlog_offset: Offset in the log up to which the events were read
+    :type userlog_offset: int
+    """
+
+    def __init__(self, cluster_id, proc_ids, events, userlog_offset):
+        super(EventLogQueueState, self).__init__()
+        self.cluster_id = cluster_id
+        self.userlog_offset = userlog_offset
+        self.delta = True
+        self.failed_schedds = []
+        self.poll_times = {}
+        self.listed_proc_ids = set(proc_ids)
+        # Only the last event that sets the status of a job counts
+        last_events = {}
+        for event in events:
+            if event.cluster_id != int(cluster_id) or event.jobstatus is None: continue
+            last_events[event.proc_id] = event
+        self.terminated = []
+        self.classads = []
+        self._classads_by_procid = {}
+        for proc_id in sorted(last_events):
+            if not proc_id in self.listed_proc_ids: continue
+            classad = last_events[proc_id].classad()
+            if classad.state == 4:
+                # The job left the queue; its exit code is picked up via the history
+                self.listed_proc_ids.discard(proc_id)
+                self.terminated.append(classad)
+            else:
+                self.classads.append(classad)
+                self._classads_by_procid[proc_id] = classad
+
+    def __repr__(self):
+        return '<EventLogQueueState {0}: {1} changed, {2} terminated>'.format(
+            self.cluster_id, len(self.classads), len(self.terminated)
+            )
+
+    def feed_history(self):
+        """
+        Adds the terminated jobs to the history cache, so that no history query
+        is needed to get their exit codes
+        """
+        if len(self.terminated) == 0: return
+        cjm.todo.HTCondorClusterHistory.feed(self.cluster_id, self.terminated)
+
+    def has_held_jobs(self):
+        return any(classad.state == 5 for classad in self.classads)
+
+    def get_classad(self, proc_id):
+        return self._classads_by_procid[proc_id]
+
+    def has_proc_id(self, proc_id):
+        return proc_id in self.listed_proc_ids
+
+    def has_classad(self, proc_id):
+        return proc_id in self._classads_by_procid
+
+    def changed_proc_ids(self):
+        return list(self._classads_by_procid.keys())
+
+    def is_complete(self):
+        return True
+
+
+def read_queuestates(todoitems):
+    """
+    Returns a dict of cluster_id to EventLogQueueState for all `todoitems` that can
+    be updated from their job event log. Todoitems without a known log, with an
+    unreadable log, or with held jobs (releasing them needs the schedd) are left
+    out, and should be polled instead. A log shared by several clusters is read once.
+    """
+    queuestates = {}
+    read_logs = {}
+    for todoitem in todoitems:
+        path = todoitem.get_userlog_path()
+        if path is None:
+            logger.debug('No event log known for %s', todoitem.cluster_id)
+            continue
+        key = (path, todoitem.userlog_offset)
+        if not key in read_logs:
+            try:
+                read_logs[key] = read_events(path, todoitem.userlog_offset)
+            except (IOError, OSError) as e:
+                logger.warning('Could not read event log %s: %s', path, e)
+                read_logs[key] = None
+        if read_logs[key] is None: continue
+        events, offset = read_logs[key]
+        queuestate = EventLogQueueState(todoitem.cluster_id, todoitem.active_proc_ids(), events, offset)
+        if queuestate.has_held_jobs():
+            logger.info('Cluster %s has held jobs; falling back to polling', todoitem.cluster_id)
+            continue
+        queuestate.feed_history()
+        queuestates[todoitem.cluster_id] = queuestate
+    logger.info('Updating %s out of %s clusters from event logs', len(queuestates), len(todoitems))
+    return queuestates
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import cjm
+import os.path as osp
+import logging, os, json, sqlite3, threading
+logger = logging.getLogger('cjm')
+
+# Keys to keep from a history classad, on top of CONFIG.interesting_history_keys
+STORED_HISTORY_KEYS = [ 'ExitCode', 'Err', 'Out', 'EnteredCurrentStatus' ]
+
+# Opened stores, by path
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get_store(config=None):
+    """
+    Returns the HistoryStore for the configuration, or None if the persistent
+    history is disabled (`history_store = none` in the config file)
+    """
+    config = cjm.CONFIG if config is None else config
+    path = config.history_store_file
+    if path is None: return None
+    with _stores_lock:
+        if not path in _stores:
+            _stores[path] = HistoryStore(path)
+        return _stores[path]
+
+def project_classad(classad, keys):
+    """
+    Returns a plain, json-serializable dict with only `keys` from `classad`.
+    ClassAd expressions that are not plain values are stored as strings.
+    """
+    projected = {}
+    for key in keys:
+        if not key in classad: continue
+        value = classad[key]
+        if not isinstance(value, (int, float, bool, str)) and not value is None:
+            value = str(value)
+        projected[key] = value
+    return projected
+
+
+class HistoryStore(object):
+    """
+    Persistent store for projected history classads of jobs that left the queue,
+    keyed by (cluster_id, proc_id). Lives in a sqlite file (under CJM_DIR by default),
+    so that history retrieved in one cjm-update run is still available in the next.
+    """
+
+    def __init__(self, path):
+        super(HistoryStore, self).__init__()
+        self.path = path
+        dirname = osp.dirname(self.path)
+        if dirname and not osp.isdir(dirname):
+            logger.info('Creating directory %s', dirname)
+            os.makedirs(dirname)
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS history ('
+                'cluster_id INTEGER NOT NULL, '
+                'proc_id INTEGER NOT NULL, '
+                'ad TEXT NOT NULL, '
+                'PRIMARY KEY (cluster_id, proc_id))'
+                )
+        logger.debug('Opened history store %s', self.path)
+
+    def get(self, cluster_id, proc_id):
+        """
+        Returns the stored history dict for a job, or None
+        """
+        with self._lock:
+            row = self.connection.execute(
+                'SELECT ad FROM history WHERE cluster_id=? AND proc_id=?',
+                (int(cluster_id), int(proc_id))
+                ).fetchone()
+        if row is None: return None
+        logger.debug('Found history for job %s.%s in %s', cluster_id, proc_id, self.path)
+        return json.loads(row[0])
+
+    def has_all(self, cluster_id, proc_ids):
+        """
+        Checks whether history for all `proc_ids` in `cluster_id` is stored
+        """
+        proc_ids = set(int(p) for p in proc_ids)
+        with self._lock:
+            stored = set(r[0] for r in self.connection.execute(
+                'SELECT proc_id FROM history WHERE cluster_id=?', (int(cluster_id),)
+                ))
+        return proc_ids.issubset(stored)
+
+    def put(self, classads, keys=None):
+        """
+        Stores the projection of history classads. Only jobs that reached a
+        terminal state (removed or completed) are stored.
+        """
+        if keys is None:
+            keys = cjm.CONFIG.interesting_history_keys + STORED_HISTORY_KEYS
+        rows = []
+        for classad in classads:
+            if not int(classad.get('JobStatus', 4)) in [3, 4]: continue
+            rows.append((
+                int(classad['ClusterId']), int(classad['ProcId']),
+                json.dumps(project_classad(classad, keys))
+                ))
+        if len(rows) == 0: return
+        with self._lock:
+            with self.connection:
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO history (cluster_id, proc_id, ad) VALUES (?, ?, ?)',
+                    rows
+                    )
+        logger.debug('Stored history for %s jobs in %s', len(rows), self.path)
+
+    def prune(self, keep_cluster_ids):
+        """
+        Removes the history of all clusters not in `keep_cluster_ids`
+        """
+        keep_cluster_ids = set(int(c) for c in keep_cluster_ids)
+        with self._lock:
+            stored = [ r[0] for r in self.connection.execute('SELECT DISTINCT cluster_id FROM history') ]
+            expired = [ c for c in stored if not c in keep_cluster_ids ]
+            if len(expired) == 0: return
+            with self.connection:
+                self.connection.executemany(
+                    'DELETE FROM history WHERE cluster_id=?', [ (c,) for c in expired ]
+                    )
+        logger.info('Removed stored history for clusters %s', expired)
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
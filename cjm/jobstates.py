@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import logging
+from array import array
+logger = logging.getLogger('cjm')
+
+# States a job in a todoitem can be in
+JOB_STATES = [
+    'idle',
+    'running',
+    'removed',
+    'completed',
+    'held',
+    'transferring',
+    'suspended',
+    'done',
+    'failed',
+    ]
+
+
+class JobStateStore(object):
+    """
+    Compact store of the state of every job in a cluster.
+
+    The state of each job is kept as a one-byte code in a bytearray, indexed by the
+    position of the proc_id in the (sorted) cluster. For the usual contiguous
+    proc_ids no index is stored at all; otherwise the proc_ids are kept in an
+    `array` and looked up by bisection. Per-state counters are updated incrementally,
+    so counting jobs in a state is O(1), and listing the jobs in a state is a scan
+    over the bytearray done in C (`bytearray.find`).
+
+    :param states: Names of the possible states
+    :type states: list
+    :param proc_ids: The proc_ids of all jobs in the cluster
+    :type proc_ids: iterable
+    """
+
+    UNSET = 255
+
+    def __init__(self, states, proc_ids):
+        super(JobStateStore, self).__init__()
+        self.states = list(states)
+        if len(self.states) >= self.UNSET:
+            raise ValueError('At most {0} states are supported'.format(self.UNSET))
+        self._codes = { state : code for code, state in enumerate(self.states) }
+        proc_ids = sorted(set(int(p) for p in proc_ids))
+        self._n = len(proc_ids)
+        self._offset = proc_ids[0] if self._n else 0
+        if self._n == 0 or proc_ids[-1] - proc_ids[0] + 1 == self._n:
+            # Contiguous proc_ids: position is simply proc_id - offset
+            self._proc_ids = None
+        else:
+            self._proc_ids = array('l', proc_ids)
+        self._state = bytearray([self.UNSET]) * self._n
+        self._counts = [0] * len(self.states)
+        # Sparse: most jobs never fail
+        self.failurecounts = {}
+        # Whether the state array and failure counts may be modified in place,
+        # or are (possibly) shared with a copy
+        self._owns_state = True
+        self._owns_failurecounts = True
+
+    def __len__(self):
+        return self._n
+
+    def copy(self):
+        """
+        Returns a copy-on-write copy: the state array and failure counts are shared
+        until either store modifies them, so copying is cheap regardless of size.
+        """
+        new = self.__class__.__new__(self.__class__)
+        new.__dict__.update(self.__dict__)
+        new._counts = self._counts[:]
+        self._owns_state = new._owns_state = False
+        self._owns_failurecounts = new._owns_failurecounts = False
+        return new
+
+    def __contains__(self, proc_id):
+        try:
+            self.index(proc_id)
+            return True
+        except KeyError:
+            return False
+
+    @property
+    def proc_ids(self):
+        """
+        Returns all proc_ids, sorted
+        """
+        if self._proc_ids is None:
+            return list(range(self._offset, self._offset + self._n))
+        return self._proc_ids.tolist()
+
+    def index(self, proc_id):
+        """
+        Returns the position of proc_id in the store; raises KeyError if it is not tracked
+        """
+        proc_id = int(proc_id)
+        if self._proc_ids is None:
+            i = proc_id - self._offset
+            if 0 <= i < self._n: return i
+        else:
+            from bisect import bisect_left
+            i = bisect_left(self._proc_ids, proc_id)
+            if i < self._n and self._proc_ids[i] == proc_id: return i
+        raise KeyError('proc_id {0} is not tracked'.format(proc_id))
+
+    def proc_id_at(self, i):
+        return self._offset + i if self._proc_ids is None else self._proc_ids[i]
+
+    def get_state(self, proc_id):
+        """
+        Returns the state name of a job, or None if no state was set
+        """
+        code = self._state[self.index(proc_id)]
+        return None if code == self.UNSET else self.states[code]
+
+    def set_state(self, proc_id, state):
+        """
+        Sets the state of a job and keeps the counters up to date. O(1) (or O(log n)
+        for non-contiguous proc_ids).
+        """
+        if not state in self._codes:
+            raise ValueError('State {0} does not exist'.format(state))
+        i = self.index(proc_id)
+        old_code = self._state[i]
+        new_code = self._codes[state]
+        if old_code == new_code: return
+        if not self._owns_state:
+            self._state = bytearray(self._state)
+            self._owns_state = True
+        if old_code != self.UNSET: self._counts[old_code] -= 1
+        self._counts[new_code] += 1
+        self._state[i] = new_code
+
+    def set_states(self, proc_ids, state):
+        for proc_id in proc_ids:
+            self.set_state(proc_id, state)
+
+    def count(self, state):
+        """
+        Returns the number of jobs in `state`
+        """
+        return self._counts[self._codes[state]]
+
+    def count_unset(self):
+        """
+        Returns the number of jobs for which no state was set
+        """
+        return self._n - sum(self._counts)
+
+    def proc_ids_in_state(self, state):
+        """
+        Returns the sorted proc_ids of the jobs in `state`, or of the jobs without a
+        state if `state` is None
+        """
+        if state is None:
+            code = bytes(bytearray([self.UNSET]))
+            n_expected = self.count_unset()
+        else:
+            code = bytes(bytearray([self._codes[state]]))
+            n_expected = self.count(state)
+        proc_ids = []
+        i = self._state.find(code)
+        while i != -1 and len(proc_ids) < n_expected:
+            proc_ids.append(self.proc_id_at(i))
+            i = self._state.find(code, i+1)
+        return proc_ids
+
+    def proc_ids_in_states(self, states):
+        """
+        Returns the sorted proc_ids of the jobs in any of `states`; None stands for
+        the jobs without a state. States without jobs are skipped based on the
+        counters, without scanning.
+        """
+        proc_ids = []
+        for state in states:
+            if (self.count_unset() if state is None else self.count(state)) == 0: continue
+            proc_ids.extend(self.proc_ids_in_state(state))
+        proc_ids.sort()
+        return proc_ids
+
+    def same_states(self, other):
+        """
+        Checks whether `other` holds the same job states and failure counts
+        """
+        return (
+            (self._state is other._state or self._state == other._state)
+            and self.failurecounts == other.failurecounts
+            )
+
+    def get_failurecount(self, proc_id):
+        return self.failurecounts.get(int(proc_id), 0)
+
+    def set_failurecount(self, proc_id, count):
+        self.index(proc_id) # Raises if not tracked
+        if not self._owns_failurecounts:
+            self.failurecounts = dict(self.failurecounts)
+            self._owns_failurecounts = True
+        if int(count) == 0:
+            self.failurecounts.pop(int(proc_id), None)
+        else:
+            self.failurecounts[int(proc_id)] = int(count)
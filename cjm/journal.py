@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os.path as osp
+import logging, os, json, fcntl
+logger = logging.getLogger('cjm')
+
+
+class SubmissionJournal(object):
+    """
+    Append-only journal of newly submitted clusters, one json record per line.
+
+    Appending costs O(1) regardless of the size of the todo list, and is safe for
+    concurrent appenders (an exclusive lock is held per append). The TodoList folds
+    the records into its state when reading, and after the state is written the
+    consumed part of the journal is compacted away. Records appended in between are
+    kept, so a submission can not be dropped by a concurrent update.
+    """
+
+    def __init__(self, path):
+        super(SubmissionJournal, self).__init__()
+        self.path = path
+
+    def __repr__(self):
+        return '<SubmissionJournal {0}>'.format(self.path)
+
+    def exists(self):
+        return osp.isfile(self.path)
+
+    def append(self, title, section):
+        """
+        Appends a record for a new todo section
+        """
+        dirname = osp.dirname(osp.abspath(self.path))
+        if not osp.isdir(dirname):
+            logger.info('Creating directory %s', dirname)
+            os.makedirs(dirname)
+        line = json.dumps({ 'title' : title, 'section' : dict(section) }, sort_keys=True) + '\n'
+        with open(self.path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        logger.info('Appended section %s to %s', title, self.path)
+
+    def read(self):
+        """
+        Returns a list of (title, section) records and the byte offset up to which
+        the journal was read (to be passed to `compact`)
+        """
+        if not self.exists(): return [], 0
+        with open(self.path, 'rb') as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            try:
+                data = f.read()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        # Only consider complete lines
+        offset = data.rfind(b'\n') + 1
+        records = []
+        for line in data[:offset].decode('utf-8').splitlines():
+            if not line.strip(): continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logger.error('Skipping corrupt line in %s: %s', self.path, line)
+                continue
+            records.append((record['title'], record['section']))
+        return records, offset
+
+    def compact(self, offset):
+        """
+        Removes the first `offset` bytes (the records that were folded into the
+        stored todo list) from the journal, keeping anything appended since
+        """
+        if offset == 0 or not self.exists(): return
+        with open(self.path, 'r+b') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                remainder = f.read()[offset:]
+                f.seek(0)
+                f.truncate()
+                f.write(remainder)
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        logger.info('Compacted %s; %s bytes remain', self.path, len(remainder))
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Structured metrics of update cycles. A CycleMetrics instance is active while
+TodoList.update runs; schedd calls, state transitions and resubmissions are
+recorded into it from wherever they happen (the record_* functions do nothing if
+no cycle is active). At the end of the cycle the phase times and history cache
+counters are added, and the metrics are written as a Prometheus textfile (for the
+node exporter textfile collector) and appended as a line to a json lines file.
+"""
+import cjm
+import os.path as osp
+import logging, os, time, json, threading
+from collections import OrderedDict
+logger = logging.getLogger('cjm')
+
+# Upper bounds (seconds) of the schedd call latency histogram buckets
+LATENCY_BUCKETS = [ .01, .05, .1, .5, 1., 5., 10., 30., 60., 120. ]
+
+# Number of ads of which the size is measured to estimate the bytes received
+N_SAMPLE_ADS = 50
+
+_current = None
+
+
+class ScheddCallMetrics(object):
+    """
+    Counts, received ads and bytes, and a latency histogram of one kind of call
+    (e.g. xquery or history) to one schedd
+    """
+
+    def __init__(self):
+        super(ScheddCallMetrics, self).__init__()
+        self.count = 0
+        self.failures = 0
+        self.ads = 0
+        self.bytes = 0
+        self.latency_sum = 0.
+        self.latency_max = 0.
+        # Non-cumulative counts per bucket; the last one is for latencies above all bounds
+        self.bucket_counts = [ 0 for i in range(len(LATENCY_BUCKETS) + 1) ]
+
+    def add(self, duration, ads=0, nbytes=0):
+        self.count += 1
+        self.ads += ads
+        self.bytes += nbytes
+        self.latency_sum += duration
+        self.latency_max = max(self.latency_max, duration)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if duration <= bound: break
+        else:
+            i = len(LATENCY_BUCKETS)
+        self.bucket_counts[i] += 1
+
+    def cumulative_buckets(self):
+        """
+        Returns (upper bound, cumulative count) pairs as Prometheus histograms use them
+        """
+        counts = []
+        total = 0
+        for bound, count in zip(LATENCY_BUCKETS + [ float('inf') ], self.bucket_counts):
+            total += count
+            counts.append((bound, total))
+        return counts
+
+    def to_dict(self):
+        return OrderedDict([
+            ('count', self.count),
+            ('failures', self.failures),
+            ('ads', self.ads),
+            ('bytes', self.bytes),
+            ('latency_sum', self.latency_sum),
+            ('latency_max', self.latency_max),
+            ('latency_buckets', [ [ 'inf' if b == float('inf') else b, c ] for b, c in self.cumulative_buckets() ]),
+            ])
+
+
+class CycleMetrics(object):
+    """
+    Metrics of a single update cycle
+    """
+
+    def __init__(self):
+        super(CycleMetrics, self).__init__()
+        self.start_time = time.time()
+        self.duration = None
+        self.clusters = 0
+        self.clusters_skipped = 0
+        self.jobs = 0
+        # (call, schedd name) to ScheddCallMetrics
+        self.schedd_calls = OrderedDict()
+        # (from state, to state) to count
+        self.transitions = OrderedDict()
+        self.resubmissions = 0
+        self.phase_times = OrderedDict()
+        self.history_cache = {}
+        self._history_counters_at_start = cjm.todo.HTCondorClusterHistory.stats()
+        self._lock = threading.Lock()
+
+    def get_schedd_call(self, call, schedd_name):
+        key = (call, schedd_name)
+        if not key in self.schedd_calls: self.schedd_calls[key] = ScheddCallMetrics()
+        return self.schedd_calls[key]
+
+    def finish(self, profiler=None):
+        """
+        Adds the phase times of `profiler` and the history cache counters of this cycle
+        """
+        self.duration = time.time() - self.start_time
+        if not profiler is None: self.phase_times.update(profiler.times)
+        stats = cjm.todo.HTCondorClusterHistory.stats()
+        hits = stats['hits'] - self._history_counters_at_start['hits']
+        misses = stats['misses'] - self._history_counters_at_start['misses']
+        # The counters are reset when the cache is cleared during the cycle
+        if hits < 0 or misses < 0: hits, misses = stats['hits'], stats['misses']
+        self.history_cache = OrderedDict([
+            ('hits', hits),
+            ('misses', misses),
+            ('hit_rate', float(hits) / (hits + misses) if hits + misses > 0 else None),
+            ('clusters', stats['clusters']),
+            ('jobs', stats['jobs']),
+            ])
+
+    def to_dict(self):
+        return OrderedDict([
+            ('time', self.start_time),
+            ('duration', self.duration),
+            ('clusters', self.clusters),
+            ('clusters_skipped', self.clusters_skipped),
+            ('jobs', self.jobs),
+            ('phases', self.phase_times),
+            ('schedd_calls', [
+                OrderedDict([ ('call', call), ('schedd', schedd_name) ] + list(m.to_dict().items()))
+                for (call, schedd_name), m in self.schedd_calls.items()
+                ]),
+            ('history_cache', self.history_cache),
+            ('transitions', OrderedDict(
+                ('{0}->{1}'.format(*key), n) for key, n in self.transitions.items()
+                )),
+            ('resubmissions', self.resubmissions),
+            ])
+
+    def prometheus_text(self):
+        """
+        Returns the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        def metric(name, help, type, samples):
+            lines.append('# HELP {0} {1}'.format(name, help))
+            lines.append('# TYPE {0} {1}'.format(name, type))
+            for suffix, labels, value in samples:
+                label_text = ','.join('{0}="{1}"'.format(k, escape_label(v)) for k, v in labels)
+                lines.append('{0}{1}{2} {3}'.format(
+                    name, suffix, '{' + label_text + '}' if label_text else '', format_value(value)
+                    ))
+
+        metric('cjm_cycle_timestamp_seconds', 'Start time of the last update cycle', 'gauge',
+            [ ('', [], self.start_time) ])
+        metric('cjm_cycle_duration_seconds', 'Duration of the last update cycle', 'gauge',
+            [ ('', [], self.duration or 0.) ])
+        metric('cjm_phase_duration_seconds', 'Time spent per phase of the last update cycle', 'gauge',
+            [ ('', [ ('phase', phase) ], t) for phase, t in self.phase_times.items() ])
+        metric('cjm_clusters', 'Clusters processed in the last update cycle', 'gauge',
+            [ ('', [], self.clusters) ])
+        metric('cjm_clusters_skipped', 'Clusters not due for polling in the last update cycle', 'gauge',
+            [ ('', [], self.clusters_skipped) ])
+        metric('cjm_jobs', 'Jobs in the clusters processed in the last update cycle', 'gauge',
+            [ ('', [], self.jobs) ])
+        calls = [ ([ ('call', call), ('schedd', name) ], m) for (call, name), m in self.schedd_calls.items() ]
+        metric('cjm_schedd_calls', 'Calls to schedds in the last update cycle', 'gauge',
+            [ ('', labels, m.count + m.failures) for labels, m in calls ])
+        metric('cjm_schedd_call_failures', 'Failed or timed out calls to schedds in the last update cycle', 'gauge',
+            [ ('', labels, m.failures) for labels, m in calls ])
+        metric('cjm_schedd_ads_received', 'Classads received from schedds in the last update cycle', 'gauge',
+            [ ('', labels, m.ads) for labels, m in calls ])
+        metric('cjm_schedd_bytes_received', 'Estimated bytes of classads received from schedds in the last update cycle', 'gauge',
+            [ ('', labels, m.bytes) for labels, m in calls ])
+        samples = []
+        for labels, m in calls:
+            for bound, count in m.cumulative_buckets():
+                samples.append(('_bucket', labels + [ ('le', bound) ], count))
+            samples.append(('_sum', labels, m.latency_sum))
+            samples.append(('_count', labels, m.count))
+        metric('cjm_schedd_call_duration_seconds', 'Latency of successful schedd calls in the last update cycle', 'histogram',
+            samples)
+        metric('cjm_history_cache_hits', 'History cache hits in the last update cycle', 'gauge',
+            [ ('', [], self.history_cache.get('hits', 0)) ])
+        metric('cjm_history_cache_misses', 'History cache misses in the last update cycle', 'gauge',
+            [ ('', [], self.history_cache.get('misses', 0)) ])
+        metric('cjm_transitions', 'Job state transitions in the last update cycle', 'gauge',
+            [ ('', [ ('from', f), ('to', t) ], n) for (f, t), n in self.transitions.items() ])
+        metric('cjm_resubmissions', 'Jobs resubmitted in the last update cycle', 'gauge',
+            [ ('', [], self.resubmissions) ])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, prom_file=None, jsonl_file=None, max_jsonl_bytes=10*1024*1024):
+        """
+        Writes the Prometheus textfile (atomically, since the node exporter may read
+        it at any time), and appends a line to the json lines file, which is rotated
+        to `jsonl_file`.1 when it grows beyond `max_jsonl_bytes`
+        """
+        if prom_file:
+            cjm.storage.atomic_write(prom_file, self.prometheus_text())
+        if jsonl_file:
+            if osp.isfile(jsonl_file) and os.stat(jsonl_file).st_size > max_jsonl_bytes:
+                os.rename(jsonl_file, jsonl_file + '.1')
+            with open(jsonl_file, 'a') as f:
+                f.write(json.dumps(self.to_dict()) + '\n')
+        logger.debug('Wrote metrics to %s and %s', prom_file, jsonl_file)
+
+
+def escape_label(value):
+    if value == float('inf'): return '+Inf'
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_value(value):
+    if value is None: return 'NaN'
+    if value == float('inf'): return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+def estimate_bytes(ads):
+    """
+    Estimates the bytes received for `ads` from the text size of a sample of them
+    """
+    if not isinstance(ads, list) or len(ads) == 0: return 0
+    sample = ads[:N_SAMPLE_ADS]
+    sample_bytes = sum(len(str(ad)) for ad in sample)
+    return int(sample_bytes * float(len(ads)) / len(sample))
+
+
+# ____________________________________________________
+# Recording; all no-ops if no cycle is active
+
+def start_cycle():
+    """
+    Starts recording the metrics of a new cycle, and returns its CycleMetrics
+    """
+    global _current
+    _current = CycleMetrics()
+    return _current
+
+def finish_cycle(profiler=None, config=None):
+    """
+    Finishes the active cycle and writes its metrics to the files in the config.
+    Returns the CycleMetrics, or None if no cycle was active.
+    """
+    global _current
+    metrics = _current
+    _current = None
+    if metrics is None: return None
+    config = cjm.CONFIG if config is None else config
+    metrics.finish(profiler)
+    try:
+        metrics.write(config.metrics_prom_file, config.metrics_jsonl_file)
+    except (IOError, OSError) as e:
+        logger.error('Could not write metrics: %s', e)
+    return metrics
+
+def get_current():
+    return _current
+
+def record_schedd_call(call, schedd_name, duration, result=None):
+    metrics = _current
+    if metrics is None: return
+    with metrics._lock:
+        metrics.get_schedd_call(call, schedd_name).add(
+            duration,
+            ads = len(result) if isinstance(result, list) else 0,
+            nbytes = estimate_bytes(result),
+            )
+
+def record_schedd_failure(call, schedd_name):
+    metrics = _current
+    if metrics is None: return
+    with metrics._lock:
+        metrics.get_schedd_call(call, schedd_name).failures += 1
+
+def record_transition(from_state, to_state):
+    metrics = _current
+    if metrics is None: return
+    key = (str(from_state), str(to_state))
+    with metrics._lock:
+        metrics.transitions[key] = metrics.transitions.get(key, 0) + 1
+
+def record_resubmission():
+    metrics = _current
+    if metrics is None: return
+    with metrics._lock:
+        metrics.resubmissions += 1
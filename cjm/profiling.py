@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import cjm
+import os.path as osp
+import logging, os, sys, time, io
+from collections import OrderedDict
+from contextlib import contextmanager
+from time import strftime
+logger = logging.getLogger('cjm')
+
+
+class Profiler(object):
+    """
+    Records the wall time of each phase of a cycle (e.g. read, query, history,
+    process, email, write), and optionally cProfile stats and the top tracemalloc
+    allocations per phase. Timing is always on and cheap; profiling and memory
+    tracing are only done when requested.
+
+    :param profile: Record cProfile stats per phase
+    :type profile: bool
+    :param trace_memory: Record the top allocations per phase with tracemalloc
+    :type trace_memory: bool
+    :param name: Prefix for the output files
+    :type name: str
+    :param output_dir: Directory for the output files; defaults to CJM_DIR/profiles
+    :type output_dir: str, optional
+    """
+
+    # Number of entries to report per phase
+    n_top = 25
+
+    def __init__(self, profile=False, trace_memory=False, name='update', output_dir=None):
+        super(Profiler, self).__init__()
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.name = name
+        self.output_dir = osp.join(cjm.CJM_DIR, 'profiles') if output_dir is None else output_dir
+        self.start_time = time.time()
+        self.timestamp = strftime('%Y%m%d_%H%M%S')
+        self.times = OrderedDict()
+        self.profiles = OrderedDict()
+        self.allocations = OrderedDict()
+        self.allocated = OrderedDict()
+        self.peak_memory = OrderedDict()
+        # Growth of the peak resident set size of the process during each phase, in
+        # bytes; zero if the phase stayed below the peak reached earlier
+        self.rss_growth = OrderedDict()
+        self._started_tracemalloc = False
+        if self.trace_memory:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracemalloc = True
+
+    @property
+    def enabled(self):
+        return self.profile or self.trace_memory
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Context manager around one phase. Phases with the same name accumulate.
+        """
+        if self.profile:
+            import cProfile
+            if not name in self.profiles: self.profiles[name] = cProfile.Profile()
+            profile = self.profiles[name]
+        if self.trace_memory:
+            import tracemalloc
+            if hasattr(tracemalloc, 'reset_peak'): tracemalloc.reset_peak()
+            snapshot_before = tracemalloc.take_snapshot()
+        max_rss_before = get_max_rss()
+        t0 = time.time()
+        if self.profile: profile.enable()
+        try:
+            yield
+        finally:
+            if self.profile: profile.disable()
+            self.times[name] = self.times.get(name, 0.) + time.time() - t0
+            if not max_rss_before is None:
+                self.rss_growth[name] = self.rss_growth.get(name, 0) + get_max_rss() - max_rss_before
+            if self.trace_memory:
+                self.peak_memory[name] = max(self.peak_memory.get(name, 0), tracemalloc.get_traced_memory()[1])
+                allocations = tracemalloc.take_snapshot().compare_to(snapshot_before, 'lineno')
+                # Net bytes allocated (and not freed) during the phase
+                self.allocated[name] = self.allocated.get(name, 0) + sum(stat.size_diff for stat in allocations)
+                self.allocations[name] = allocations[:self.n_top]
+
+    def total_time(self):
+        return time.time() - self.start_time
+
+    def summary(self):
+        """
+        Returns a one-line summary of the phase times
+        """
+        return ', '.join('{0} {1:.2f}s'.format(name, t) for name, t in self.times.items())
+
+    def report(self):
+        """
+        Returns the full text report: phase times, and the profile stats and top
+        allocations per phase if they were recorded
+        """
+        lines = [ '{0} cycle of {1:.2f} s started at {2}'.format(self.name, self.total_time(), self.timestamp), '' ]
+        for name, t in self.times.items():
+            line = '{0:<12} {1:>9.3f} s'.format(name, t)
+            if name in self.peak_memory:
+                line += '  peak traced memory {0:.1f} MB'.format(self.peak_memory[name] / 1e6)
+            lines.append(line)
+        for name, profile in self.profiles.items():
+            import pstats
+            stream = io.StringIO()
+            pstats.Stats(profile, stream=stream).sort_stats('cumulative').print_stats(self.n_top)
+            lines.extend([ '', '=== cProfile: {0} ==='.format(name), stream.getvalue() ])
+        for name, allocations in self.allocations.items():
+            lines.extend([ '', '=== Top allocations: {0} ==='.format(name) ])
+            lines.extend(str(stat) for stat in allocations)
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """
+        Writes the report, and the raw cProfile stats per phase (loadable with
+        pstats), to timestamped files in the output dir. Returns the report path.
+        """
+        if not osp.isdir(self.output_dir):
+            logger.info('Creating directory %s', self.output_dir)
+            os.makedirs(self.output_dir)
+        prefix = osp.join(self.output_dir, '{0}_{1}'.format(self.name, self.timestamp))
+        for name, profile in self.profiles.items():
+            profile.dump_stats('{0}_{1}.prof'.format(prefix, name.replace(' ', '_')))
+        report_file = prefix + '.txt'
+        with open(report_file, 'w') as f:
+            f.write(self.report())
+        logger.info('Wrote profile of %s cycle to %s', self.name, report_file)
+        return report_file
+
+    def stop(self):
+        """
+        Stops tracemalloc if this profiler started it
+        """
+        if self._started_tracemalloc:
+            import tracemalloc
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+
+def get_max_rss():
+    """
+    Returns the peak resident set size of this process in bytes, or None if it
+    can not be determined on this platform
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return max_rss if sys.platform == 'darwin' else 1024 * max_rss
+
+def get_profile_flag_file():
+    return osp.join(cjm.CJM_DIR, 'profile_next_cycle')
+
+def request_profile():
+    """
+    Marks the next update cycle (possibly in another process) to be profiled
+    """
+    with open(get_profile_flag_file(), 'a'):
+        pass
+
+def pop_profile_request():
+    """
+    Returns True if profiling of this cycle was requested, and clears the request
+    """
+    try:
+        os.remove(get_profile_flag_file())
+        return True
+    except OSError:
+        return False
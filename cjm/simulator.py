@@ -0,0 +1,555 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Pure-python stand-in for htcondor schedds, to test and load-test cjm offline.
+
+A SimulatedSchedd holds a population of jobs that move through idle, running,
+held and completed over simulated time (a SimulatedClock shared between
+schedds), and implements the parts of the htcondor.Schedd api that cjm uses:
+xquery, history, edit and act. Constraints are evaluated with a small ClassAd
+expression evaluator. Per-call latency, timeouts and exceptions can be injected.
+
+Typical use::
+
+    clock = cjm.simulator.SimulatedClock()
+    schedds = [ cjm.simulator.SimulatedSchedd('schedd{0}'.format(i), clock) for i in range(3) ]
+    cjm.CONFIG.set_schedds(schedds)
+    cluster_id = schedds[0].submit(100)
+    clock.advance(3600)
+"""
+import cjm
+import logging, re, time, random, heapq, threading
+logger = logging.getLogger('cjm')
+
+IDLE = 1
+RUNNING = 2
+REMOVED = 3
+COMPLETED = 4
+HELD = 5
+
+
+class SimulatedScheddError(RuntimeError):
+    """
+    Raised by a SimulatedSchedd for injected failures (like htcondor raises
+    RuntimeError or IOError when a schedd can not be reached)
+    """
+    pass
+
+
+class SimulatedClock(object):
+    """
+    Simulated time, shared by all schedds of a simulation. Schedds process the
+    transitions of their jobs whenever they are queried.
+    """
+
+    def __init__(self, start=1.6e9):
+        super(SimulatedClock, self).__init__()
+        self.now = float(start)
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+        return self.now
+
+
+# ____________________________________________________
+# Minimal ClassAd expression evaluator
+
+CONSTRAINT_TOKEN = re.compile(r'''
+    \s*(?:
+    (?P<number>\d+\.\d*|\.\d+|\d+)
+    |(?P<string>"(?:[^"\\]|\\.)*")
+    |(?P<op>=\?=|=!=|==|!=|<=|>=|&&|\|\||[<>!()])
+    |(?P<name>[A-Za-z_][A-Za-z0-9_.]*)
+    )''', re.VERBOSE)
+
+# Binary operators by precedence, lowest first
+BINARY_OPERATORS = [
+    [ '||' ],
+    [ '&&' ],
+    [ '==', '!=', '=?=', '=!=' ],
+    [ '<', '<=', '>', '>=' ],
+    ]
+
+class Undefined(object):
+    """
+    The ClassAd UNDEFINED value
+    """
+    def __repr__(self):
+        return 'undefined'
+UNDEFINED = Undefined()
+
+def tokenize(text):
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        match = CONSTRAINT_TOKEN.match(text, pos)
+        if match is None or match.end() == pos:
+            raise ValueError('Can not parse constraint {0!r} at position {1}'.format(text, pos))
+        pos = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'number':
+            value = float(value) if '.' in value else int(value)
+        elif kind == 'string':
+            value = value[1:-1].replace('\\"', '"')
+        elif kind == 'name' and value.lower() in ['true', 'false', 'undefined']:
+            kind, value = 'literal', { 'true' : True, 'false' : False, 'undefined' : UNDEFINED }[value.lower()]
+        tokens.append((kind, value))
+    return tokens
+
+def compare(op, left, right):
+    if op == '=?=':
+        return type(left) == type(right) and left == right if not isinstance(left, str) else (
+            isinstance(right, str) and left.lower() == right.lower()
+            )
+    if op == '=!=': return not compare('=?=', left, right)
+    if left is UNDEFINED or right is UNDEFINED: return UNDEFINED
+    if isinstance(left, str) and isinstance(right, str):
+        # String comparisons are case-insensitive in ClassAds
+        left, right = left.lower(), right.lower()
+    elif isinstance(left, str) or isinstance(right, str):
+        return False if op == '==' else True if op == '!=' else UNDEFINED
+    if op == '==': return left == right
+    if op == '!=': return left != right
+    if op == '<': return left < right
+    if op == '<=': return left <= right
+    if op == '>': return left > right
+    if op == '>=': return left >= right
+
+def logical_and(left, right):
+    if left is False or right is False: return False
+    if left is UNDEFINED or right is UNDEFINED: return UNDEFINED
+    return bool(left) and bool(right)
+
+def logical_or(left, right):
+    if left is True or right is True: return True
+    if left is UNDEFINED or right is UNDEFINED: return UNDEFINED
+    return bool(left) or bool(right)
+
+
+class Constraint(object):
+    """
+    A parsed ClassAd constraint expression, supporting attribute references,
+    int/real/string/boolean/undefined literals, parentheses, !, comparisons
+    (==, !=, <, <=, >, >=, =?=, =!=), && and ||. Attribute names are
+    case-insensitive, as in ClassAds.
+
+    >>> Constraint('Owner=="me" && (ClusterId==1 || ClusterId==2)').evaluate({ 'Owner' : 'me', 'ClusterId' : 2 })
+    True
+    """
+
+    _cache = {}
+    _cache_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, text):
+        """
+        Returns a (cached) Constraint for `text`
+        """
+        with cls._cache_lock:
+            if not text in cls._cache:
+                if len(cls._cache) > 1000: cls._cache.clear()
+                cls._cache[text] = cls(text)
+            return cls._cache[text]
+
+    def __init__(self, text):
+        super(Constraint, self).__init__()
+        self.text = text
+        self.tokens = tokenize(text)
+        self.pos = 0
+        self.tree = self.parse_binary(0) if self.tokens else ('literal', True)
+        if self.pos != len(self.tokens):
+            raise ValueError('Unexpected token {0!r} in constraint {1!r}'.format(self.tokens[self.pos][1], text))
+        del self.tokens
+
+    def __repr__(self):
+        return '<Constraint {0!r}>'.format(self.text)
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def parse_binary(self, level):
+        if level == len(BINARY_OPERATORS): return self.parse_unary()
+        left = self.parse_binary(level + 1)
+        while True:
+            kind, value = self.peek()
+            if kind != 'op' or not value in BINARY_OPERATORS[level]: return left
+            self.pos += 1
+            left = ('binary', value, left, self.parse_binary(level + 1))
+
+    def parse_unary(self):
+        kind, value = self.peek()
+        if kind == 'op' and value == '!':
+            self.pos += 1
+            return ('not', self.parse_unary())
+        if kind == 'op' and value == '(':
+            self.pos += 1
+            tree = self.parse_binary(0)
+            if self.peek() != ('op', ')'):
+                raise ValueError('Missing closing parenthesis in constraint {0!r}'.format(self.text))
+            self.pos += 1
+            return tree
+        if kind is None or kind == 'op':
+            raise ValueError('Unexpected {0!r} in constraint {1!r}'.format(value, self.text))
+        self.pos += 1
+        if kind == 'name': return ('attribute', value.lower())
+        return ('literal', value)
+
+    def evaluate(self, ad):
+        """
+        Evaluates the constraint against a dict-like ad. Returns True, False or UNDEFINED.
+        """
+        lower_ad = { key.lower() : value for key, value in ad.items() }
+        return self._evaluate(self.tree, lower_ad)
+
+    def matches(self, ad):
+        return self.evaluate(ad) is True
+
+    def _evaluate(self, tree, ad):
+        kind = tree[0]
+        if kind == 'literal': return tree[1]
+        if kind == 'attribute': return ad.get(tree[1], UNDEFINED)
+        if kind == 'not':
+            value = self._evaluate(tree[1], ad)
+            return value if value is UNDEFINED else not value
+        op, left, right = tree[1], self._evaluate(tree[2], ad), self._evaluate(tree[3], ad)
+        if op == '&&': return logical_and(left, right)
+        if op == '||': return logical_or(left, right)
+        return compare(op, left, right)
+
+
+# ____________________________________________________
+# Simulated jobs and schedds
+
+class SimulatedClassAd(dict):
+    """
+    Classad returned by a SimulatedSchedd; like the real ones, helper attributes
+    can be set on it
+    """
+    pass
+
+
+class SimulatedJob(object):
+    """
+    A job in a SimulatedSchedd. The times at which it starts and finishes are drawn
+    when it becomes idle.
+    """
+
+    def __init__(self, cluster_id, proc_id, owner, now, request_memory=2048, memory_usage=1000, exit_code=0):
+        super(SimulatedJob, self).__init__()
+        self.cluster_id = cluster_id
+        self.proc_id = proc_id
+        self.owner = owner
+        self.status = IDLE
+        self.last_status = None
+        self.entered_current_status = now
+        self.qdate = now
+        self.request_memory = request_memory
+        self.memory_usage = memory_usage
+        self.exit_code = exit_code
+        self.hold_reason_code = None
+        self.completion_date = None
+        # Time and kind of the next scheduled transition; version invalidates
+        # transitions that were scheduled before a state change by edit/act
+        self.version = 0
+
+    def spec(self):
+        return '{0}.{1}'.format(self.cluster_id, self.proc_id)
+
+    def set_status(self, status, now):
+        self.last_status = self.status
+        self.status = status
+        self.entered_current_status = now
+        self.version += 1
+
+    def classad(self, now):
+        ad = SimulatedClassAd(
+            ClusterId = self.cluster_id,
+            ProcId = self.proc_id,
+            Owner = self.owner,
+            JobStatus = self.status,
+            LastJobStatus = self.last_status if not self.last_status is None else 0,
+            EnteredCurrentStatus = int(self.entered_current_status),
+            QDate = int(self.qdate),
+            ServerTime = int(now),
+            RequestMemory = self.request_memory,
+            MemoryUsage = self.memory_usage if self.status != IDLE else 0,
+            Err = 'job_{0}_{1}.stderr'.format(self.cluster_id, self.proc_id),
+            Out = 'job_{0}_{1}.stdout'.format(self.cluster_id, self.proc_id),
+            )
+        if self.status == HELD:
+            ad['HoldReasonCode'] = self.hold_reason_code
+            ad['HoldReasonSubCode'] = 0
+            ad['HoldReason'] = 'Job exceeded its memory request ({0} > {1} MB)'.format(
+                self.memory_usage, self.request_memory
+                )
+        if self.status == COMPLETED:
+            ad['ExitCode'] = self.exit_code
+            ad['ExitBySignal'] = False
+            ad['CompletionDate'] = int(self.completion_date)
+        return ad
+
+
+class SimulatedSchedd(object):
+    """
+    Simulated htcondor schedd with a population of jobs.
+
+    Submitted jobs wait an exponentially distributed time (mean `mean_idle_time`)
+    before running, and run for an exponentially distributed time (mean
+    `mean_run_time`). A job whose MemoryUsage exceeds its RequestMemory is held
+    with HoldReasonCode 34 when it would finish; otherwise it completes with its
+    exit code and moves to the history. Released jobs become idle again; removed
+    jobs move to the history with JobStatus 3.
+
+    :param name: Name of the schedd
+    :type name: str
+    :param clock: Clock shared by the simulation (a new one if None)
+    :type clock: SimulatedClock, optional
+    :param latency: Seconds (real time) each call takes
+    :type latency: float
+    :param latency_jitter: Random extra seconds (uniform) per call
+    :type latency_jitter: float
+    :param error_rate: Probability that a call raises a SimulatedScheddError
+    :type error_rate: float
+    :param timeout_rate: Probability that a call hangs for `timeout_duration` seconds
+        (real time) before raising a SimulatedScheddError
+    :type timeout_rate: float
+    :param seed: Seed for the random draws of this schedd
+    :type seed: int, optional
+    """
+
+    def __init__(
+            self, name, clock=None, latency=0., latency_jitter=0., error_rate=0.,
+            timeout_rate=0., timeout_duration=120., mean_idle_time=600.,
+            mean_run_time=3600., seed=None, owner=None
+            ):
+        super(SimulatedSchedd, self).__init__()
+        self.name = name
+        self.clock = SimulatedClock() if clock is None else clock
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.timeout_duration = timeout_duration
+        self.mean_idle_time = mean_idle_time
+        self.mean_run_time = mean_run_time
+        self.owner = cjm.CONFIG.user if owner is None else owner
+        self.random = random.Random(seed)
+        self.jobs = {}
+        self.history_ads = []
+        self._transitions = []
+        self._next_cluster_id = 1
+        self._lock = threading.RLock()
+        # Number of calls per method, for tests and load tests
+        self.calls = { 'xquery' : 0, 'history' : 0, 'edit' : 0, 'act' : 0 }
+
+    def __repr__(self):
+        return '<SimulatedSchedd {0}>'.format(self.name)
+
+    # ____________________________________________________
+    # Simulation
+
+    def submit(self, n_jobs, cluster_id=None, request_memory=2048, memory_usage=1000, exit_codes=None):
+        """
+        Submits a cluster of `n_jobs` jobs. `memory_usage` and `exit_codes` can be
+        single values or per-job lists. Returns the cluster_id.
+        """
+        with self._lock:
+            if cluster_id is None: cluster_id = self._next_cluster_id
+            self._next_cluster_id = max(self._next_cluster_id, cluster_id) + 1
+            now = self.clock.time()
+            for proc_id in range(n_jobs):
+                job = SimulatedJob(
+                    cluster_id, proc_id, self.owner, now,
+                    request_memory = request_memory,
+                    memory_usage = memory_usage[proc_id] if isinstance(memory_usage, list) else memory_usage,
+                    exit_code = 0 if exit_codes is None else exit_codes[proc_id] if isinstance(exit_codes, list) else exit_codes,
+                    )
+                self.jobs[(cluster_id, proc_id)] = job
+                self.schedule(job, now + self.random.expovariate(1. / self.mean_idle_time))
+        logger.debug('%s: submitted cluster %s with %s jobs', self, cluster_id, n_jobs)
+        return cluster_id
+
+    def schedule(self, job, at):
+        heapq.heappush(self._transitions, (at, job.cluster_id, job.proc_id, job.version))
+
+    def step(self):
+        """
+        Processes all job transitions up to the current simulated time
+        """
+        now = self.clock.time()
+        with self._lock:
+            while self._transitions and self._transitions[0][0] <= now:
+                at, cluster_id, proc_id, version = heapq.heappop(self._transitions)
+                job = self.jobs.get((cluster_id, proc_id), None)
+                if job is None or job.version != version: continue
+                if job.status == IDLE:
+                    job.set_status(RUNNING, at)
+                    self.schedule(job, at + self.random.expovariate(1. / self.mean_run_time))
+                elif job.status == RUNNING:
+                    if job.memory_usage > job.request_memory:
+                        job.hold_reason_code = 34
+                        job.set_status(HELD, at)
+                    else:
+                        job.completion_date = at
+                        job.set_status(COMPLETED, at)
+                        self.leave_queue(job, now)
+
+    def leave_queue(self, job, now):
+        del self.jobs[(job.cluster_id, job.proc_id)]
+        self.history_ads.append(job.classad(now))
+
+    def count(self, status=None):
+        """
+        Returns the number of jobs in the queue, optionally only those in `status`
+        """
+        self.step()
+        with self._lock:
+            return sum(1 for job in self.jobs.values() if status is None or job.status == status)
+
+    # ____________________________________________________
+    # Fault injection
+
+    def inject(self, method):
+        """
+        Called at the start of every api call: counts it, sleeps for the latency,
+        and raises the injected failures
+        """
+        self.calls[method] += 1
+        latency = self.latency + (self.random.uniform(0., self.latency_jitter) if self.latency_jitter else 0.)
+        if latency > 0.: time.sleep(latency)
+        if self.timeout_rate and self.random.random() < self.timeout_rate:
+            time.sleep(self.timeout_duration)
+            raise SimulatedScheddError('{0}: {1} timed out'.format(self, method))
+        if self.error_rate and self.random.random() < self.error_rate:
+            raise SimulatedScheddError('{0}: failed to connect for {1}'.format(self, method))
+
+    # ____________________________________________________
+    # htcondor.Schedd api
+
+    @staticmethod
+    def project(ad, projection):
+        if not projection: return ad
+        projected = SimulatedClassAd()
+        for key in projection:
+            if key in ad: projected[key] = ad[key]
+        return projected
+
+    def xquery(self, requirements='true', projection=None, limit=-1, constraint=None):
+        """
+        Returns the (projected) classads of the jobs in the queue matching the constraint
+        """
+        self.inject('xquery')
+        self.step()
+        constraint = Constraint.get(constraint or requirements or 'true')
+        now = self.clock.time()
+        with self._lock:
+            ads = [ job.classad(now) for job in self.jobs.values() ]
+        ads = [ self.project(ad, projection) for ad in ads if constraint.matches(ad) ]
+        return ads if limit is None or limit < 0 else ads[:limit]
+
+    def history(self, requirements='true', projection=None, match=-1, constraint=None):
+        """
+        Returns the (projected) classads of the jobs that left the queue, newest first
+        """
+        self.inject('history')
+        self.step()
+        constraint = Constraint.get(constraint or requirements or 'true')
+        with self._lock:
+            ads = [ ad for ad in reversed(self.history_ads) if constraint.matches(ad) ]
+        ads = [ self.project(ad, projection) for ad in ads ]
+        return ads if match is None or match < 0 else ads[:match]
+
+    def select_jobs(self, job_spec):
+        """
+        Returns the jobs selected by a job id ('cluster.proc' or 'cluster'), a list
+        of job ids, or a constraint
+        """
+        now = self.clock.time()
+        if isinstance(job_spec, (list, tuple)):
+            specs = [ str(s) for s in job_spec ]
+        elif re.match(r'^\s*\d+(\.\d+)?\s*$', str(job_spec)):
+            specs = [ str(job_spec).strip() ]
+        else:
+            constraint = Constraint.get(job_spec)
+            return [ job for job in self.jobs.values() if constraint.matches(job.classad(now)) ]
+        jobs = []
+        for spec in specs:
+            if '.' in spec:
+                cluster_id, proc_id = spec.split('.')
+                job = self.jobs.get((int(cluster_id), int(proc_id)), None)
+                if job: jobs.append(job)
+            else:
+                jobs.extend(job for job in self.jobs.values() if job.cluster_id == int(spec))
+        return jobs
+
+    def edit(self, job_spec, attr, value):
+        """
+        Sets an attribute of the selected jobs; only RequestMemory affects the simulation
+        """
+        self.inject('edit')
+        self.step()
+        with self._lock:
+            jobs = self.select_jobs(job_spec)
+            for job in jobs:
+                if attr.lower() == 'requestmemory': job.request_memory = int(value)
+        logger.debug('%s: set %s = %s for %s jobs', self, attr, value, len(jobs))
+        return len(jobs)
+
+    def act(self, action, job_spec):
+        """
+        Releases, holds or removes the selected jobs. `action` may be an
+        htcondor.JobAction or the name of the action. Like htcondor, returns the
+        number of jobs per outcome (TotalSuccess, TotalNotFound, TotalBadStatus).
+        """
+        self.inject('act')
+        self.step()
+        match = re.search(r'(Release|Remove|Hold)', str(getattr(action, 'name', action)))
+        if match is None:
+            raise ValueError('{0}: action {1} is not simulated'.format(self, action))
+        action = match.group(1)
+        now = self.clock.time()
+        n_changed = 0
+        with self._lock:
+            jobs = self.select_jobs(job_spec)
+            n_not_found = self.count_not_found(job_spec)
+            for job in jobs:
+                if action == 'Release' and job.status == HELD:
+                    job.hold_reason_code = None
+                    job.set_status(IDLE, now)
+                    self.schedule(job, now + self.random.expovariate(1. / self.mean_idle_time))
+                elif action == 'Hold' and job.status in [ IDLE, RUNNING ]:
+                    job.hold_reason_code = 1
+                    job.set_status(HELD, now)
+                elif action == 'Remove':
+                    job.set_status(REMOVED, now)
+                    self.leave_queue(job, now)
+                else:
+                    continue
+                n_changed += 1
+        logger.debug('%s: %s %s jobs', self, action, n_changed)
+        return {
+            'TotalSuccess' : n_changed,
+            'TotalNotFound' : n_not_found,
+            'TotalBadStatus' : len(jobs) - n_changed,
+            }
+
+    def count_not_found(self, job_spec):
+        """
+        Returns the number of job ids in `job_spec` that are not in the queue; a
+        constraint only selects existing jobs, so nothing counts as not found then
+        """
+        if isinstance(job_spec, (list, tuple)):
+            specs = [ str(s) for s in job_spec ]
+        elif re.match(r'^\s*\d+\.\d+\s*$', str(job_spec)):
+            specs = [ str(job_spec).strip() ]
+        else:
+            return 0
+        return sum(
+            1 for spec in specs
+            if '.' in spec and not tuple(int(i) for i in spec.split('.')) in self.jobs
+            )
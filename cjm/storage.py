@@ -0,0 +1,393 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import cjm
+import os.path as osp
+import logging, os, configparser, tempfile, glob, sqlite3, json
+from io import StringIO
+logger = logging.getLogger('cjm')
+
+def atomic_write(path, text):
+    """
+    Writes `text` to `path` via a temporary file in the same directory and a rename,
+    so that readers only ever see either the old or the new complete file.
+    """
+    dirname = osp.dirname(osp.abspath(path))
+    if not osp.isdir(dirname):
+        logger.info('Creating directory %s', dirname)
+        os.makedirs(dirname)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.' + osp.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, path) # Atomic on POSIX
+    except Exception:
+        if osp.exists(tmp_path): os.remove(tmp_path)
+        raise
+
+def section_to_text(title, section):
+    """
+    Serializes a single todo section the way configparser writes it
+    """
+    config = configparser.ConfigParser()
+    config[title] = dict(section)
+    text = StringIO()
+    config.write(text)
+    return text.getvalue()
+
+def file_signature(path):
+    """
+    Returns (mtime, size) of a file, or None if it does not exist
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size)
+
+def config_to_text(config):
+    text = StringIO()
+    config.write(text)
+    return text.getvalue()
+
+def get_storage(todofile, config=None):
+    """
+    Returns the storage backend for `todofile` as set by `todo_storage` in the config
+    """
+    config = cjm.CONFIG if config is None else config
+    kind = config.todo_storage
+    if kind == 'ini':
+        return INIFileStorage(todofile)
+    elif kind == 'sharded':
+        return ShardedStorage(todofile + '.d')
+    elif kind == 'sqlite':
+        storage = SQLiteStorage(todofile + '.sqlite')
+        if not storage.is_initialized() and osp.isfile(todofile):
+            storage.migrate_from(INIFileStorage(todofile))
+        return storage
+    raise ValueError(
+        'Unknown todo_storage {0}; choose from {1}'
+        .format(kind, ', '.join(STORAGE_KINDS))
+        )
+
+STORAGE_KINDS = [ 'ini', 'sharded', 'sqlite' ]
+
+
+class TodoStorage(object):
+    """
+    Base class for the storage of the todo list. `load` returns a dict of section title
+    to a dict of keys and values; `save` stores a configparser.ConfigParser.
+    """
+
+    def load(self):
+        raise NotImplementedError
+
+    def save(self, config):
+        raise NotImplementedError
+
+    def exists(self):
+        raise NotImplementedError
+
+    def signature(self):
+        """
+        Returns something that changes whenever the stored todo list is modified
+        (by any process), to detect external changes
+        """
+        raise NotImplementedError
+
+
+class INIFileStorage(TodoStorage):
+    """
+    The todo list as a single ini-style file. Written atomically, and only if the
+    contents changed compared to what was last read or written.
+    """
+
+    def __init__(self, path):
+        super(INIFileStorage, self).__init__()
+        self.path = path
+        self._text = None
+
+    def __repr__(self):
+        return '<INIFileStorage {0}>'.format(self.path)
+
+    def exists(self):
+        return osp.isfile(self.path)
+
+    def signature(self):
+        return file_signature(self.path)
+
+    def load(self):
+        if not self.exists(): return {}
+        with open(self.path, 'r') as f:
+            self._text = f.read()
+        config = configparser.ConfigParser()
+        config.read_string(self._text)
+        return { title : dict(config[title]) for title in config.sections() }
+
+    def save(self, config):
+        text = config_to_text(config)
+        if text == self._text and self.exists():
+            logger.info('Contents of %s unchanged, not writing', self.path)
+            return
+        logger.info('Overwriting %s', self.path)
+        atomic_write(self.path, text)
+        self._text = text
+        logger.debug('Wrote the following to %s:\n%s', self.path, text)
+
+
+class ShardedStorage(TodoStorage):
+    """
+    The todo list as a directory with one file per cluster. Every file is written
+    atomically, and only if that cluster's section changed, so the written volume
+    follows the number of changed clusters rather than the number of tracked jobs.
+    """
+
+    suffix = '.todo'
+
+    def __init__(self, path):
+        super(ShardedStorage, self).__init__()
+        self.path = path
+        self._texts = {}
+
+    def __repr__(self):
+        return '<ShardedStorage {0}>'.format(self.path)
+
+    def exists(self):
+        return osp.isdir(self.path)
+
+    def shard(self, title):
+        return osp.join(self.path, title + self.suffix)
+
+    def signature(self):
+        return tuple(
+            (shard, file_signature(shard))
+            for shard in sorted(glob.glob(osp.join(self.path, '*' + self.suffix)))
+            )
+
+    def load(self):
+        sections = {}
+        self._texts = {}
+        for shard in sorted(glob.glob(osp.join(self.path, '*' + self.suffix))):
+            with open(shard, 'r') as f:
+                text = f.read()
+            config = configparser.ConfigParser()
+            config.read_string(text)
+            for title in config.sections():
+                sections[title] = dict(config[title])
+                self._texts[title] = text
+        return sections
+
+    def save(self, config):
+        n_written = 0
+        for title in config.sections():
+            text = section_to_text(title, config[title])
+            if self._texts.get(title, None) == text: continue
+            atomic_write(self.shard(title), text)
+            self._texts[title] = text
+            n_written += 1
+        removed = [ title for title in self._texts if not title in config.sections() ]
+        for title in removed:
+            if osp.isfile(self.shard(title)): os.remove(self.shard(title))
+            del self._texts[title]
+        logger.info(
+            'Wrote %s and removed %s out of %s shards in %s',
+            n_written, len(removed), len(config.sections()) + len(removed), self.path
+            )
+
+
+class SQLiteStorage(TodoStorage):
+    """
+    The todo list in a sqlite database (WAL mode), with a row per cluster and a row
+    per job that is not yet done or failed. Jobs in a terminal state are never
+    processed again, so they are kept as compact ranges in the cluster row instead;
+    loading and saving then scale with the number of clusters and unfinished jobs.
+    Saving only touches the rows of jobs whose state or failure count changed,
+    in one transaction.
+    """
+
+    # Section keys that are stored per job rather than in the cluster row
+    job_keys = [ 'all', 'failurecounts' ] + cjm.jobstates.JOB_STATES
+    # States whose jobs are stored as ranges in the cluster row
+    terminal_states = [ 'done', 'failed' ]
+
+    def __init__(self, path):
+        super(SQLiteStorage, self).__init__()
+        self.path = path
+        dirname = osp.dirname(osp.abspath(self.path))
+        if not osp.isdir(dirname):
+            logger.info('Creating directory %s', dirname)
+            os.makedirs(dirname)
+        self.connection = sqlite3.connect(self.path, timeout=60.)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS clusters ('
+                'title TEXT PRIMARY KEY, '
+                'meta TEXT NOT NULL)'
+                )
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'title TEXT NOT NULL, '
+                'proc_id INTEGER NOT NULL, '
+                'state TEXT, '
+                'failurecount INTEGER NOT NULL DEFAULT 0, '
+                'PRIMARY KEY (title, proc_id))'
+                )
+            self.connection.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (title, state)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT)'
+                )
+        # What is known to be in the database, to compute what changed on save
+        self._meta = {}
+        self._jobs = {}
+
+    def __repr__(self):
+        return '<SQLiteStorage {0}>'.format(self.path)
+
+    def exists(self):
+        return osp.isfile(self.path)
+
+    def signature(self):
+        return (file_signature(self.path), file_signature(self.path + '-wal'))
+
+    def is_initialized(self):
+        """
+        Whether the database was ever written to (or migrated into)
+        """
+        return self.connection.execute(
+            'SELECT value FROM info WHERE key=?', ('initialized',)
+            ).fetchone() is not None
+
+    def _mark_initialized(self):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO info (key, value) VALUES (?, ?)', ('initialized', '1')
+            )
+
+    @classmethod
+    def split_section(cls, section):
+        """
+        Splits a todo section into the cluster-level keys and a dict of
+        proc_id -> (state, failurecount) of the jobs that are not in a terminal state.
+        The cluster-level keys include the terminal states and the failure counts of
+        the jobs in them, encoded as in the section.
+        """
+        meta = { k : v for k, v in section.items() if not k in cls.job_keys }
+        jobs = { p : (None, 0) for p in cjm.utils.decode_ranges(section.get('all', '')) }
+        for state in cjm.jobstates.JOB_STATES:
+            for proc_id in cjm.utils.decode_ranges(section.get(state, '')):
+                jobs[proc_id] = (state, jobs.get(proc_id, (None, 0))[1])
+        for proc_id, count in cjm.utils.decode_counts(section.get('failurecounts', '')).items():
+            jobs[proc_id] = (jobs.get(proc_id, (None, 0))[0], count)
+        terminal_failurecounts = {}
+        for state in cls.terminal_states:
+            proc_ids = [ p for p, (s, count) in jobs.items() if s == state ]
+            if not proc_ids: continue
+            meta[state] = cjm.utils.encode_ranges(proc_ids)
+            for proc_id in proc_ids:
+                count = jobs.pop(proc_id)[1]
+                if count: terminal_failurecounts[proc_id] = count
+        if terminal_failurecounts: meta['failurecounts'] = cjm.utils.encode_counts(terminal_failurecounts)
+        return meta, jobs
+
+    @classmethod
+    def join_section(cls, meta, jobs):
+        """
+        Inverse of `split_section`
+        """
+        section = { k : v for k, v in meta.items() if not k in cls.job_keys }
+        jobs = dict(jobs)
+        for state in cls.terminal_states:
+            for proc_id in cjm.utils.decode_ranges(meta.get(state, '')):
+                jobs[proc_id] = (state, 0)
+        for proc_id, count in cjm.utils.decode_counts(meta.get('failurecounts', '')).items():
+            jobs[proc_id] = (jobs[proc_id][0], count)
+        section['all'] = cjm.utils.encode_ranges(jobs.keys())
+        by_state = {}
+        failurecounts = {}
+        for proc_id, (state, count) in jobs.items():
+            if not state is None: by_state.setdefault(state, []).append(proc_id)
+            if count: failurecounts[proc_id] = count
+        for state in cjm.jobstates.JOB_STATES:
+            if state in by_state: section[state] = cjm.utils.encode_ranges(by_state[state])
+        if failurecounts: section['failurecounts'] = cjm.utils.encode_counts(failurecounts)
+        return section
+
+    def load(self):
+        self._meta = {}
+        self._jobs = {}
+        # One read transaction, so a concurrent save cannot land between the two reads
+        self.connection.execute('BEGIN')
+        try:
+            for title, meta in self.connection.execute('SELECT title, meta FROM clusters'):
+                self._meta[title] = json.loads(meta)
+                self._jobs[title] = {}
+            # Finished jobs are in the cluster rows; only the rows of the other jobs are read
+            for title, proc_id, state, count in self.connection.execute(
+                    'SELECT title, proc_id, state, failurecount FROM jobs '
+                    'WHERE state IS NULL OR state NOT IN ({0}) ORDER BY title, proc_id'
+                    .format(', '.join('?' for state in self.terminal_states)),
+                    self.terminal_states
+                    ):
+                if title in self._jobs: self._jobs[title][proc_id] = (state, count)
+        finally:
+            self.connection.commit()
+        return { title : self.join_section(self._meta[title], self._jobs[title]) for title in self._meta }
+
+    def _write_section(self, title, section):
+        """
+        Writes the rows that differ from what is known to be in the database.
+        Must be called inside a transaction. Returns the number of changed job rows.
+        """
+        meta, jobs = self.split_section(section)
+        if self._meta.get(title, None) != meta:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO clusters (title, meta) VALUES (?, ?)',
+                (title, json.dumps(meta, sort_keys=True))
+                )
+            self._meta[title] = meta
+        old_jobs = self._jobs.get(title, {})
+        changed = [
+            (title, proc_id, state, count) for proc_id, (state, count) in jobs.items()
+            if old_jobs.get(proc_id, None) != (state, count)
+            ]
+        if changed:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO jobs (title, proc_id, state, failurecount) VALUES (?, ?, ?, ?)',
+                changed
+                )
+        removed = [ (title, proc_id) for proc_id in old_jobs if not proc_id in jobs ]
+        if removed:
+            self.connection.executemany('DELETE FROM jobs WHERE title=? AND proc_id=?', removed)
+        self._jobs[title] = jobs
+        return len(changed) + len(removed)
+
+    def _delete_section(self, title):
+        self.connection.execute('DELETE FROM clusters WHERE title=?', (title,))
+        self.connection.execute('DELETE FROM jobs WHERE title=?', (title,))
+        self._meta.pop(title, None)
+        self._jobs.pop(title, None)
+
+    def save(self, config):
+        n_rows = 0
+        with self.connection:
+            for title in config.sections():
+                n_rows += self._write_section(title, config[title])
+            removed = [ title for title in list(self._meta) if not title in config.sections() ]
+            for title in removed:
+                self._delete_section(title)
+            self._mark_initialized()
+        logger.info(
+            'Updated %s job rows and removed %s clusters in %s', n_rows, len(removed), self.path
+            )
+
+    def migrate_from(self, storage):
+        """
+        One-shot import of all sections of another storage (e.g. the ini todo file)
+        """
+        sections = storage.load()
+        logger.warning('Migrating %s clusters from %s to %s', len(sections), storage, self)
+        with self.connection:
+            for title, section in sections.items():
+                self._write_section(title, section)
+            self._mark_initialized()
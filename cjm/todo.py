@@ -2,25 +2,10 @@
 # -*- coding: utf-8 -*-
 import cjm
 import os.path as osp
-import logging, configparser, pprint, copy, os
+import logging, configparser, pprint, copy, os, threading, time
+from collections import OrderedDict
 from time import strftime
 logger = logging.getLogger('cjm')
-import htcondor
-
-# Patch configparser.ConfigParser deepcopy method
-def configparser_deepcopy(self):
-    try:
-        from StringIO import StringIO
-    except ImportError:
-        from io import StringIO
-    # Create a deep copy of the configuration object
-    config_string = StringIO()
-    self.write(config_string)
-    # Reset the buffer to make it ready for reading.
-    config_string.seek(0)        
-    new_config = ConfigParser.ConfigParser()
-    new_config.readfp(config_string)
-configparser.ConfigParser.__deepcopy__ = configparser_deepcopy
 
 
 class TodoList(object):
@@ -34,6 +19,10 @@ class TodoList(object):
         """
         super(TodoList, self).__init__()
         self.todofile = cjm.CONFIG.todofile if todofile is None else todofile
+        self.storage = cjm.storage.get_storage(self.todofile)
+        # New submissions are appended here, and folded into the todo list on reading
+        self.journal = cjm.journal.SubmissionJournal(self.todofile + '.journal')
+        self._journal_offset = 0
         self.todo = configparser.ConfigParser()
         if _dict:
             self.todo.read_dict(_dict)
@@ -45,33 +34,44 @@ class TodoList(object):
             self.read()
 
     def read(self):
-        if osp.isfile(self.todofile):
-            self.todo.read(self.todofile)
+        if self.storage.exists():
+            self.todo.read_dict(self.storage.load())
             logger.info(
-                'Initializing todo list using file %s; sections detected: %s',
-                self.todofile, self.get_section_titles()
+                'Initializing todo list using %s; sections detected: %s',
+                self.storage, self.get_section_titles()
                 )
         else:
-            logger.info('Todo file %s does not exist, keeping empty configparser', self.todofile)
+            logger.info('%s does not exist, keeping empty configparser', self.storage)
+        self.fold_journal()
+
+    def fold_journal(self):
+        """
+        Adds the sections of newly submitted clusters from the journal to the todo list
+        """
+        records, self._journal_offset = self.journal.read()
+        for title, section in records:
+            if title in self.todo:
+                logger.debug('Section %s from %s was already stored', title, self.journal)
+                continue
+            self.todo[title] = section
+        if records:
+            logger.info('Folded %s sections from %s', len(records), self.journal)
 
     def write(self, config=None):
         if config is None: config = self.todo
-        logger.info('Overwriting %s', self.todofile)
-        dirname = osp.dirname(self.todofile)
-        if not osp.isdir(dirname):
-            logger.info('Creating directory %s', dirname)
-            os.makedirs(dirname)
-        with open(self.todofile, 'w') as f:
-            config.write(f)
-        logger.debug('Wrote the following to %s:\n%s', self.todofile, self.read_plain())
+        self.storage.save(config)
+        # The folded journal records are now stored, so they can be removed
+        self.journal.compact(self._journal_offset)
+        self._journal_offset = 0
 
     def read_plain(self):
         """
-        Reads and returns the contents of the todo file as plain text.
+        Reads and returns the stored todo list as plain ini-style text, whatever the
+        configured storage.
         """
-        with open(self.todofile, 'r') as f:
-            contents = f.read()
-        return contents
+        config = configparser.ConfigParser()
+        config.read_dict(self.storage.load())
+        return cjm.storage.config_to_text(config)
 
     def push(self, key, dictlike):
         self.todo[key] = dictlike
@@ -94,31 +94,166 @@ class TodoList(object):
         """
         return HTCondorQueueState(cluster_id).read()
 
-    def update(self):
+    def get_queuestates(self, cluster_ids, since=None):
+        """
+        Returns a dict of cluster_id to HTCondorQueueState instance for all clusters
+        in `cluster_ids`, using a single query per schedd
+        """
+        return HTCondorQueueState.read_batch(cluster_ids, since=since)
+
+    @staticmethod
+    def get_delta_since(todoitems):
+        """
+        Returns the per-schedd ServerTime from which on a delta poll is safe for all
+        `todoitems`, i.e. the oldest previous poll. Schedds for which any todoitem has
+        no previous poll are left out, so they get a full poll.
+        """
+        since = None
+        for todoitem in todoitems:
+            if since is None:
+                since = dict(todoitem.last_poll)
+                continue
+            since = {
+                name : min(poll_time, todoitem.last_poll[name])
+                for name, poll_time in since.items() if name in todoitem.last_poll
+                }
+        return since if since else None
+
+    def update(self, profile=False, trace_memory=False, profiler=None):
         """
         Reads the queue using the htcondor bindings, and makes an updated todolist.
         Returns an updated TodoList instance.
         Does not modify `self`, only the physical todofile.
         Writes the updated todolist automatically to the todofile.
+
+        :param profile: Record cProfile stats per phase of the update
+        :type profile: bool
+        :param trace_memory: Record the top allocations per phase of the update
+        :type trace_memory: bool
+        :param profiler: A cjm.profiling.Profiler to use instead (e.g. one that also
+            covered reading the todo list); `profile` and `trace_memory` are then ignored
+        :type profiler: cjm.profiling.Profiler, optional
         """
+        if profiler is None:
+            if not profile and cjm.profiling.pop_profile_request():
+                logger.info('Profiling this cycle, since the previous one was slow')
+                profile = True
+            profiler = cjm.profiling.Profiler(profile=profile, trace_memory=trace_memory)
         logger.debug('Begin updating, section titles = %s', self.get_section_titles())
+        metrics = cjm.metrics.start_cycle()
+        cjm.CONFIG.refresh_stale_schedds()
         new_todo = configparser.ConfigParser()
         # Instantiates an email class, which will be filled with noteworthy events
         email = cjm.Email()
-        for section_title in self.get_section_titles():
+        with profiler.phase('read'):
             # Key `cluster_id` is expected to exist in the section
-            cluster_id = self.todo[section_title]['cluster_id']
-            todoitem = self.get_todoitem(cluster_id)
-            queuestate = self.get_queuestate(cluster_id)
-            new_todoitem = HTCondorUpdater(todoitem, queuestate, email=email).update()
-            status = new_todoitem.is_finished()
-            if status['finished']:
-                logger.info('Finished, not parsing todo item to next update')
-            else:
-                new_todo[cluster_id] = new_todoitem.parse_todoitem()
-        email.send_email()
-        self.write(new_todo)
-        return TodoList(self.todofile)
+            cluster_ids = [ self.todo[title]['cluster_id'] for title in self.get_section_titles() ]
+            todoitems = [ self.get_todoitem(cluster_id) for cluster_id in cluster_ids ]
+            if cjm.CONFIG.adaptive_polling:
+                # Clusters that are not due yet are carried over unchanged
+                now = time.time()
+                not_due = [ t for t in todoitems if not t.is_due(now) ]
+                for todoitem in not_due:
+                    new_todo[todoitem.cluster_id] = self.todo[todoitem.section_title]
+                if not_due:
+                    logger.info('Skipping %s clusters that are not due for polling', len(not_due))
+                    todoitems = [ t for t in todoitems if t.is_due(now) ]
+                    cluster_ids = [ t.cluster_id for t in todoitems ]
+                    metrics.clusters_skipped = len(not_due)
+            metrics.clusters = len(todoitems)
+            metrics.jobs = sum(t.get_n_jobs() for t in todoitems)
+        with profiler.phase('query'):
+            queuestates = {}
+            if cjm.CONFIG.update_engine == 'eventlog':
+                # Local reads of the job event logs; only the other clusters are polled
+                queuestates = cjm.eventlog.read_queuestates(todoitems)
+            polled_todoitems = [ t for t in todoitems if not t.cluster_id in queuestates ]
+            # Snapshot of the queue for all polled clusters at once
+            since = self.get_delta_since(polled_todoitems) if cjm.CONFIG.delta_polling else None
+            queuestates.update(self.get_queuestates(
+                [ t.cluster_id for t in polled_todoitems ], since=since
+                ))
+        with profiler.phase('process'):
+            updaters = [
+                HTCondorUpdater(todoitem, queuestates[todoitem.cluster_id], email=email, defer_actions=True)
+                for todoitem in todoitems
+                ]
+        with profiler.phase('history'):
+            # Fetch the history of all clusters that will need it in one go
+            history_proc_ids = { u.todoitem.cluster_id : u.history_proc_ids() for u in updaters }
+            unavailable = HTCondorClusterHistory.prefetch(
+                [ c for c in cluster_ids if len(history_proc_ids[c]) > 0 ],
+                proc_ids=history_proc_ids
+                )
+            for updater in updaters:
+                if updater.todoitem.cluster_id in unavailable: updater.history_unavailable = True
+        with profiler.phase('process'):
+            for updater in updaters:
+                updater.process_jobs()
+        # Side effects of processing are applied for all clusters at once
+        resubmissions = [ r for updater in updaters for r in updater.resubmissions ]
+        if resubmissions:
+            with profiler.phase('resubmit'):
+                apply_resubmissions(resubmissions)
+                for updater in updaters:
+                    updater.finish_resubmissions()
+        actions = [ action for updater in updaters for action in updater.actions ]
+        if actions:
+            with profiler.phase('actions'):
+                if cjm.CONFIG.io_engine == 'asyncio':
+                    cjm.aio.run_actions(actions)
+                else:
+                    run_actions(actions)
+        with profiler.phase('process'):
+            for updater in updaters:
+                cluster_id = updater.todoitem.cluster_id
+                new_todoitem = updater.finish()
+                status = new_todoitem.is_finished()
+                if status['finished']:
+                    logger.info('Finished, not parsing todo item to next update')
+                else:
+                    new_todo[cluster_id] = new_todoitem.parse_todoitem()
+        with profiler.phase('email'):
+            email.send_email()
+        with profiler.phase('write'):
+            self.write(new_todo)
+            # Stored history is only needed for clusters that are still tracked
+            store = cjm.history.get_store()
+            if store: store.prune([ new_todo[s]['cluster_id'] for s in new_todo.sections() ])
+        self.finish_profiler(profiler)
+        cjm.metrics.finish_cycle(profiler)
+        return self.derive(new_todo)
+
+    @staticmethod
+    def finish_profiler(profiler):
+        """
+        Logs the phase times, writes the profile if one was recorded, and requests
+        a profile of the next cycle if this one was slower than `profile_slow_cycle`
+        """
+        total_time = profiler.total_time()
+        logger.info('Update cycle took %.2f s: %s', total_time, profiler.summary())
+        if profiler.enabled:
+            profiler.write()
+            profiler.stop()
+        elif 0 < cjm.CONFIG.profile_slow_cycle < total_time:
+            logger.warning(
+                'Update cycle took longer than %s s; the next cycle will be profiled',
+                cjm.CONFIG.profile_slow_cycle
+                )
+            cjm.profiling.request_profile()
+
+    def derive(self, todo):
+        """
+        Returns a new TodoList for the same todo file with `todo` (a ConfigParser) as
+        its state, sharing the storage and journal instead of re-reading them
+        """
+        new = self.__class__.__new__(self.__class__)
+        new.todofile = self.todofile
+        new.storage = self.storage
+        new.journal = self.journal
+        new._journal_offset = 0
+        new.todo = todo
+        return new
 
     def submit(self, command_line, monitor_level='high'):
         """
@@ -129,25 +264,40 @@ class TodoList(object):
         :param command_line: the command line that would normally be submitted to condor_submit
         :type command_line: list
         """
-        new_todo = copy.deepcopy(self.todo)
-        cluster_id, n_jobs, output = cjm.utils.submit(command_line)
-        new_item = {
-            'cluster_id' : str(cluster_id),
-            'submission_time' : strftime('%Y-%m-%d %H:%M:%S'),
-            'submission_path' : os.getcwd(),
-            'monitor_level' : monitor_level,
-            'all' : ','.join([ str(i) for i in range(n_jobs)]),
-            'idle' : ','.join([ str(i) for i in range(n_jobs)])
-            }
-        logger.info('Pushing new todo item %s: %s', cluster_id, new_item)
-        new_todo[str(cluster_id)] = new_item
-        self.write(new_todo)
+        cluster_id = submit(command_line, todofile=self.todofile, monitor_level=monitor_level)
         return cluster_id, TodoList(self.todofile)
 
 
+def submit(command_line, todofile=None, monitor_level='high'):
+    """
+    Submits jobs according to the command line, and appends the new cluster to the
+    submission journal of the todo file. The todo list itself is neither read nor
+    written; the next update folds the new cluster in. Returns the `cluster_id`.
+
+    :param command_line: the command line that would normally be submitted to condor_submit
+    :type command_line: list
+    """
+    if todofile is None: todofile = cjm.CONFIG.todofile
+    cluster_id, n_jobs, output = cjm.utils.submit(command_line)
+    new_item = {
+        'cluster_id' : str(cluster_id),
+        'submission_time' : strftime('%Y-%m-%d %H:%M:%S'),
+        'submission_path' : os.getcwd(),
+        'monitor_level' : monitor_level,
+        'all' : cjm.utils.encode_ranges(range(n_jobs)),
+        'idle' : cjm.utils.encode_ranges(range(n_jobs))
+        }
+    logger.info('Pushing new todo item %s: %s', cluster_id, new_item)
+    cjm.journal.SubmissionJournal(todofile + '.journal').append(str(cluster_id), new_item)
+    return cluster_id
+
+
 class HTCondorTodoItem(object):
     """docstring for HTCondorTodoItem"""
 
+    # States from which a job is never moved again
+    terminal_states = [ 'done', 'failed' ]
+
     @classmethod
     def from_section(cls, section_title, section):
         instance = cls()
@@ -156,22 +306,14 @@ class HTCondorTodoItem(object):
 
     def __init__(self):
         super(HTCondorTodoItem, self).__init__()
-        self.states = [
-            'idle',
-            'running',
-            'removed',
-            'completed',
-            'held',
-            'transferring',
-            'suspended',
-            'done',
-            'failed',
-            ]
-        self.jobs = []
-        # 'Private' dict to efficiently look up a job by id and state
+        self.states = list(cjm.jobstates.JOB_STATES)
+        # Lazy sequence of HTCondorJob instances, created on first access
+        self.jobs = LazyJobSequence(self)
+        # 'Private' dict of the job instances created so far, by proc_id
         # subject to change, and not part of the api
         self._jobs_by_procid = {}
-        self._jobs_by_state = {}
+        # Compact store holding the state and failure count of every job
+        self.jobstates = None
         self.status = None
 
     def __repr__(self):
@@ -189,34 +331,32 @@ class HTCondorTodoItem(object):
         self.submission_time = self.section.get('submission_time', None)
         self.total_failure_count = int(self.section.get('total_failure_count', 0))
         self.total_resubmission_count = int(self.section.get('total_resubmission_count', 0))
+        # ServerTime of the previous poll per schedd, used for delta polling
+        self.last_poll = {}
+        for pair in self.read_section_key('last_poll'):
+            schedd_name, poll_time = pair.rsplit(':', 1)
+            self.last_poll[schedd_name] = int(poll_time)
+        # Time of the next poll and the interval leading to it, for adaptive polling
+        self.next_poll = float(self.section['next_poll']) if 'next_poll' in self.section else None
+        self.poll_interval = float(self.section['poll_interval']) if 'poll_interval' in self.section else None
+        # Job event log of the cluster, and the byte offset up to which it was read
+        self.userlog = self.section.get('userlog', None)
+        self.userlog_offset = int(self.section.get('userlog_offset', 0))
         self.get_job_instances()
         return self
 
     def get_job_instances(self):
         """
-        Creates list of empty jobs and fills according to what is specified in the section
+        Fills the job state store according to what is specified in the section.
+        HTCondorJob instances are only created when requested via `get_job`.
         """
-        # Create list of empty jobs
-        logger.debug('Creating job instances for %s', self.cluster_id)
-        self.all = self.read_section_key('all', required=True)
-        logger.debug('All proc_ids: %s', self.all)
-        for proc_id in sorted(self.all):
-            job = HTCondorJob(self.cluster_id, proc_id)
-            job.set_parent_todoitem(self)
-            self.jobs.append(job)
-            self._jobs_by_procid[proc_id] = job
-        logger.debug('Created jobs: %s', self.jobs)
-        # Fill in the found states
+        logger.debug('Reading job states for %s', self.cluster_id)
+        self.jobstates = cjm.jobstates.JobStateStore(self.states, self.read_section_key('all', required=True))
         for state in self.states:
-            self._jobs_by_state[state] = []
-            for proc_id in self.read_section_key(state):
-                job = self._jobs_by_procid[proc_id]
-                job.set_prev_state(state)
-                self._jobs_by_state[state].append(job)
+            self.jobstates.set_states(self.read_section_key(state), state)
         # Count number of failed resubmission attempts
-        for pair in self.read_section_key('failurecounts'):
-            proc_id, count = pair.split(':')
-            self._jobs_by_procid[proc_id].set_failurecount(count)
+        for proc_id, count in self.read_section_key('failurecounts').items():
+            self.jobstates.set_failurecount(proc_id, count)
 
     def read_section_key(self, key, required=False):
         if not key in self.section:
@@ -225,9 +365,11 @@ class HTCondorTodoItem(object):
                     'Key {0} is required but not found'
                     .format(key)
                     )
-            return []
+            return {} if key == 'failurecounts' else []
         if key in self.states or key == 'all':
-            return [ int(i) for i in self.section[key].split(',') ]
+            return cjm.utils.decode_ranges(self.section[key])
+        elif key == 'failurecounts':
+            return cjm.utils.decode_counts(self.section[key])
         else:
             return self.section[key].split(',')
 
@@ -244,17 +386,35 @@ class HTCondorTodoItem(object):
         if logger.isEnabledFor(logging.DEBUG):
             logger.debug('Verbose output for %s:\n%s', self, pprint.pformat(vars(self)))
 
+    @property
+    def all(self):
+        """
+        Sorted list of all proc_ids tracked in this todoitem
+        """
+        return self.jobstates.proc_ids
+
     def get_n_jobs(self):
         """
         Returns the total number of jobs tracked in this todoitem
         """
-        return len(self.all)
+        return len(self.jobstates)
 
     def get_state(self, job_id):
-        return self._jobs_by_procid[job_id].prev_state
+        return self.jobstates.get_state(job_id)
 
     def get_job(self, job_id):
-        return self._jobs_by_procid[job_id]
+        """
+        Returns the HTCondorJob instance for proc_id `job_id`, creating it if needed
+        """
+        job_id = int(job_id)
+        job = self._jobs_by_procid.get(job_id, None)
+        if job is None:
+            job = HTCondorJob(self.cluster_id, job_id)
+            job.set_parent_todoitem(self)
+            job.set_prev_state(self.jobstates.get_state(job_id))
+            job.set_failurecount(self.jobstates.get_failurecount(job_id))
+            self._jobs_by_procid[job_id] = job
+        return job
 
     def get_jobs_in_state(self, state):
         if not state in self.states:
@@ -262,54 +422,72 @@ class HTCondorTodoItem(object):
                 'No state {0} in available states {1}'
                 .format(state, self.states)
                 )
-        return self._jobs_by_state[state]
+        return [ self.get_job(p) for p in self.jobstates.proc_ids_in_state(state) ]
+
+    def active_proc_ids(self):
+        """
+        Returns the sorted proc_ids of all jobs that are not in a terminal state,
+        including jobs listed in 'all' without any state. Only the (C-level) scan of
+        the state store is needed for this, and terminal jobs are never touched.
+        """
+        return self.jobstates.proc_ids_in_states(
+            [ s for s in self.states if not s in self.terminal_states ] + [ None ]
+            )
+
+    def count_jobs_in_state(self, state):
+        """
+        Returns the number of jobs in state `state` (O(1))
+        """
+        if not state in self.states:
+            raise ValueError(
+                'No state {0} in available states {1}'
+                .format(state, self.states)
+                )
+        return self.jobstates.count(state)
 
     def copy(self):
         """
-        Creates a deepcopy of the instance, with the exception of the 
-        underlying HTCondorJob instances; these are the same instances
-        """
-        # Disable deepcopying of the HTCondorJob class
-        def override_job_deepcopy(self, memo):
-            logger.debug('deepcopy of %s is overridden, returning shallow', self.__class__)
-            return self
-        restore = False
-        if hasattr(HTCondorJob, '__deepcopy__'):
-            _backup_deepcopy = HTCondorJob.__deepcopy__
-            restore = True
-        HTCondorJob.__deepcopy__ = override_job_deepcopy
-        # Throws error otherwise... kinda weird
-        configparser.SectionProxy.__deepcopy__ = override_job_deepcopy
-        # Create the deepcopy of HTCondorTodoItem instance
-        self.debug_log()
-        new = copy.deepcopy(self)
-        # Restore deepcopying of HTCondorJob class if necessary
-        if restore: HTCondorJob.__deepcopy__ = _backup_deepcopy
+        Creates a structural copy of the instance. The underlying HTCondorJob instances
+        are shared, and the job states are copied on write, so only the states that
+        change after the copy are duplicated.
+        """
+        new = self.__class__.__new__(self.__class__)
+        new.__dict__.update(self.__dict__)
+        new.jobs = LazyJobSequence(new)
+        new.jobstates = self.jobstates.copy()
+        new._jobs_by_procid = dict(self._jobs_by_procid)
+        new.status = copy.copy(self.status)
         return new
 
     def move(self, job, new_state):
         if not new_state in self.states:
             raise ValueError('State {0} does not exist'.format(new_state))
-        current_state = job.prev_state
+        current_state = self.jobstates.get_state(job.proc_id)
         if current_state == new_state:
             logger.info('Job %s state change: %s -> %s; doing nothing', job.proc_id, current_state, new_state)
         else:
-            self._jobs_by_state[current_state].remove(job)
-            self._jobs_by_state[new_state].append(job)
+            self.jobstates.set_state(job.proc_id, new_state)
             job.prev_state = new_state
             logger.info('Job %s state change: %s -> %s', job.proc_id, current_state, new_state)
+            cjm.metrics.record_transition(current_state, new_state)
+
+    def increment_failurecount(self, job):
+        """
+        Increases the failure count of `job` by one
+        """
+        job.failurecount = self.jobstates.get_failurecount(job.proc_id) + 1
+        self.jobstates.set_failurecount(job.proc_id, job.failurecount)
 
     def is_finished(self):
         """
         Counts done, failed, and all jobs, and determines whether the job is finished.
         Returns a dict.
         """
-        done_jobs = [ j.proc_id for j in self.get_jobs_in_state('done')]
-        failed_jobs = [ j.proc_id for j in self.get_jobs_in_state('failed')]
-        n_done = len(done_jobs)
-        n_failed = len(failed_jobs)
+        n_done = self.count_jobs_in_state('done')
+        n_failed = self.count_jobs_in_state('failed')
         n_all = self.get_n_jobs()
-        if set(done_jobs + failed_jobs) == set(self.all):
+        # Every job has exactly one state, so counting suffices
+        if n_done + n_failed == n_all:
             finished = True
             logger.info(
                 'Todo item {0} is finished: {1} ({2:.2f}%) done, {3} ({4:.2f}%) failed'
@@ -341,15 +519,72 @@ class HTCondorTodoItem(object):
             'total_resubmission_count' : str(self.total_resubmission_count)
             }
         # Optional attributes
-        for key in [ 'monitor_level', 'submission_time', 'all' ]:
+        for key in [ 'monitor_level', 'submission_time' ]:
             if key in self.section: r[key] = self.section[key]
-        # Parse states
+        # Parse states, as compact ranges of proc_ids
+        r['all'] = cjm.utils.encode_ranges(self.all)
         for state in self.states:
-            jobs = self.get_jobs_in_state(state)
-            if len(jobs) == 0: continue
-            r[state] = ','.join([str(j.proc_id) for j in jobs])
+            if self.count_jobs_in_state(state) == 0: continue
+            r[state] = cjm.utils.encode_ranges(self.jobstates.proc_ids_in_state(state))
+        if self.jobstates.failurecounts:
+            r['failurecounts'] = cjm.utils.encode_counts(self.jobstates.failurecounts)
+        if self.last_poll:
+            r['last_poll'] = ','.join(
+                '{0}:{1}'.format(name, self.last_poll[name]) for name in sorted(self.last_poll)
+                )
+        if self.userlog:
+            r['userlog'] = self.userlog
+            r['userlog_offset'] = str(self.userlog_offset)
+        if cjm.CONFIG.adaptive_polling and not self.next_poll is None:
+            r['next_poll'] = str(int(self.next_poll))
+            r['poll_interval'] = str(int(self.poll_interval))
         return r
 
+    def get_userlog_path(self):
+        """
+        Returns the path to the job event log, or None if it is not known
+        """
+        if not self.userlog: return None
+        return osp.join(osp.abspath(self.submission_path), self.userlog)
+
+    def is_due(self, now=None):
+        """
+        Checks whether the cluster should be polled (always, unless adaptive polling
+        scheduled the next poll in the future)
+        """
+        if self.next_poll is None: return True
+        return self.next_poll <= (time.time() if now is None else now)
+
+
+class LazyJobSequence(object):
+    """
+    Read-only sequence of the jobs of a todoitem, sorted by proc_id.
+    Job instances are only created when accessed.
+    """
+
+    def __init__(self, todoitem):
+        super(LazyJobSequence, self).__init__()
+        self.todoitem = todoitem
+
+    def __len__(self):
+        return self.todoitem.get_n_jobs()
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [ self[j] for j in range(*i.indices(len(self))) ]
+        if i < 0: i += len(self)
+        if not 0 <= i < len(self): raise IndexError('job index out of range')
+        return self.todoitem.get_job(self.todoitem.jobstates.proc_id_at(i))
+
+    def __iter__(self):
+        for proc_id in self.todoitem.jobstates.proc_ids:
+            yield self.todoitem.get_job(proc_id)
+
+    def __repr__(self):
+        return '<LazyJobSequence of {0} jobs ({1} created)>'.format(
+            len(self), len(self.todoitem._jobs_by_procid)
+            )
+
 
 class HTCondorClusterHistory(object):
     """
@@ -358,10 +593,22 @@ class HTCondorClusterHistory(object):
     as little as possible.
     This class saves any instantiated history requests, and uses the saved history
     whenever possible.
+
+    The saved instances form an LRU cache keyed by cluster_id, each instance indexing
+    its classads by proc_id, so that a (cluster, proc) lookup is O(1). The cache is
+    bounded by `max_clusters` and `max_jobs`, entries older than `ttl` seconds (if set)
+    are refetched, and access is guarded by a lock so it can be used from threads.
     """
 
-    _cluster_ids = []
-    _cluster_id_to_instance = {}
+    max_clusters = 500
+    max_jobs = 200000
+    ttl = None
+
+    _lock = threading.RLock()
+    _cluster_id_to_instance = OrderedDict()
+    _n_jobs = 0
+    hits = 0
+    misses = 0
 
     @classmethod
     def get(cls, cluster_id, proc_id=None):
@@ -369,15 +616,101 @@ class HTCondorClusterHistory(object):
         If proc_id is None, returns an instance for cluster_id
         If proc_id is defined, returns the job for proc_id in cluster_id
         """
-        if not cluster_id in cls._cluster_ids:
+        instance = cls.get_cached(cluster_id)
+        if not(instance is None) and instance.partial and (proc_id is None or not instance.has_job(proc_id)):
+            instance = None
+        if instance is None:
+            # A single job may already be in the persistent store from a previous run
+            store = cjm.history.get_store()
+            if not(proc_id is None or store is None):
+                history = store.get(cluster_id, proc_id)
+                if not(history is None): return history
             instance = cls(cluster_id)
-        else:
-            instance = cls._cluster_id_to_instance[cluster_id]
         if not(proc_id is None):
             return instance.get_job(proc_id)
         else:
             return instance
 
+    @classmethod
+    def get_cached(cls, cluster_id):
+        """
+        Returns the cached instance for cluster_id, or None if there is no (fresh) one.
+        Updates the hit/miss counters.
+        """
+        key = str(cluster_id)
+        with cls._lock:
+            instance = cls._cluster_id_to_instance.get(key, None)
+            if not(instance is None) and instance.is_expired():
+                logger.debug('History for cluster %s expired', key)
+                cls._remove(key)
+                instance = None
+            if instance is None:
+                cls.misses += 1
+            else:
+                cls.hits += 1
+                cls._cluster_id_to_instance.move_to_end(key)
+        return instance
+
+    @classmethod
+    def is_cached(cls, cluster_id, proc_ids=None):
+        """
+        Checks whether there is a fresh instance for cluster_id that has all `proc_ids`.
+        Without `proc_ids`, a partial instance does not count. An instance missing
+        some of `proc_ids` is outdated, since in a long-running process more jobs of
+        the cluster may have finished after it was fetched.
+        """
+        with cls._lock:
+            instance = cls._cluster_id_to_instance.get(str(cluster_id), None)
+            if instance is None or instance.is_expired(): return False
+            if proc_ids is None: return not instance.partial
+            return all(instance.has_job(p) for p in proc_ids)
+
+    @classmethod
+    def feed(cls, cluster_id, jobs):
+        """
+        Adds history classads for some jobs of a cluster that are known without a
+        history query (e.g. from the job event log). If there is no instance for the
+        cluster yet, a partial one is created; lookups of other jobs in a partial
+        instance still query the history.
+        """
+        with cls._lock:
+            instance = cls._cluster_id_to_instance.get(str(cluster_id), None)
+            if instance is None or instance.is_expired():
+                cls(cluster_id, jobs=list(jobs), partial=True)
+            else:
+                instance.add_jobs([ job for job in jobs if not instance.has_job(job['ProcId']) ])
+
+    @classmethod
+    def prefetch(cls, cluster_ids, proc_ids=None):
+        """
+        Retrieves the history for all not yet cached clusters in `cluster_ids`
+        with one history query per schedd, and registers an instance per cluster.
+        If `proc_ids` is a dict of cluster_id to needed proc_ids, clusters for which
+        all needed jobs are in the persistent store are skipped.
+        Returns the cluster_ids whose history is unavailable this cycle, because a
+        schedd failed; no instance is registered for them, since any of their jobs
+        may have been in the history of the failing schedd.
+        """
+        cluster_ids = [
+            c for c in cluster_ids if not cls.is_cached(c, None if proc_ids is None else proc_ids[c])
+            ]
+        store = cjm.history.get_store()
+        if not(proc_ids is None or store is None):
+            cluster_ids = [ c for c in cluster_ids if not store.has_all(c, proc_ids[c]) ]
+        if len(cluster_ids) == 0: return []
+        logger.info('Prefetching history for clusters %s', cluster_ids)
+        errors = []
+        jobs_per_cluster = cjm.utils.get_history_for_clusters_htcondor(cluster_ids, errors=errors)
+        if errors:
+            logger.error(
+                'History query failed for schedds %s; no history for clusters %s this cycle',
+                [ schedd for schedd, e in errors ], cluster_ids
+                )
+            return cluster_ids
+        for cluster_id in cluster_ids:
+            cls(cluster_id, jobs=jobs_per_cluster[int(cluster_id)])
+        return []
+
     @classmethod
     def register(cls, instance):
         """
@@ -386,17 +719,95 @@ class HTCondorClusterHistory(object):
         Storing the history in memory is cheap, calling the history from
         htcondor is very expensive, so better keep it.
         """
-        cls._cluster_ids.append(instance.cluster_id)
-        cls._cluster_id_to_instance[instance.cluster_id] = instance
+        key = str(instance.cluster_id)
+        with cls._lock:
+            if key in cls._cluster_id_to_instance: cls._remove(key)
+            cls._cluster_id_to_instance[key] = instance
+            cls._n_jobs += len(instance)
+            # Evict least recently used clusters, but always keep the newest one
+            while (
+                len(cls._cluster_id_to_instance) > 1
+                and (
+                    len(cls._cluster_id_to_instance) > cls.max_clusters
+                    or cls._n_jobs > cls.max_jobs
+                    )
+                ):
+                evict_key = next(iter(cls._cluster_id_to_instance))
+                logger.debug('Evicting history for cluster %s from cache', evict_key)
+                cls._remove(evict_key)
+
+    @classmethod
+    def _remove(cls, key):
+        instance = cls._cluster_id_to_instance.pop(key)
+        cls._n_jobs -= len(instance)
+
+    @classmethod
+    def clear(cls):
+        """
+        Empties the cache and resets the counters
+        """
+        with cls._lock:
+            cls._cluster_id_to_instance.clear()
+            cls._n_jobs = 0
+            cls.hits = 0
+            cls.misses = 0
 
-    def __init__(self, cluster_id):
+    @classmethod
+    def stats(cls):
+        """
+        Returns a dict with the cache size and hit/miss counters
+        """
+        with cls._lock:
+            return {
+                'clusters' : len(cls._cluster_id_to_instance),
+                'jobs' : cls._n_jobs,
+                'hits' : cls.hits,
+                'misses' : cls.misses,
+                }
+
+    def __init__(self, cluster_id, jobs=None, partial=False):
         super(HTCondorClusterHistory, self).__init__()
         self.cluster_id = cluster_id
-        self.jobs = cjm.utils.get_cluster_history_htcondor(self.cluster_id)
+        if jobs is None:
+            errors = []
+            jobs = cjm.utils.get_cluster_history_htcondor(self.cluster_id, errors=errors)
+            if errors:
+                raise cjm.utils.ScheddQueryError(
+                    'History of cluster {0} is incomplete, since schedds {1} failed'
+                    .format(self.cluster_id, [ schedd for schedd, e in errors ])
+                    )
+        # A partial instance only holds the history of some jobs of the cluster
+        self.partial = partial
+        self.jobs = []
+        self.fetch_time = time.time()
+        # Index the classads by proc_id; keep duplicates to report them on lookup
+        self._jobs_by_procid = {}
+        self.add_jobs(jobs)
         self.__class__.register(self)
 
+    def add_jobs(self, jobs):
+        jobs = list(jobs)
+        store = cjm.history.get_store()
+        if store: store.put(jobs)
+        with self.__class__._lock:
+            self.jobs.extend(jobs)
+            for job in jobs:
+                self._jobs_by_procid.setdefault(int(job['ProcId']), []).append(job)
+            if self.__class__._cluster_id_to_instance.get(str(self.cluster_id), None) is self:
+                self.__class__._n_jobs += len(jobs)
+
+    def has_job(self, proc_id):
+        return int(proc_id) in self._jobs_by_procid
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def is_expired(self):
+        ttl = self.__class__.ttl
+        return not(ttl is None) and time.time() - self.fetch_time > ttl
+
     def get_job(self, proc_id):
-        jobs = [ j for j in self.jobs if int(j['ProcId']) == int(proc_id) ]
+        jobs = self._jobs_by_procid.get(int(proc_id), [])
         if len(jobs) == 0:
             logger.debug('No history for job %s in cluster %s', proc_id, self.cluster_id)
             return None
@@ -405,13 +816,22 @@ class HTCondorClusterHistory(object):
             return jobs[0]
         else:
             raise ValueError(
-                'Unexpected history count %s for job %s in cluster %s',
-                len(jobs), proc_id, self.cluster_id
+                'Unexpected history count {0} for job {1} in cluster {2}'
+                .format(len(jobs), proc_id, self.cluster_id)
                 )
 
 
 class HTCondorJob(object):
-    """docstring for HTCondorJob"""
+    """
+    A single job in a cluster. Instances are created on demand by the parent
+    HTCondorTodoItem, and use __slots__ to keep them small.
+    """
+
+    __slots__ = [
+        'cluster_id', 'proc_id', 'failurecount', 'stderr', 'stderr_file', 'classad',
+        'prev_state', 'new_state', 'queuestate', 'schedd', 'todoitem', '_history',
+        ]
+
     def __init__(self, cluster_id, proc_id):
         super(HTCondorJob, self).__init__()
         self.cluster_id = cluster_id
@@ -419,40 +839,36 @@ class HTCondorJob(object):
         self.failurecount = 0
         self.stderr = None
         self.classad = None
-        # Variables to keep track of what information is present for this job
-        self._isset_prev_state = False
-        self._isset_failurecount = False
-        self._isset_queuestate = False
-        self._isset_todoitem = False
-        self._iscalled_history = False
+        # None means not (yet) set
+        self.prev_state = None
+        self.new_state = None
+        self.queuestate = None
+        self.schedd = None
+        self.todoitem = None
 
     def set_parent_todoitem(self, todoitem):
         """
         Setter for the parent todoitem
         """
         self.todoitem = todoitem
-        self._isset_todoitem = True
 
     def set_prev_state(self, state):
         """
         Setter for the prev_state attribute
         """
         self.prev_state = state
-        self._isset_prev_state = True
 
     def set_failurecount(self, failurecount):
         """
         Setter for the failurecount attribute
         """
-        self.failurecount = failurecount
-        self._isset_failurecount = True
+        self.failurecount = int(failurecount)
 
     def set_queuestate(self, queuestate, classad):
         self.queuestate = queuestate
         self.classad = classad
         self.new_state = self.classad.state
         self.schedd = self.classad.schedd
-        self._isset_queuestate = True
 
     def __repr__(self):
         return super(HTCondorJob, self).__repr__().replace(
@@ -463,10 +879,6 @@ class HTCondorJob(object):
     def history(self):
         self._history = HTCondorClusterHistory.get(self.cluster_id, self.proc_id)
         return self._history
-        # if not self._iscalled_history:
-        #     self._history = cjm.utils.get_job_history_htcondor(self.cluster_id, self.proc_id)
-        #     self._iscalled_history = True
-        # return self._history
 
     def spec(self):
         return '{0}.{1}'.format(self.cluster_id, self.proc_id)
@@ -493,7 +905,7 @@ class HTCondorJob(object):
         else:
             logger.info('stderr_file %s looks like a relative path; finding submission_path', stderr_file)
             # Need the submission path from the parent; path to stderr is typically relative
-            if not self._isset_todoitem:
+            if self.todoitem is None:
                 logger.info('No parent todoitem set')
                 return
             if not getattr(self.todoitem, 'submission_path', None):
@@ -552,9 +964,14 @@ class HTCondorJob(object):
         """
         Returns the exitcode if the job's history could be retrieved,
         or -1000 if there is a history but there was no key ExitCode,
-        or -2000 if no history could be retrieved
+        or -2000 if no history could be retrieved.
+        A completed job that is still in the queue is not in the history yet, but
+        its queue classad has the ExitCode.
         """
-        history = self.history()
+        if self.classad and 'ExitCode' in self.classad:
+            history = self.classad
+        else:
+            history = self.history()
         if history:
             if 'ExitCode' in history:
                 exitcode = int(history['ExitCode'])
@@ -574,26 +991,170 @@ class HTCondorJob(object):
 
 class HTCondorQueueState(object):
     """docstring for HTCondorQueueState"""
+
+    # variables to get from job classad
+    projection = [
+        'ClusterId',
+        'ProcId',
+        'JobStatus',
+        'HoldReason',
+        'HoldReasonCode',
+        'HoldReasonSubCode',
+        'ExitCode',
+        'Err',
+        'ServerTime',
+        ]
+
+    @classmethod
+    def get_projection(cls, config):
+        """
+        Returns the projection for queries; the path of the job event log is only
+        needed for the eventlog update engine
+        """
+        if config.update_engine == 'eventlog': return cls.projection + [ 'UserLog' ]
+        return cls.projection
+
+    @staticmethod
+    def make_requirements(user, cluster_ids):
+        """
+        Returns the requirements string selecting the jobs of `user` in any of `cluster_ids`
+        """
+        return (
+            'Owner=="{0}" && ({1})'
+            .format(user, ' || '.join([ 'ClusterId=={0}'.format(c) for c in cluster_ids ]))
+            )
+
+    @classmethod
+    def read_batch(cls, cluster_ids, config=None, since=None):
+        """
+        Queries the queue for all clusters in `cluster_ids` at once (one query per
+        schedd rather than one per schedd per cluster), and splits the resulting
+        classads in memory into one HTCondorQueueState per cluster.
+        Returns a dict of cluster_id to HTCondorQueueState.
+
+        If `since` is a dict of schedd name to a ServerTime of a previous poll, only a
+        cheap listing of ids is done for all jobs, and the full projection is only
+        retrieved for jobs whose EnteredCurrentStatus is not older than that time
+        (delta mode). Schedds not in `since` get the full projection for all jobs.
+        """
+        config = cjm.CONFIG if config is None else config
+        queuestates = { cluster_id : cls(cluster_id, config=config) for cluster_id in cluster_ids }
+        if len(queuestates) == 0: return queuestates
+        # Classads report ClusterId as an int, the todo file as a str
+        by_int_id = { int(cluster_id) : qs for cluster_id, qs in queuestates.items() }
+        requirements = cls.make_requirements(config.user, sorted(by_int_id))
+        errors = []
+        poll_times = {}
+
+        def split_per_cluster(classads):
+            classads_per_cluster = { cluster_id : [] for cluster_id in by_int_id }
+            for classad in classads:
+                cluster_id = int(classad['ClusterId'])
+                if not cluster_id in classads_per_cluster:
+                    logger.warning('Batch query returned classad for untracked cluster %s', cluster_id)
+                    continue
+                classads_per_cluster[cluster_id].append(classad)
+                if 'ServerTime' in classad:
+                    name = config.get_schedd_name(classad.schedd)
+                    poll_times[name] = max(poll_times.get(name, 0), int(classad['ServerTime']))
+            return classads_per_cluster
+
+        # Local clock as a fallback for schedds that return no jobs at all (and thus no
+        # ServerTime); taken before querying, and corrected for possible clock skew
+        fallback_poll_time = int(time.time() - config.delta_polling_margin)
+
+        if since is None:
+            logger.info('Querying queue for %s clusters in one batch', len(by_int_id))
+            classads_per_cluster = split_per_cluster(cls.query(
+                config.schedds, projection=cls.get_projection(config), requirements=requirements,
+                errors=errors, config=config
+                ))
+        else:
+            logger.info('Querying queue for %s clusters in one batch (delta mode)', len(by_int_id))
+            # Cheap listing of all ids, to find out which jobs left the queue
+            listed_per_cluster = split_per_cluster(cls.query(
+                config.schedds, projection=['ClusterId', 'ProcId', 'ServerTime'],
+                requirements=requirements, errors=errors, config=config
+                ))
+            for cluster_id, classads in listed_per_cluster.items():
+                by_int_id[cluster_id].listed_proc_ids = set(c.proc_id for c in classads)
+                by_int_id[cluster_id].delta = True
+            # Full projection only for jobs that changed status since the previous poll
+            def delta_requirements(schedd):
+                last_poll_time = since.get(config.get_schedd_name(schedd), None)
+                if last_poll_time is None: return requirements
+                return '({0}) && EnteredCurrentStatus >= {1}'.format(requirements, last_poll_time)
+            classads_per_cluster = split_per_cluster(cls.query(
+                config.schedds, projection=cls.get_projection(config), requirements=delta_requirements,
+                errors=errors, config=config
+                ))
+
+        failed_schedds = [ schedd for schedd, e in errors ]
+        for schedd in config.schedds:
+            name = config.get_schedd_name(schedd)
+            if schedd in failed_schedds:
+                # In delta mode the listing may have succeeded while the delta query
+                # failed; the poll of this schedd must then not count as done
+                poll_times.pop(name, None)
+            elif not name in poll_times:
+                poll_times[name] = fallback_poll_time
+        for cluster_id, classads in classads_per_cluster.items():
+            by_int_id[cluster_id].fill(classads)
+            by_int_id[cluster_id].failed_schedds = failed_schedds
+            by_int_id[cluster_id].poll_times = poll_times
+        return queuestates
+
+    @staticmethod
+    def query(schedds, projection, requirements, errors=None, config=None):
+        """
+        Queries all `schedds` concurrently with the given projection and requirements.
+        `requirements` may also be a callable returning the requirements per schedd.
+        Yields an iterator of classads with a few helper attributes set, streaming
+        the results of each schedd as soon as it answers.
+        Schedds that fail or time out are appended to `errors` if it is a list.
+        """
+        def query_schedd(schedd):
+            logger.debug('Querying %s, xquery: %s', schedd, schedd.xquery)
+            return list(schedd.xquery(
+                requirements=requirements(schedd) if callable(requirements) else requirements,
+                projection=projection
+                ))
+
+        for schedd, classads in cjm.utils.fanout_schedds(
+                query_schedd, schedds, errors=errors, config=config, call='xquery'
+                ):
+            for classad in classads:
+                # Set a few helper attributes that are used often (saves querying the classad)
+                classad.schedd = schedd
+                classad.proc_id = int(classad['ProcId'])
+                classad.state = int(classad.get('JobStatus', -1))
+                logger.debug(
+                    'Got %s.%s at %s from query: %s',
+                    classad.__class__.__module__, classad.__class__.__name__, hex(id(classad)), classad
+                    )
+                yield classad
+
     def __init__(self, cluster_id, config=None):
         super(HTCondorQueueState, self).__init__()
         self.config = cjm.CONFIG if config is None else config
         self.cluster_id = cluster_id
-        # variables to get from job classad
-        self.projection = [
-            'ClusterId',
-            'ProcId',
-            'JobStatus',
-            'HoldReason',
-            'HoldReasonCode',
-            'HoldReasonSubCode',
-            'Err',
-            ]
+        self.projection = self.__class__.projection[:]
         self.requirements = (
             'Owner=="{0}" '
             '&& ClusterId=={1} '
             .format(self.config.user, self.cluster_id)
             )
         self._isread = False
+        # Schedds that could not be queried; if any, unlisted jobs are not conclusive
+        self.failed_schedds = []
+        # In delta mode, classads are only retrieved for jobs that changed status;
+        # the ids of all jobs in the queue are in listed_proc_ids
+        self.delta = False
+        self.listed_proc_ids = None
+        # ServerTime of this poll per schedd name
+        self.poll_times = {}
+        # Only set for queue states read from a job event log
+        self.userlog_offset = None
         self.classads = []
         self._classads_by_procid = {}
         self._classads_by_state = {}
@@ -601,36 +1162,30 @@ class HTCondorQueueState(object):
     def pformat(self):
         return self.__repr__()[:-1] + ' classads: ' + pprint.pformat(self._classads_by_state) + ' >'
 
-    def xquery(self, projection=None, requirements=None, schedd=None):
+    def xquery(self, projection=None, requirements=None, schedd=None, errors=None):
         """
         Queries the htcondor queue utility. Yields an iterator of classads
         """
         if projection is None: projection = self.projection
         if requirements is None: requirements = self.requirements
-        jobs = []
         # If the exact scheduler is known, just use it, but otherwise query all
         schedds = self.config.schedds if schedd is None else [schedd]
-        for schedd in schedds:
-            logger.debug('Querying %s, xquery: %s', schedd, schedd.xquery)
-            for classad in schedd.xquery(
-                requirements=self.requirements,
-                projection=self.projection
-                ):
-                # Set a few helper attributes that are used often (saves querying the classad)
-                classad.schedd = schedd
-                classad.proc_id = int(classad['ProcId'])
-                classad.state = int(classad.get('JobStatus', -1))
-                logger.debug(
-                    'Got %s.%s at %s from query: %s',
-                    classad.__class__.__module__, classad.__class__.__name__, hex(id(classad)), classad
-                    )
-                yield classad
+        return self.query(schedds, projection, requirements, errors=errors, config=self.config)
 
     def read(self):
         """
         Reads the state from the htcondor queue utility iterator
         """
-        self.classads = list(sorted(self.xquery(), key=lambda j: j.proc_id))
+        errors = []
+        self.fill(self.xquery(errors=errors))
+        self.failed_schedds = [ schedd for schedd, e in errors ]
+        return self
+
+    def fill(self, classads):
+        """
+        Fills the state from an iterable of classads (as yielded by `xquery`)
+        """
+        self.classads = list(sorted(classads, key=lambda j: j.proc_id))
         for classad in self.classads:
             self._classads_by_procid[classad.proc_id] = classad
             if not classad.state in self._classads_by_state: self._classads_by_state[classad.state] = []
@@ -655,11 +1210,207 @@ class HTCondorQueueState(object):
 
     def has_proc_id(self, proc_id):
         """
-        Checks whether a classad with proc_id is listed in this queue state.
+        Checks whether a job with proc_id is listed in this queue state.
         Returns boolean
         """
+        if self.delta: return proc_id in self.listed_proc_ids
+        return proc_id in self._classads_by_procid
+
+    def has_classad(self, proc_id):
+        """
+        Checks whether a classad was retrieved for proc_id. In delta mode, this is
+        only the case for jobs that changed status since the previous poll.
+        """
         return proc_id in self._classads_by_procid
 
+    def changed_proc_ids(self):
+        """
+        Returns the proc_ids for which a classad was retrieved
+        """
+        return list(self._classads_by_procid.keys())
+
+    def is_complete(self):
+        """
+        Returns True if all schedds answered, i.e. an unlisted job has really left the queue
+        """
+        return len(self.failed_schedds) == 0
+
+
+class DeferredAction(object):
+    """
+    A blocking side effect decided while processing a job, e.g. releasing it on its
+    schedd. The sync engine runs it right away; the asyncio engine collects the
+    actions of all clusters and runs them concurrently after processing.
+    """
+    def __init__(self, description, func, args=(), schedd=None):
+        super(DeferredAction, self).__init__()
+        self.description = description
+        self.func = func
+        self.args = args
+        self.schedd = schedd
+
+    def __repr__(self):
+        return '<DeferredAction {0}>'.format(self.description)
+
+    def run(self):
+        return self.func(*self.args)
+
+
+def run_actions(actions):
+    """
+    Runs DeferredActions one after another; the synchronous counterpart of
+    cjm.aio.run_actions, with the same return value
+    """
+    results = []
+    for action in actions:
+        try:
+            action.run()
+            results.append(None)
+        except Exception as e:
+            logger.error('%s failed: %s', action, e)
+            results.append(e)
+    return results
+
+
+class Resubmission(object):
+    """
+    The decision to release a held job with a new RequestMemory. Resubmissions are
+    applied in bulk by `apply_resubmissions`, which sets `applied`, or `error` if
+    it failed for this job.
+    """
+    def __init__(self, job, request_memory, details=None):
+        super(Resubmission, self).__init__()
+        self.job = job
+        self.request_memory = request_memory
+        self.details = details
+        self.applied = False
+        self.error = None
+
+    def __repr__(self):
+        return '<Resubmission {0} RequestMemory = {1}>'.format(self.job.spec(), self.request_memory)
+
+
+def apply_resubmissions(resubmissions, config=None):
+    """
+    Applies resubmissions in bulk: they are grouped per schedd and new RequestMemory,
+    and every group (of at most `config.resubmit_group_size` jobs) is edited and
+    released with one call each, selecting its jobs by a constraint. Schedds are
+    handled concurrently. If a call for a group fails, its jobs are retried one
+    by one, so that the outcome is known per job.
+    """
+    config = cjm.CONFIG if config is None else config
+    per_schedd = OrderedDict()
+    for resubmission in resubmissions:
+        if resubmission.job.schedd is None:
+            resubmission.error = ValueError('The schedd of job {0} is unknown'.format(resubmission.job))
+            continue
+        per_schedd.setdefault(id(resubmission.job.schedd), []).append(resubmission)
+    if len(per_schedd) == 0: return
+
+    def resubmit_on_schedd(schedd):
+        groups = OrderedDict()
+        for resubmission in per_schedd[id(schedd)]:
+            groups.setdefault(resubmission.request_memory, []).append(resubmission)
+        n = config.resubmit_group_size
+        for request_memory, group in groups.items():
+            for i in range(0, len(group), n):
+                release_with_memory(schedd, group[i:i+n], request_memory)
+
+    errors = []
+    schedds = [ group[0].job.schedd for group in per_schedd.values() ]
+    for schedd, result in cjm.utils.fanout_schedds(
+            resubmit_on_schedd, schedds, errors=errors, config=config, call='resubmit'
+            ):
+        pass
+    for schedd, e in errors:
+        for resubmission in per_schedd[id(schedd)]:
+            if not resubmission.applied and resubmission.error is None:
+                resubmission.error = e
+    n_failed = sum(1 for r in resubmissions if not r.applied)
+    logger.info(
+        'Resubmitted %s jobs on %s schedds (%s failed)',
+        len(resubmissions) - n_failed, len(per_schedd), n_failed
+        )
+
+def release_with_memory(schedd, resubmissions, request_memory):
+    """
+    Sets RequestMemory of the jobs of `resubmissions` on `schedd` and releases them,
+    with one edit and one act call. A single job is selected by its id, several by a
+    constraint. A constrained call does not fail if some of the jobs are missing or
+    not held anymore, so the number of released jobs is checked; if it falls short,
+    the jobs that are still held are retried one by one.
+    """
+    import htcondor
+    if len(resubmissions) == 1:
+        job_spec = resubmissions[0].job.spec()
+    else:
+        job_spec = cjm.utils.make_job_constraint([ (r.job.cluster_id, r.job.proc_id) for r in resubmissions ])
+    try:
+        schedd.edit(job_spec, 'RequestMemory', request_memory)
+        result = schedd.act(htcondor.JobAction.Release, job_spec)
+        # The bindings return a classad with the number of jobs per outcome
+        if not result is None and 'TotalSuccess' in result and int(result['TotalSuccess']) != len(resubmissions):
+            raise RuntimeError(
+                'Released {0} out of {1} jobs (not found: {2}, bad status: {3})'
+                .format(
+                    result['TotalSuccess'], len(resubmissions),
+                    result.get('TotalNotFound', '?'), result.get('TotalBadStatus', '?')
+                    )
+                )
+    except Exception as e:
+        if len(resubmissions) == 1:
+            resubmissions[0].error = e
+            return
+        logger.warning(
+            'Resubmitting %s jobs at once on %s failed (%s); retrying per job',
+            len(resubmissions), schedd, e
+            )
+        retry_release_per_job(schedd, resubmissions, request_memory, job_spec)
+        return
+    for resubmission in resubmissions:
+        resubmission.applied = True
+    logger.info(
+        'Released %s jobs on %s with RequestMemory = %s', len(resubmissions), schedd, request_memory
+        )
+
+def retry_release_per_job(schedd, resubmissions, request_memory, constraint):
+    """
+    Retries the jobs of a failed or partial bulk release one by one. Only jobs that
+    are idle or running with the new RequestMemory were released by the bulk call;
+    jobs that are still held are retried, and any other job (e.g. removed, or
+    released without the new RequestMemory) is marked as failed, so that it is
+    looked at again next cycle. If the jobs can not be queried, all are retried.
+    """
+    try:
+        ads = {
+            (int(ad['ClusterId']), int(ad['ProcId'])) : ad
+            for ad in schedd.xquery(
+                requirements=constraint, projection=['ClusterId', 'ProcId', 'JobStatus', 'RequestMemory']
+                )
+            }
+    except Exception as e:
+        logger.warning('Could not query the status of the jobs on %s (%s)', schedd, e)
+        ads = None
+    for resubmission in resubmissions:
+        job = resubmission.job
+        if ads is None:
+            release_with_memory(schedd, [ resubmission ], request_memory)
+            continue
+        ad = ads.get((int(job.cluster_id), int(job.proc_id)), None)
+        if ad is None:
+            resubmission.error = RuntimeError('Job {0} is not in the queue anymore'.format(job.spec()))
+            continue
+        status = int(ad['JobStatus'])
+        if status == 5:
+            release_with_memory(schedd, [ resubmission ], request_memory)
+        elif status in [ 1, 2 ] and int(ad.get('RequestMemory', -1)) == int(request_memory):
+            resubmission.applied = True
+        else:
+            resubmission.error = RuntimeError(
+                'Job {0} has JobStatus {1} and RequestMemory {2} instead of being released with {3}'
+                .format(job.spec(), status, ad.get('RequestMemory', '?'), request_memory)
+                )
+
 
 class HTCondorUpdater(object):
     """
@@ -667,21 +1418,59 @@ class HTCondorUpdater(object):
     current state of the htcondor queue (HTCondorQueueState).
     This class contains the main functionalities of this package.
     """
-    def __init__(self, todoitem, queuestate, email=None):
+    def __init__(self, todoitem, queuestate, email=None, defer_actions=False):
         super(HTCondorUpdater, self).__init__()
         self.todoitem = todoitem
         self.queuestate = queuestate
         # Create a new todoitem, starting out as just a copy
         self.new_todoitem = self.todoitem.copy()
         self.email = email
+        # If set, side effects are collected in `actions` and `resubmissions` instead
+        # of run during processing
+        self.defer_actions = defer_actions
+        self.actions = []
+        self.resubmissions = []
+        # Resubmissions that could not be applied; their jobs are retried next cycle
+        self.failed_resubmissions = []
+        # If set, jobs that need the history keep their state until the next cycle
+        self.history_unavailable = False
 
     def update(self):
+        """
+        Processes all jobs and returns the new todoitem. If actions are deferred, the
+        caller should apply them between `process_jobs` and `finish` instead.
+        """
+        self.fetch_history()
+        self.process_jobs()
+        return self.finish()
+
+    def fetch_history(self):
+        """
+        Retrieves the history needed to process the jobs of this todoitem in one go
+        """
+        proc_ids = self.history_proc_ids()
+        if len(proc_ids) == 0: return
+        cluster_id = self.todoitem.cluster_id
+        if cluster_id in HTCondorClusterHistory.prefetch([ cluster_id ], proc_ids={ cluster_id : proc_ids }):
+            self.history_unavailable = True
+
+    def process_jobs(self):
         logger.debug(
             'Constructing update for %s, %s',
             self.todoitem.section, self.todoitem.cluster_id
             )
-        for job in self.todoitem.jobs:
+        for job in self.jobs_to_process():
             self.process(job)
+
+    def finish(self):
+        """
+        Finalizes the new todoitem after all jobs were processed, and returns it
+        """
+        # Only kept for delta polling, so that an unchanged cluster otherwise stays unchanged
+        if self.queuestate.poll_times and cjm.CONFIG.delta_polling:
+            self.new_todoitem.last_poll = dict(self.todoitem.last_poll, **self.get_poll_times())
+        self.track_userlog()
+        if cjm.CONFIG.adaptive_polling: self.schedule_next_poll()
         self.new_todoitem.compute_status()
         logger.debug('Newly created todo item after update:')
         self.new_todoitem.debug_log()
@@ -691,6 +1480,124 @@ class HTCondorUpdater(object):
         self.email_event(cjm.EventCodes.monitoring, self.new_todoitem, old_todoitem=self.todoitem)
         return self.new_todoitem
 
+    def get_poll_times(self):
+        """
+        Returns the poll times to store for delta polling. A job whose resubmission
+        failed stays held without changing status, so the delta query would never
+        return it again; the poll time of its schedd is not advanced, so that the job
+        is processed (and its resubmission retried) in the next cycle.
+        """
+        poll_times = dict(self.queuestate.poll_times)
+        for resubmission in self.failed_resubmissions:
+            if resubmission.job.schedd is None: return {}
+            poll_times.pop(cjm.CONFIG.get_schedd_name(resubmission.job.schedd), None)
+        return poll_times
+
+    def track_userlog(self):
+        """
+        Keeps the offset up to which the job event log was read, or picks up the path
+        of the log from the polled classads if it is not known yet
+        """
+        if not self.queuestate.userlog_offset is None:
+            self.new_todoitem.userlog_offset = self.queuestate.userlog_offset
+        elif not self.new_todoitem.userlog:
+            for classad in self.queuestate.classads:
+                if classad.get('UserLog', None):
+                    logger.info('Found event log %s for %s', classad['UserLog'], self.new_todoitem.cluster_id)
+                    self.new_todoitem.userlog = classad['UserLog']
+                    self.new_todoitem.userlog_offset = 0
+                    break
+
+    def schedule_next_poll(self, now=None, config=None):
+        """
+        Sets the poll interval and next poll time of the new todoitem. The interval
+        drops to the minimum when jobs changed state (including new failures, which
+        also change the failure counts) or are held. Otherwise it backs off, capped the
+        lower the larger the fraction of running jobs; a cluster that is all idle
+        backs off up to the maximum.
+        """
+        config = cjm.CONFIG if config is None else config
+        now = time.time() if now is None else now
+        old, new = self.todoitem, self.new_todoitem
+        if (
+            not new.jobstates.same_states(old.jobstates)
+            or new.count_jobs_in_state('held') > 0
+            or not self.queuestate.is_complete()
+            ):
+            interval = config.poll_interval_min
+        else:
+            interval = (old.poll_interval or config.poll_interval_min) * config.poll_backoff
+            n_jobs = new.get_n_jobs()
+            if n_jobs > 0:
+                running_fraction = float(new.count_jobs_in_state('running')) / n_jobs
+                interval = min(interval, config.poll_interval_max * (1. - running_fraction))
+        interval = min(max(interval, config.poll_interval_min), config.poll_interval_max)
+        new.poll_interval = interval
+        new.next_poll = now + interval
+        logger.debug('Next poll of %s in %s s', new.cluster_id, interval)
+
+    def jobs_to_process(self):
+        """
+        Returns the jobs that need processing. Jobs in a terminal state (done or failed)
+        are never processed again. In delta mode only jobs that changed status, and
+        jobs that left the queue, are processed.
+        """
+        active_proc_ids = self.todoitem.active_proc_ids()
+        if not self.queuestate.delta:
+            proc_ids = active_proc_ids
+        else:
+            proc_ids = []
+            for proc_id in active_proc_ids:
+                if self.queuestate.has_classad(proc_id):
+                    proc_ids.append(proc_id)
+                elif not self.queuestate.has_proc_id(proc_id) and self.queuestate.is_complete():
+                    proc_ids.append(proc_id)
+        if self.history_unavailable:
+            needs_history = set(self.history_proc_ids())
+            if needs_history:
+                logger.warning(
+                    'No history for cluster %s; %s jobs keep their state until the next cycle',
+                    self.todoitem.cluster_id, len(needs_history)
+                    )
+                proc_ids = [ p for p in proc_ids if not p in needs_history ]
+        logger.info(
+            'Processing %s out of %s jobs for %s (%s in a terminal state)',
+            len(proc_ids), self.todoitem.get_n_jobs(), self.todoitem.cluster_id,
+            self.todoitem.get_n_jobs() - len(active_proc_ids)
+            )
+        return [ self.todoitem.get_job(p) for p in proc_ids ]
+
+    def history_proc_ids(self):
+        """
+        Returns the proc_ids for which processing will look up the history,
+        i.e. not yet finished jobs that are unlisted, or removed, held or suspended
+        in the queue. Jobs that are still in the queue are not in the history yet,
+        so completed jobs with an ExitCode in their classad and jobs held for
+        exceeding their memory (which are only resubmitted) are left out; otherwise
+        their cluster would be refetched every cycle.
+        """
+        proc_ids = []
+        # Works on the state store directly, to not create job instances
+        for proc_id in self.todoitem.active_proc_ids():
+            if not self.queuestate.has_proc_id(proc_id):
+                if self.queuestate.is_complete(): proc_ids.append(proc_id)
+                continue
+            if not self.queuestate.has_classad(proc_id): continue
+            classad = self.queuestate.get_classad(proc_id)
+            if classad.state == 4 and 'ExitCode' in classad:
+                continue
+            elif classad.state == 5 and int(classad.get('HoldReasonCode', -1)) == 34:
+                continue
+            elif classad.state in [3, 4, 5, 7]:
+                proc_ids.append(proc_id)
+        return proc_ids
+
+    def needs_history(self):
+        """
+        Returns True if processing this todoitem will look up the history of any job
+        """
+        return len(self.history_proc_ids()) > 0
+
     def email_event(self, event_code, todoitem, **kwargs):
         """
         If the HTCondorUpdater instance has an email attribute, this method
@@ -701,6 +1608,15 @@ class HTCondorUpdater(object):
         if not self.email: return
         self.email.make_event(event_code, todoitem, **kwargs)
 
+    def perform(self, action):
+        """
+        Runs a DeferredAction, or collects it if actions are deferred
+        """
+        if self.defer_actions:
+            self.actions.append(action)
+        else:
+            action.run()
+
     def message(self, job, msg):
         logger.debug(
             'Job %s: %s -> %s, %s',
@@ -714,7 +1630,10 @@ class HTCondorUpdater(object):
         marks noteworthy events for a potential email.
         """
         # Look for a matching classad in the retrieved queue state
-        if self.queuestate.has_proc_id(job.proc_id):
+        if self.queuestate.has_proc_id(job.proc_id) and not self.queuestate.has_classad(job.proc_id):
+            logger.debug('Job %s did not change status since the previous poll', job)
+            return
+        elif self.queuestate.has_proc_id(job.proc_id):
             classad = self.queuestate.get_classad(job.proc_id)
             job.set_queuestate(self.queuestate, classad)
             logger.info('Found matching classad %s for job %s', classad, job)
@@ -775,7 +1694,9 @@ class HTCondorUpdater(object):
             else:
                 self.permanent_failure(job)
         elif job.new_state == 'unlisted': # job is not in the queuestate
-            if job.prev_state == 'done' or job.prev_state == 'failed':
+            if not self.queuestate.is_complete():
+                self.message(job, 'unlisted but not all schedds answered, doing nothing')
+            elif job.prev_state == 'done' or job.prev_state == 'failed':
                 self.message(
                     job,
                     'unlisted and previous state was {0}, doing nothing'.format(job.prev_state)
@@ -792,7 +1713,7 @@ class HTCondorUpdater(object):
 
     def attempt_resubmission(self, job):
         logger.debug('Analyzing failure for job %s', job)
-        job.failurecount += 1
+        self.new_todoitem.increment_failurecount(job)
         if job.classad:
             if 'HoldReasonCode' in job.classad and int(job.classad['HoldReasonCode']) == 34:
                 used_memory = job.classad.get('MemoryUsage', '?')
@@ -804,28 +1725,66 @@ class HTCondorUpdater(object):
                     'Attempting to resubmit with twice as much memory: %s',
                     job, used_memory, request_memory, new_request_memory
                     )
-                job.schedd.edit(
-                    job.spec(),
-                    'RequestMemory', new_request_memory
-                    )
-                job.schedd.act(htcondor.JobAction.Release, job.spec())
-                logger.info('Made edit call the schedd %s', job.schedd)
-                self.new_todoitem.move(job, 'idle')
-                self.email_event(
-                    cjm.EventCodes.job_resubmitted,
-                    self.new_todoitem,
-                    job = job,
+                self.resubmit(Resubmission(
+                    job, new_request_memory,
                     details = (
                         'Resubmitted with RequestMemory = %s '
                         '(previously MemoryUsage = %s, RequestMemory = %s)',
                         new_request_memory, used_memory, request_memory
-                        ),
-                    current_resubmission_count = self.new_todoitem.total_resubmission_count
-                    )
-                self.new_todoitem.total_resubmission_count += 1
+                        )
+                    ))
                 return
         self.permanent_failure(job)
 
+    def resubmit(self, resubmission):
+        """
+        Applies a Resubmission right away, or collects it to be applied in bulk if
+        actions are deferred (see `finish_resubmissions`)
+        """
+        if self.defer_actions:
+            self.resubmissions.append(resubmission)
+        else:
+            apply_resubmissions([ resubmission ])
+            self.finish_resubmission(resubmission)
+
+    def finish_resubmissions(self):
+        """
+        Processes the outcome of the collected resubmissions, after they were applied
+        """
+        for resubmission in self.resubmissions:
+            self.finish_resubmission(resubmission)
+
+    def finish_resubmission(self, resubmission):
+        """
+        A resubmitted job moves to idle; if resubmitting failed, the job is still held
+        in the queue and its resubmission is attempted again next cycle
+        """
+        job = resubmission.job
+        if not resubmission.applied:
+            logger.error(
+                'Resubmission of job %s failed: %s; will be retried next cycle',
+                job, resubmission.error
+                )
+            self.new_todoitem.move(job, 'held')
+            self.failed_resubmissions.append(resubmission)
+            return
+        cjm.metrics.record_resubmission()
+        self.new_todoitem.move(job, 'idle')
+        self.email_event(
+            cjm.EventCodes.job_resubmitted,
+            self.new_todoitem,
+            job = job,
+            details = resubmission.details,
+            current_resubmission_count = self.new_todoitem.total_resubmission_count
+            )
+        self.new_todoitem.total_resubmission_count += 1
+
+    @staticmethod
+    def log_stderr(job):
+        stderr = job.get_stderr()
+        if stderr:
+            logger.info('Tail of %s:\n%s', job.stderr_file, stderr)
+
     def permanent_failure(self, job):
         self.message(job, 'failed with no resubmission options')
         history = job.history()
@@ -843,9 +1802,7 @@ class HTCondorUpdater(object):
                     key : job.classad[key] for key in cjm.CONFIG.interesting_history_keys if key in job.classad
                     })
                 )
-        stderr = job.get_stderr()
-        if stderr:
-            logger.info('Tail of %s:\n%s', job.stderr_file, stderr)
+        self.perform(DeferredAction('tail of stderr of job {0}'.format(job.spec()), self.log_stderr, (job,)))
         self.new_todoitem.move(job, 'failed')
         self.email_event(
             cjm.EventCodes.job_permanently_failed,
@@ -1,9 +1,8 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import os, shutil, logging, sys, subprocess, re
+import os, shutil, logging, sys, subprocess, re, time
 import os.path as osp
 import cjm
-from six import string_types
 logger = logging.getLogger('cjm')
 
 def _create_directory_no_checks(dirname, dry=False):
@@ -91,7 +90,7 @@ def run_command(cmd, env=None, dry=False, shell=False):
     logger.warning('Issuing command: {0}'.format(' '.join(cmd)))
     if dry: return
     if shell:
-        if not(isinstance(cmd, string_types)):
+        if not(isinstance(cmd, str)):
             cmd = ' '.join(cmd)
     process = subprocess.Popen(
         cmd,
@@ -118,6 +117,193 @@ def run_command(cmd, env=None, dry=False, shell=False):
         raise subprocess.CalledProcessError(cmd, returncode)
     return output
 
+def encode_ranges(ints):
+    """
+    Encodes integers as a compact string of ranges, e.g. [0,1,2,3,7] -> '0-3,7'
+
+    :param ints: Integers to encode; need not be sorted
+    :type ints: iterable
+    """
+    ints = sorted(set(ints))
+    if len(ints) == 0: return ''
+    parts = []
+    start = prev = ints[0]
+    for i in ints[1:]:
+        if i == prev + 1:
+            prev = i
+            continue
+        parts.append(str(start) if start == prev else '{0}-{1}'.format(start, prev))
+        start = prev = i
+    parts.append(str(start) if start == prev else '{0}-{1}'.format(start, prev))
+    return ','.join(parts)
+
+def decode_ranges(text):
+    """
+    Decodes a string of ranges as written by `encode_ranges` into a list of integers.
+    Plain comma-separated lists (the older todo file format) decode as well.
+
+    :param text: e.g. '0-3,7' or '0,1,2,3,7'
+    :type text: str
+    """
+    ints = []
+    for part in text.split(','):
+        part = part.strip()
+        if len(part) == 0: continue
+        if '-' in part:
+            start, end = part.split('-')
+            ints.extend(range(int(start), int(end)+1))
+        else:
+            ints.append(int(part))
+    return ints
+
+def encode_counts(counts):
+    """
+    Encodes a dict of integer to count as ranges sharing a count,
+    e.g. {0: 1, 1: 1, 2: 1, 5: 3} -> '0-2:1,5:3'
+    """
+    by_count = {}
+    for i, count in counts.items():
+        by_count.setdefault(int(count), []).append(int(i))
+    parts = []
+    for count, ints in by_count.items():
+        for part in encode_ranges(ints).split(','):
+            parts.append((int(part.split('-')[0]), '{0}:{1}'.format(part, count)))
+    return ','.join(part for start, part in sorted(parts))
+
+def decode_counts(text):
+    """
+    Decodes a string as written by `encode_counts` into a dict of integer to count.
+    The older format listing every 'integer:count' pair decodes as well.
+    """
+    counts = {}
+    for part in text.split(','):
+        part = part.strip()
+        if len(part) == 0: continue
+        ranges, count = part.split(':')
+        for i in decode_ranges(ranges):
+            counts[i] = int(count)
+    return counts
+
+class ScheddQueryError(Exception):
+    """
+    Raised (or collected) when a schedd did not answer a query in time or at all
+    """
+    pass
+
+def fanout_schedds(func, schedds=None, max_workers=None, timeout=None, errors=None, config=None, call='call'):
+    """
+    Calls `func(schedd)` for all schedds concurrently using a bounded thread pool
+    (or the asyncio engine, if `config.io_engine` is 'asyncio'), and yields
+    `(schedd, result)` pairs in the order in which the schedds answer.
+    The slowest schedd thus determines the latency, rather than the sum of all.
+
+    `func` should fully materialize its result (e.g. `list(schedd.xquery(...))`),
+    since lazy htcondor iterators would otherwise be consumed in the main thread.
+
+    The timeout applies per schedd, from the start of its call. A schedd that does not
+    answer in time is counted as failed, but its call can not be interrupted: the
+    worker thread keeps running, and since the threads of a ThreadPoolExecutor are
+    joined at interpreter exit, a hanging call still delays the exit of the process.
+
+    :param func: Callable taking a schedd as its only argument
+    :type func: callable
+    :param schedds: Schedds to query; defaults to all schedds in the config
+    :type schedds: list, optional
+    :param max_workers: Size of the thread pool; defaults to `config.schedd_pool_size`
+    :type max_workers: int, optional
+    :param timeout: Seconds to wait for a schedd; defaults to `config.schedd_timeout`
+    :type timeout: float, optional
+    :param errors: If a list is passed, failing schedds are appended as
+        `(schedd, exception)` pairs instead of raising a ScheddQueryError
+    :type errors: list, optional
+    :param call: Name of the call (e.g. 'xquery') under which the latency and the
+        received ads are recorded in the cycle metrics
+    :type call: str, optional
+    """
+    config = cjm.CONFIG if config is None else config
+    schedds = config.schedds if schedds is None else schedds
+    if max_workers is None: max_workers = config.schedd_pool_size
+    if timeout is None: timeout = config.schedd_timeout
+    if len(schedds) == 0: return
+    failures = []
+    if config.io_engine == 'asyncio':
+        answers = cjm.aio.fanout_schedds(func, schedds, timeout, failures, config=config)
+    else:
+        answers = _fanout_schedds_threads(func, schedds, max_workers, timeout, failures)
+    for schedd, result, dt in answers:
+        logger.debug('Schedd %s answered in %.2f s', schedd, dt)
+        cjm.metrics.record_schedd_call(call, config.get_schedd_name(schedd), dt, result)
+        yield schedd, result
+    for schedd, e in failures:
+        cjm.metrics.record_schedd_failure(call, config.get_schedd_name(schedd))
+    if failures:
+        # A failure may be due to an outdated cached schedd ad
+        config.mark_schedds_stale([ schedd for schedd, e in failures ])
+        if errors is None:
+            raise ScheddQueryError(
+                'Failed to query {0} schedd(s): {1}'
+                .format(len(failures), ', '.join(str(e) for s, e in failures))
+                )
+        errors.extend(failures)
+
+def _fanout_schedds_threads(func, schedds, max_workers, timeout, failures):
+    """
+    Thread pool implementation of `fanout_schedds`; yields `(schedd, result, seconds)`
+    and appends failing schedds to `failures`. Every schedd gets `timeout` seconds from
+    the moment its call starts, so time spent by the caller between yields does not
+    count, and every schedd ends up either yielded or in `failures`.
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    n_workers = max(1, min(max_workers, len(schedds)))
+    start_times = {}
+
+    def timed_call(i_schedd):
+        start_times[i_schedd] = time.time()
+        result = func(schedds[i_schedd])
+        return result, time.time() - start_times[i_schedd]
+
+    def timeout_error(schedd):
+        logger.error('Schedd %s did not answer within %s s', schedd, timeout)
+        return ScheddQueryError('Schedd {0} did not answer within {1} s'.format(schedd, timeout))
+
+    executor = ThreadPoolExecutor(max_workers=n_workers)
+    try:
+        futures = { executor.submit(timed_call, i) : i for i in range(len(schedds)) }
+        pending = set(futures)
+        n_hung = 0
+        while pending:
+            now = time.time()
+            deadlines = [ start_times[futures[f]] + timeout for f in pending if futures[f] in start_times ]
+            wait_time = max(0., min(deadlines) - now) if deadlines else timeout
+            done, not_done = wait(pending, timeout=wait_time, return_when=FIRST_COMPLETED)
+            # First everything that finished, also if it finished after its deadline
+            for future in done:
+                pending.discard(future)
+                schedd = schedds[futures[future]]
+                try:
+                    result, dt = future.result()
+                except Exception as e:
+                    logger.error('Query to schedd %s failed: %s', schedd, e)
+                    failures.append((schedd, e))
+                    continue
+                yield schedd, result, dt
+            now = time.time()
+            for future in list(pending):
+                i_schedd = futures[future]
+                if not future.done() and i_schedd in start_times and now - start_times[i_schedd] > timeout:
+                    pending.discard(future)
+                    n_hung += 1
+                    failures.append((schedds[i_schedd], timeout_error(schedds[i_schedd])))
+            if n_hung >= n_workers:
+                # All workers are blocked by hanging calls; queued calls would never start
+                for future in list(pending):
+                    if futures[future] in start_times: continue
+                    future.cancel()
+                    pending.discard(future)
+                    failures.append((schedds[futures[future]], timeout_error(schedds[futures[future]])))
+    finally:
+        executor.shutdown(wait=False)
+
 def get_job_history_htcondor(cluster_id, proc_id, schedd=None, projection=None):
     logger.debug('Getting history for job %s.%s, schedd %s', cluster_id, proc_id, schedd)
     import htcondor
@@ -149,7 +335,11 @@ def get_job_history_htcondor(cluster_id, proc_id, schedd=None, projection=None):
     else:
         return jobs[0]
 
-def get_cluster_history_htcondor(cluster_id, schedd=None, projection=None):
+def get_cluster_history_htcondor(cluster_id, schedd=None, projection=None, errors=None):
+    """
+    Gets the history of all jobs in a cluster. Schedds that fail or time out are
+    appended to `errors` if it is a list (see `fanout_schedds`).
+    """
     logger.debug('Getting history for cluster %s, schedd %s', cluster_id, schedd)
     import htcondor
     projection = [] if projection is None else projection
@@ -160,14 +350,43 @@ def get_cluster_history_htcondor(cluster_id, schedd=None, projection=None):
         schedds = [schedd]
     # Get jobs from all needed schedulers
     jobs = []
-    for schedd in schedds:
-        jobs.extend(list(schedd.history(
+    for schedd, history in fanout_schedds(
+        lambda schedd: list(schedd.history(
             requirements = 'ClusterId == {0}'.format(cluster_id),
             projection = projection,
-            )))
+            )),
+        schedds, errors=errors, call='history'
+        ):
+        jobs.extend(history)
     logger.info('Found %s jobs in history for cluster %s', len(jobs), cluster_id)
     return jobs
 
+def get_history_for_clusters_htcondor(cluster_ids, schedds=None, projection=None, errors=None):
+    """
+    Gets the history for all clusters in `cluster_ids` with a single history query
+    per schedd. Returns a dict of int cluster_id to list of history classads.
+    Schedds that fail or time out are appended to `errors` if it is a list.
+    """
+    cluster_ids = sorted(set(int(c) for c in cluster_ids))
+    jobs_per_cluster = { cluster_id : [] for cluster_id in cluster_ids }
+    if len(cluster_ids) == 0: return jobs_per_cluster
+    logger.debug('Getting history for clusters %s', cluster_ids)
+    projection = [] if projection is None else projection
+    requirements = ' || '.join([ 'ClusterId == {0}'.format(c) for c in cluster_ids ])
+    for schedd, history in fanout_schedds(
+        lambda schedd: list(schedd.history(requirements=requirements, projection=projection)),
+        schedds, errors=errors, call='history'
+        ):
+        for job in history:
+            cluster_id = int(job['ClusterId'])
+            if cluster_id in jobs_per_cluster:
+                jobs_per_cluster[cluster_id].append(job)
+    logger.info(
+        'Found %s jobs in history for %s clusters',
+        sum(len(jobs) for jobs in jobs_per_cluster.values()), len(cluster_ids)
+        )
+    return jobs_per_cluster
+
 
 def tail(file, n=10):
     """
@@ -185,8 +404,7 @@ def submit(command_line):
     condor_submit is wrapped on LPC, so for now keep this command
     line option rather than using the python config
     """
-    from six import string_types
-    if isinstance(command_line, string_types):
+    if isinstance(command_line, str):
         command_line = [command_line]
     if not command_line[0].startswith('condor_submit'):
         command_line.insert(0, 'condor_submit')
@@ -200,9 +418,49 @@ def submit(command_line):
     logger.info('Submitted %s jobs to cluster_id %s', n_jobs, cluster_id)
     return cluster_id, n_jobs, output
 
-def remove(cluster_id):
+def remove(cluster_ids):
+    """
+    Removes one or more clusters from the queue, with one call per schedd for all
+    clusters; the schedds are called concurrently
+
+    :param cluster_ids: A cluster_id, or a list of them
+    :type cluster_ids: str, int or list
+    """
     import htcondor
-    logger.info('Removing cluster_id %s from queue', cluster_id)
-    for schedd in cjm.CONFIG.schedds:
-        schedd.act(htcondor.JobAction.Remove, 'ClusterId=={0}'.format(cluster_id))
+    if not isinstance(cluster_ids, (list, tuple, set)): cluster_ids = [ cluster_ids ]
+    logger.info('Removing cluster_ids %s from queue', cluster_ids)
+    constraint = ' || '.join('ClusterId=={0}'.format(c) for c in cluster_ids)
+    for schedd, result in fanout_schedds(
+            lambda schedd: schedd.act(htcondor.JobAction.Remove, constraint), call='remove'
+            ):
+        logger.info('Remove call to %s returned %s', schedd, result)
+
+def make_job_constraint(job_ids):
+    """
+    Returns a constraint selecting exactly the jobs in `job_ids`, with consecutive
+    proc_ids selected as a range, e.g. [(1, 0), (1, 1), (1, 2), (1, 5)] ->
+    '(ClusterId == 1 && ((ProcId >= 0 && ProcId <= 2) || ProcId == 5))'
+
+    :param job_ids: (cluster_id, proc_id) pairs
+    :type job_ids: iterable
+    """
+    proc_ids_per_cluster = {}
+    for cluster_id, proc_id in job_ids:
+        proc_ids_per_cluster.setdefault(int(cluster_id), set()).add(int(proc_id))
+    clauses = []
+    for cluster_id in sorted(proc_ids_per_cluster):
+        proc_ids = sorted(proc_ids_per_cluster[cluster_id])
+        selections = []
+        start = prev = proc_ids[0]
+        for proc_id in proc_ids[1:] + [ None ]:
+            if proc_id is not None and proc_id == prev + 1:
+                prev = proc_id
+                continue
+            if start == prev:
+                selections.append('ProcId == {0}'.format(start))
+            else:
+                selections.append('(ProcId >= {0} && ProcId <= {1})'.format(start, prev))
+            start = prev = proc_id
+        clauses.append('(ClusterId == {0} && ({1}))'.format(cluster_id, ' || '.join(selections)))
+    return ' || '.join(clauses)
 
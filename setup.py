@@ -10,10 +10,13 @@ setup(
     author        = 'Thomas Klijnsma',
     author_email  = 'tklijnsm@gmail.com',
     packages      = ['cjm'],
+    # Module-level __getattr__ (PEP 562) for the lazy imports in cjm/__init__.py
+    python_requires = '>=3.7',
     zip_safe      = False,
     # tests_require = ['nose'],
     # test_suite    = 'nose.collector',
     scripts       = [
+        'bin/cjm-daemon',
         'bin/cjm-ls',
         'bin/cjm-submit',
         'bin/cjm-update',
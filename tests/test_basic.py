@@ -1,9 +1,6 @@
 from unittest import TestCase
-try:
-    from mock import Mock, MagicMock, patch
-except ImportError:
-    from unittest.mock import Mock, MagicMock, patch
-import logging, os, sys, copy, tempfile, glob
+from unittest.mock import Mock, MagicMock, patch
+import logging, os, sys, copy, tempfile, glob, time
 import os.path as osp
 
 
@@ -87,7 +84,18 @@ class TestHTCondorMockSetup(TestCase):
 class TestBasic(TestHTCondorMockSetup):
 
     def test_imported_htcondor_is_mock(self):
-        self.assertIsInstance(cjm.todo.htcondor, MagicMock)
+        # htcondor is imported on first use, so check the schedd handles it created
+        self.assertIsInstance(cjm.CONFIG.schedds[0], MagicMock)
+
+    def test_import_is_lazy(self):
+        import subprocess
+        out = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys, cjm; '
+            'print(sorted(m for m in ["htcondor", "cjm.todo", "cjm.config"] if m in sys.modules)); '
+            'print("CONFIG" in vars(cjm))'
+            ], cwd=osp.dirname(tests_dir), env=dict(os.environ, CJM_CONF='test'))
+        self.assertEqual(out.decode().split(), ['[]', 'False'])
 
     def test_mocked_schedd_returns_fake_ad(self):
         qstate = cjm.HTCondorQueueState('63826560')
@@ -95,6 +103,17 @@ class TestBasic(TestHTCondorMockSetup):
         cjm.logger.info('htcondor.Schedd.xquery: %s', htcondor.Schedd.xquery)
         self.assertEqual(str(jobs[0]['ClusterId']), '63826560')
 
+    def test_batch_queuestate_splits_per_cluster(self):
+        other_ad = FakeClassAd(self.ads[1])
+        other_ad['ClusterId'] = 63826561
+        htcondor.Schedd.return_value.xquery.return_value = self.ads + [other_ad]
+        queuestates = cjm.HTCondorQueueState.read_batch(['63826560', '63826561'])
+        self.assertEqual(len(queuestates['63826560'].classads), 2)
+        self.assertEqual(len(queuestates['63826561'].classads), 1)
+        self.assertTrue(queuestates['63826561'].has_proc_id(0))
+        requirements = htcondor.Schedd.return_value.xquery.call_args[1]['requirements']
+        self.assertIn('ClusterId==63826560 || ClusterId==63826561', requirements)
+
     def test_todo_item_reading(self):
         self.todoitem.debug_log()
         self.assertEqual(self.todoitem.all, [0, 1])
@@ -104,16 +123,102 @@ class TestBasic(TestHTCondorMockSetup):
         diff = cjm.HTCondorUpdater(self.todoitem, qstate)
         diff.update()
 
+    def test_history_not_needed_for_jobs_still_in_queue(self):
+        self.ads[0]['HoldReasonCode'] = 34
+        self.ads[1]['JobStatus'] = 4
+        self.ads[1]['ExitCode'] = 0
+        qstate = cjm.HTCondorQueueState('63826560').read()
+        updater = cjm.HTCondorUpdater(self.todoitem, qstate)
+        self.assertEqual(updater.history_proc_ids(), [])
+        self.ads[0]['HoldReasonCode'] = 3
+        qstate = cjm.HTCondorQueueState('63826560').read()
+        self.assertEqual(cjm.HTCondorUpdater(self.todoitem, qstate).history_proc_ids(), [1])
+
+    def test_get_job_normalizes_proc_id(self):
+        self.assertIs(self.todoitem.get_job('1'), self.todoitem.get_job(1))
+
     def test_get_history(self):
         history = cjm.utils.get_job_history_htcondor(cluster_id='9999', proc_id='9', schedd=htcondor.Schedd())
         self.assertEqual(history['JobStatus'], 5)
 
+    def test_history_prefetch_is_one_query_for_all_clusters(self):
+        schedd = htcondor.Schedd.return_value
+        schedd.history.reset_mock()
+        schedd.history.return_value = [
+            FakeClassAd(ClusterId=1001, ProcId=0, ExitCode=0),
+            FakeClassAd(ClusterId=1002, ProcId=3, ExitCode=1),
+            ]
+        cjm.todo.HTCondorClusterHistory.prefetch(['1001', '1002'])
+        self.assertEqual(schedd.history.call_count, 1)
+        self.assertEqual(cjm.todo.HTCondorClusterHistory.get('1002', 3)['ExitCode'], 1)
+        self.assertEqual(schedd.history.call_count, 1)
+
+    def test_history_cache_is_bounded_and_counts_hits(self):
+        History = cjm.todo.HTCondorClusterHistory
+        History.clear()
+        try:
+            History.max_clusters = 2
+            for cluster_id in ['2001', '2002', '2003']:
+                History(cluster_id, jobs=[FakeClassAd(ClusterId=int(cluster_id), ProcId=0)])
+            self.assertFalse(History.is_cached('2001'))
+            self.assertEqual(History.get('2003', 0)['ClusterId'], 2003)
+            self.assertIsNone(History.get('2003', 1))
+            self.assertEqual(History.stats()['hits'], 2)
+            self.assertEqual(History.stats()['clusters'], 2)
+        finally:
+            History.max_clusters = 500
+            History.clear()
+
+    def test_history_prefetch_refetches_outdated_cluster(self):
+        # In a long-running process, jobs may finish after their cluster's history was cached
+        History = cjm.todo.HTCondorClusterHistory
+        History.clear()
+        try:
+            History('3001', jobs=[FakeClassAd(ClusterId=3001, ProcId=0, ExitCode=0)])
+            self.assertTrue(History.is_cached('3001', [0]))
+            self.assertFalse(History.is_cached('3001', [0, 1]))
+            schedd = htcondor.Schedd.return_value
+            schedd.history.return_value = [
+                FakeClassAd(ClusterId=3001, ProcId=0, ExitCode=0),
+                FakeClassAd(ClusterId=3001, ProcId=1, ExitCode=1),
+                ]
+            History.prefetch(['3001'], proc_ids={ '3001' : [1] })
+            self.assertEqual(History.get('3001', 1)['ExitCode'], 1)
+        finally:
+            History.clear()
+
     def test_copy_todo_item_is_shallow_for_job_instances(self):
-        self.todoitem.jobs[0].testlist = ['test']
+        self.todoitem.jobs[0].stderr = ['test']
         new_todoitem = self.todoitem.copy()
         self.assertIsNot(self.todoitem.jobs, new_todoitem.jobs)
         self.assertIs(self.todoitem.jobs[0], new_todoitem.jobs[0])
-        self.assertIs(self.todoitem.jobs[0].testlist, new_todoitem.jobs[0].testlist)
+        self.assertIs(self.todoitem.jobs[0].stderr, new_todoitem.jobs[0].stderr)
+
+    def test_parse_todoitem_writes_ranges(self):
+        self.todoitem.increment_failurecount(self.todoitem.jobs[1])
+        self.todoitem.increment_failurecount(self.todoitem.jobs[1])
+        parsed = self.todoitem.parse_todoitem()
+        self.assertEqual(parsed['all'], '0-1')
+        self.assertEqual(parsed['idle'], '0-1')
+        self.assertEqual(parsed['failurecounts'], '1:2')
+        reread = cjm.HTCondorTodoItem.from_section('test', parsed)
+        self.assertEqual(reread.get_job(1).failurecount, 2)
+
+    def test_copy_todo_item_states_are_independent(self):
+        new_todoitem = self.todoitem.copy()
+        new_todoitem.move(new_todoitem.get_job(0), 'done')
+        self.assertEqual(new_todoitem.count_jobs_in_state('done'), 1)
+        self.assertEqual(self.todoitem.count_jobs_in_state('done'), 0)
+        self.assertEqual(self.todoitem.get_state(0), 'idle')
+        self.assertFalse(hasattr(cjm.todo.HTCondorJob, '__deepcopy__'))
+
+    def test_jobs_are_created_lazily(self):
+        self.assertEqual(len(self.todoitem._jobs_by_procid), 0)
+        job = self.todoitem.jobs[1]
+        self.assertEqual(list(self.todoitem._jobs_by_procid), [1])
+        self.assertEqual(job.prev_state, 'idle')
+        self.assertIs(job, self.todoitem.get_job(1))
+        self.assertFalse(hasattr(job, '__dict__'))
 
     def test_move_job(self):
         job = self.todoitem.jobs[0]
@@ -166,6 +271,136 @@ class TestDiff(TestHTCondorMockSetup):
         new_todoitem = diff.update()
         self.assertEqual(new_todoitem.get_jobs_in_state('failed')[0].proc_id, ad['ProcId'])
 
+    def test_delta_poll_keeps_last_poll_if_delta_query_fails(self):
+        name = cjm.CONFIG.schedd_names[0]
+        self.todoitem_dict['last_poll'] = '{0}:1576279000'.format(name)
+        self.todoitem = cjm.HTCondorTodoItem.from_section('test', self.todoitem_dict)
+        def xquery(requirements, projection):
+            if 'EnteredCurrentStatus' in requirements:
+                raise RuntimeError('schedd went away')
+            return [ FakeClassAd(ad) for ad in self.ads ]
+        schedd = htcondor.Schedd.return_value
+        schedd.xquery.side_effect = xquery
+        try:
+            since = cjm.TodoList.get_delta_since([self.todoitem])
+            qstate = cjm.HTCondorQueueState.read_batch(['63826560'], since=since)['63826560']
+            self.assertFalse(qstate.is_complete())
+            self.assertNotIn(name, qstate.poll_times)
+            cjm.CONFIG.delta_polling = True
+            new_todoitem = cjm.HTCondorUpdater(self.todoitem, qstate).update()
+        finally:
+            schedd.xquery.side_effect = None
+            cjm.CONFIG.delta_polling = False
+        self.assertEqual(new_todoitem.last_poll[name], 1576279000)
+
+    def test_delta_poll_processes_only_changed_jobs(self):
+        name = cjm.CONFIG.schedd_names[0]
+        self.todoitem_dict['last_poll'] = '{0}:1576279000'.format(name)
+        self.todoitem = cjm.HTCondorTodoItem.from_section('test', self.todoitem_dict)
+        self.ads[0]['JobStatus'] = 3 # proc 1 was removed, proc 0 is unchanged
+        def xquery(requirements, projection):
+            if 'EnteredCurrentStatus' in requirements:
+                self.assertIn('EnteredCurrentStatus >= 1576279000', requirements)
+                return [ FakeClassAd(self.ads[0]) ]
+            return [ FakeClassAd(ad) for ad in self.ads ]
+        schedd = htcondor.Schedd.return_value
+        schedd.xquery.side_effect = xquery
+        try:
+            since = cjm.TodoList.get_delta_since([self.todoitem])
+            qstate = cjm.HTCondorQueueState.read_batch(['63826560'], since=since)['63826560']
+            diff = cjm.HTCondorUpdater(self.todoitem, qstate)
+            self.assertEqual([ j.proc_id for j in diff.jobs_to_process() ], [1])
+            cjm.CONFIG.delta_polling = True
+            new_todoitem = diff.update()
+        finally:
+            schedd.xquery.side_effect = None
+            cjm.CONFIG.delta_polling = False
+        self.assertEqual(new_todoitem.get_state(0), 'idle')
+        self.assertEqual(new_todoitem.get_state(1), 'failed')
+        self.assertEqual(new_todoitem.last_poll[name], 1576279735)
+        self.assertIn('last_poll', new_todoitem.parse_todoitem())
+
+    def test_adaptive_poll_interval(self):
+        self.todoitem_dict['poll_interval'] = '600'
+        self.todoitem = cjm.HTCondorTodoItem.from_section('test', self.todoitem_dict)
+        qstate, diff = self.get_basic_diff()
+        # No transitions: back off, capped because half of the jobs run
+        for todoitem in [ diff.todoitem, diff.new_todoitem ]:
+            todoitem.jobstates.set_state(0, 'running')
+        diff.schedule_next_poll(now=1000.)
+        self.assertEqual(diff.new_todoitem.poll_interval, 1200.)
+        self.assertEqual(diff.new_todoitem.next_poll, 2200.)
+        self.assertFalse(diff.new_todoitem.is_due(now=2000.))
+        diff.todoitem.poll_interval = 3000.
+        diff.schedule_next_poll(now=1000.)
+        self.assertEqual(diff.new_todoitem.poll_interval, cjm.CONFIG.poll_interval_max / 2)
+        # A transition tightens the interval
+        diff.new_todoitem.jobstates.set_state(1, 'running')
+        diff.schedule_next_poll(now=1000.)
+        self.assertEqual(diff.new_todoitem.poll_interval, cjm.CONFIG.poll_interval_min)
+
+    def test_idle_cluster_backs_off(self):
+        self.todoitem_dict['poll_interval'] = '600'
+        self.todoitem = cjm.HTCondorTodoItem.from_section('test', self.todoitem_dict)
+        qstate, diff = self.get_basic_diff()
+        diff.schedule_next_poll(now=1000.)
+        self.assertEqual(diff.new_todoitem.poll_interval, 1200.)
+        diff.todoitem.poll_interval = 3000.
+        diff.schedule_next_poll(now=1000.)
+        self.assertEqual(diff.new_todoitem.poll_interval, cjm.CONFIG.poll_interval_max)
+
+    def test_held_or_failed_jobs_shorten_poll_interval(self):
+        self.todoitem_dict['poll_interval'] = '3000'
+        self.todoitem = cjm.HTCondorTodoItem.from_section('test', self.todoitem_dict)
+        qstate, diff = self.get_basic_diff()
+        # A job that stays held
+        for todoitem in [ diff.todoitem, diff.new_todoitem ]:
+            todoitem.jobstates.set_state(0, 'held')
+        diff.schedule_next_poll(now=1000.)
+        self.assertEqual(diff.new_todoitem.poll_interval, cjm.CONFIG.poll_interval_min)
+        # A job that failed and was resubmitted, so its state is unchanged
+        qstate, diff = self.get_basic_diff()
+        diff.new_todoitem.jobstates.set_failurecount(0, 1)
+        diff.schedule_next_poll(now=1000.)
+        self.assertEqual(diff.new_todoitem.poll_interval, cjm.CONFIG.poll_interval_min)
+        # A job that failed permanently
+        qstate, diff = self.get_basic_diff()
+        diff.new_todoitem.jobstates.set_state(1, 'failed')
+        diff.schedule_next_poll(now=1000.)
+        self.assertEqual(diff.new_todoitem.poll_interval, cjm.CONFIG.poll_interval_min)
+
+    def test_clusters_not_due_are_not_queried(self):
+        self.todoitem_dict['next_poll'] = str(int(time.time()) + 1000)
+        todolist = cjm.TodoList(_dict={ '63826560' : self.todoitem_dict })
+        todolist.todofile = None
+        cjm.CONFIG.adaptive_polling = True
+        try:
+            with patch.object(cjm.HTCondorQueueState, 'read_batch', return_value={}) as read_batch, \
+                    patch.object(todolist, 'write') as write:
+                todolist.update()
+        finally:
+            cjm.CONFIG.adaptive_polling = False
+        self.assertEqual(read_batch.call_args[0][0], [])
+        self.assertEqual(dict(write.call_args[0][0]['63826560']), self.todoitem_dict)
+
+    def test_terminal_jobs_are_not_processed(self):
+        self.todoitem_dict['idle'] = '1'
+        self.todoitem_dict['done'] = '0'
+        self.todoitem = cjm.HTCondorTodoItem.from_section('test', self.todoitem_dict)
+        qstate, diff = self.get_basic_diff()
+        self.assertEqual([ j.proc_id for j in diff.jobs_to_process() ], [1])
+        diff.update()
+        self.assertNotIn(0, self.todoitem._jobs_by_procid)
+
+    def test_jobs_without_state_are_processed(self):
+        # Job 0 is listed in 'all' only
+        self.todoitem_dict['idle'] = '1'
+        self.todoitem = cjm.HTCondorTodoItem.from_section('test', self.todoitem_dict)
+        self.assertEqual(self.todoitem.active_proc_ids(), [0, 1])
+        qstate, diff = self.get_basic_diff()
+        new_todoitem = diff.update()
+        self.assertEqual(new_todoitem.get_state(0), 'running')
+
     def test_is_finished(self):
         del self.todoitem_dict['idle']
         self.todoitem_dict['done'] = '0'
@@ -185,6 +420,198 @@ class TestDiff(TestHTCondorMockSetup):
         self.assertTrue(new_todoitem.is_finished()['finished'])
 
 
+class TestJobStateStore(TestCase):
+
+    states = ['idle', 'running', 'done', 'failed']
+
+    def test_counts_follow_moves(self):
+        store = cjm.jobstates.JobStateStore(self.states, range(10))
+        store.set_states(range(10), 'idle')
+        store.set_state(3, 'done')
+        store.set_state(3, 'done')
+        store.set_state(7, 'failed')
+        self.assertEqual(store.count('idle'), 8)
+        self.assertEqual(store.count('done'), 1)
+        self.assertEqual(store.proc_ids_in_state('failed'), [7])
+        self.assertEqual(store.get_state(3), 'done')
+
+    def test_non_contiguous_proc_ids(self):
+        store = cjm.jobstates.JobStateStore(self.states, [5, 2, 100])
+        self.assertEqual(store.proc_ids, [2, 5, 100])
+        store.set_state(100, 'running')
+        self.assertEqual(store.proc_ids_in_state('running'), [100])
+        self.assertIsNone(store.get_state(5))
+        self.assertNotIn(6, store)
+        with self.assertRaises(KeyError):
+            store.set_state(6, 'idle')
+
+
+class TestHistoryStore(TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        self.store = cjm.history.HistoryStore(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        os.remove(self.path)
+
+    def test_stores_only_terminal_jobs(self):
+        self.store.put([
+            FakeClassAd(ClusterId=10, ProcId=0, JobStatus=4, ExitCode=0),
+            FakeClassAd(ClusterId=10, ProcId=1, JobStatus=5, HoldReasonCode=34),
+            ])
+        self.assertEqual(self.store.get(10, 0)['ExitCode'], 0)
+        self.assertIsNone(self.store.get(10, 1))
+        self.assertTrue(self.store.has_all('10', [0]))
+        self.assertFalse(self.store.has_all('10', [0, 1]))
+
+    def test_prune_removes_untracked_clusters(self):
+        self.store.put([
+            FakeClassAd(ClusterId=10, ProcId=0, JobStatus=4, ExitCode=0),
+            FakeClassAd(ClusterId=11, ProcId=0, JobStatus=4, ExitCode=0),
+            ])
+        self.store.prune(['11'])
+        self.assertIsNone(self.store.get(10, 0))
+        self.assertIsNotNone(self.store.get(11, 0))
+
+
+class TestStorage(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = cjm.todo.configparser.ConfigParser()
+        self.config.read_dict({
+            '1' : { 'cluster_id' : '1', 'all' : '0-9', 'idle' : '0-9' },
+            '2' : { 'cluster_id' : '2', 'all' : '0-4', 'done' : '0-4' },
+            })
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def count_writes(self, storage, config):
+        with patch('cjm.storage.atomic_write', wraps=cjm.storage.atomic_write) as mock_write:
+            storage.save(config)
+            return mock_write.call_count
+
+    def test_ini_storage_skips_unchanged_write(self):
+        path = osp.join(self.tmpdir, 'todo')
+        storage = cjm.storage.INIFileStorage(path)
+        self.assertEqual(self.count_writes(storage, self.config), 1)
+        reloaded = cjm.storage.INIFileStorage(path)
+        self.assertEqual(reloaded.load()['1']['idle'], '0-9')
+        self.assertEqual(self.count_writes(reloaded, self.config), 0)
+        self.assertEqual(glob.glob(osp.join(self.tmpdir, '.*')), [])
+
+    def test_sharded_storage_writes_changed_clusters_only(self):
+        path = osp.join(self.tmpdir, 'todo.d')
+        storage = cjm.storage.ShardedStorage(path)
+        self.assertEqual(self.count_writes(storage, self.config), 2)
+        storage = cjm.storage.ShardedStorage(path)
+        self.assertEqual(sorted(storage.load()), ['1', '2'])
+        self.config['1']['idle'] = '0-8'
+        self.config['1']['running'] = '9'
+        self.config.remove_section('2')
+        self.assertEqual(self.count_writes(storage, self.config), 1)
+        self.assertEqual(sorted(os.listdir(path)), ['1.todo'])
+
+
+    def test_sqlite_storage_roundtrip_and_row_updates(self):
+        storage = cjm.storage.SQLiteStorage(osp.join(self.tmpdir, 'todo.sqlite'))
+        self.assertFalse(storage.is_initialized())
+        self.config['1']['failurecounts'] = '3:1'
+        storage.save(self.config)
+        storage = cjm.storage.SQLiteStorage(osp.join(self.tmpdir, 'todo.sqlite'))
+        sections = storage.load()
+        self.assertEqual(sections['1']['idle'], '0-9')
+        self.assertEqual(sections['1']['failurecounts'], '3:1')
+        self.assertEqual(sections['2']['done'], '0-4')
+        self.config['1']['idle'] = '0-8'
+        self.config['1']['running'] = '9'
+        with patch.object(storage, 'connection', wraps=storage.connection) as connection:
+            storage.save(self.config)
+            rows = [ c[0][1] for c in connection.executemany.call_args_list ]
+        self.assertEqual(rows, [[('1', 9, 'running', 0)]])
+
+    def test_sqlite_storage_keeps_finished_jobs_in_cluster_row(self):
+        path = osp.join(self.tmpdir, 'todo.sqlite')
+        storage = cjm.storage.SQLiteStorage(path)
+        self.config['1']['idle'] = '0-8'
+        self.config['1']['done'] = '9'
+        self.config['1']['failurecounts'] = '3:1,9:2'
+        storage.save(self.config)
+        n_rows = storage.connection.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
+        self.assertEqual(n_rows, 9)
+        section = cjm.storage.SQLiteStorage(path).load()['1']
+        self.assertEqual(section['all'], '0-9')
+        self.assertEqual(section['done'], '9')
+        self.assertEqual(section['failurecounts'], '3:1,9:2')
+
+    def test_submit_adds_section(self):
+        todofile = osp.join(self.tmpdir, 'todo')
+        cjm.storage.INIFileStorage(todofile).save(self.config)
+        with patch('cjm.utils.submit', return_value=(3, 5, [])):
+            cluster_id, todolist = cjm.TodoList(todofile).submit(['job.jdl'])
+        self.assertEqual(sorted(todolist.get_section_titles()), ['1', '2', '3'])
+        self.assertEqual(todolist.todo['3']['idle'], '0-4')
+        # The submission only went to the journal; writing folds it in and compacts
+        self.assertEqual(sorted(cjm.storage.INIFileStorage(todofile).load()), ['1', '2'])
+        todolist.write()
+        self.assertEqual(sorted(cjm.storage.INIFileStorage(todofile).load()), ['1', '2', '3'])
+        self.assertEqual(os.path.getsize(todofile + '.journal'), 0)
+
+    def test_submit_does_not_load_todo_list(self):
+        todofile = osp.join(self.tmpdir, 'todo')
+        with patch('cjm.utils.submit', return_value=(3, 5, [])), \
+                patch('cjm.storage.SQLiteStorage.load') as load, \
+                patch('cjm.storage.INIFileStorage.load') as ini_load:
+            cluster_id = cjm.todo.submit(['job.jdl'], todofile=todofile)
+        self.assertEqual(cluster_id, 3)
+        load.assert_not_called()
+        ini_load.assert_not_called()
+        self.assertFalse(osp.exists(todofile))
+        records, offset = cjm.journal.SubmissionJournal(todofile + '.journal').read()
+        self.assertEqual([ title for title, section in records ], ['3'])
+
+    def test_journal_compaction_keeps_later_appends(self):
+        journal = cjm.journal.SubmissionJournal(osp.join(self.tmpdir, 'todo.journal'))
+        journal.append('1', { 'cluster_id' : '1' })
+        records, offset = journal.read()
+        journal.append('2', { 'cluster_id' : '2' })
+        journal.compact(offset)
+        self.assertEqual(records, [('1', { 'cluster_id' : '1' })])
+        self.assertEqual(journal.read()[0], [('2', { 'cluster_id' : '2' })])
+
+    def test_read_plain_uses_storage(self):
+        todofile = osp.join(self.tmpdir, 'todo')
+        cjm.storage.SQLiteStorage(todofile + '.sqlite').save(self.config)
+        _todo_storage = cjm.CONFIG.todo_storage
+        try:
+            cjm.CONFIG.todo_storage = 'sqlite'
+            plain = cjm.TodoList(todofile).read_plain()
+        finally:
+            cjm.CONFIG.todo_storage = _todo_storage
+        config = cjm.todo.configparser.ConfigParser()
+        config.read_string(plain)
+        self.assertEqual(config.sections(), ['1', '2'])
+        self.assertEqual(config['2']['done'], '0-4')
+
+    def test_sqlite_storage_migrates_ini_file(self):
+        todofile = osp.join(self.tmpdir, 'todo')
+        cjm.storage.INIFileStorage(todofile).save(self.config)
+        _todo_storage = cjm.CONFIG.todo_storage
+        try:
+            cjm.CONFIG.todo_storage = 'sqlite'
+            todolist = cjm.TodoList(todofile)
+        finally:
+            cjm.CONFIG.todo_storage = _todo_storage
+        self.assertIsInstance(todolist.storage, cjm.storage.SQLiteStorage)
+        self.assertEqual(sorted(todolist.get_section_titles()), ['1', '2'])
+        self.assertEqual(todolist.todo['2']['done'], '0-4')
+
+
 class TestTodoList(TestHTCondorMockSetup):
     """docstring for TestTodoList"""
 
@@ -200,6 +627,430 @@ class TestTodoList(TestHTCondorMockSetup):
         
 
 
+class TodoFileSetup(TestHTCondorMockSetup):
+
+    def setUp(self):
+        super(TodoFileSetup, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.todofile = osp.join(self.tmpdir, 'todo')
+        todo = cjm.todo.configparser.ConfigParser()
+        todo.read_dict({ '63826560' : {
+            'cluster_id' : '63826560', 'submission_path' : 'fake/test/path', 'all' : '0', 'idle' : '0'
+            } })
+        cjm.storage.INIFileStorage(self.todofile).save(todo)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+
+class TestDaemon(TodoFileSetup):
+
+    def test_daemon_keeps_todolist_between_cycles(self):
+        daemon = cjm.daemon.Daemon(interval=0., todofile=self.todofile)
+        with patch('cjm.TodoList', wraps=cjm.TodoList) as mock_todolist, \
+                patch('cjm.email.Email.send_email'):
+            daemon.run(max_cycles=2)
+            self.assertEqual(mock_todolist.call_count, 1)
+            self.assertEqual(daemon.todolist.todo['63826560']['running'], '0')
+            # An external modification of the todo file forces a re-read
+            with open(self.todofile, 'a') as f: f.write('\n')
+            daemon.run(max_cycles=3)
+            self.assertEqual(mock_todolist.call_count, 2)
+        self.assertEqual(daemon.n_cycles, 3)
+
+    def test_daemon_stops_on_flag(self):
+        daemon = cjm.daemon.Daemon(interval=0., todofile=self.todofile)
+        daemon.stop()
+        daemon.run()
+        self.assertEqual(daemon.n_cycles, 0)
+
+
+class TestProfiling(TodoFileSetup):
+
+    def update(self, **kwargs):
+        with patch.object(cjm, 'CJM_DIR', self.tmpdir), patch('cjm.email.Email.send_email'):
+            return cjm.TodoList(self.todofile).update(**kwargs)
+
+    def get_reports(self):
+        return glob.glob(osp.join(self.tmpdir, 'profiles', 'update_*.txt'))
+
+    def test_update_writes_profile_per_phase(self):
+        self.update(profile=True, trace_memory=True)
+        reports = self.get_reports()
+        self.assertEqual(len(reports), 1)
+        with open(reports[0]) as f:
+            report = f.read()
+        for phase in [ 'read', 'query', 'history', 'process', 'email', 'write' ]:
+            self.assertIn('=== cProfile: {0} ==='.format(phase), report)
+            self.assertIn('=== Top allocations: {0} ==='.format(phase), report)
+        self.assertEqual(len(glob.glob(osp.join(self.tmpdir, 'profiles', '*.prof'))), 6)
+
+    def test_slow_cycle_triggers_profile_of_next_cycle(self):
+        _profile_slow_cycle = cjm.CONFIG.profile_slow_cycle
+        try:
+            cjm.CONFIG.profile_slow_cycle = 1e-9
+            self.update()
+            self.assertEqual(self.get_reports(), [])
+            self.update()
+        finally:
+            cjm.CONFIG.profile_slow_cycle = _profile_slow_cycle
+        self.assertEqual(len(self.get_reports()), 1)
+
+
+class TestEventLog(TestHTCondorMockSetup):
+
+    events = [
+        '000 (63826560.000.000) 01/06 10:00:00 Job submitted from host: <127.0.0.1:9618>\n...\n',
+        '000 (63826560.001.000) 01/06 10:00:00 Job submitted from host: <127.0.0.1:9618>\n...\n',
+        '000 (999.000.000) 01/06 10:00:00 Job submitted from host: <127.0.0.1:9618>\n...\n',
+        '001 (63826560.000.000) 01/06 10:01:00 Job executing on host: <127.0.0.1:9618>\n...\n',
+        '001 (63826560.001.000) 01/06 10:01:00 Job executing on host: <127.0.0.1:9618>\n...\n',
+        (
+            '005 (63826560.001.000) 01/06 10:02:00 Job terminated.\n'
+            '\t(1) Normal termination (return value 0)\n'
+            '\t\tUsr 0 00:00:00, Sys 0 00:00:00  -  Run Remote Usage\n'
+            '...\n'
+            ),
+        ]
+
+    def setUp(self):
+        super(TestEventLog, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.userlog = osp.join(self.tmpdir, 'job.log')
+        self.todoitem_dict['userlog'] = self.userlog
+        self.todoitem = cjm.HTCondorTodoItem.from_section('63826560', self.todoitem_dict)
+        cjm.todo.HTCondorClusterHistory.clear()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+        cjm.todo.HTCondorClusterHistory.clear()
+
+    def write_log(self, events):
+        with open(self.userlog, 'a') as f:
+            f.write(''.join(events))
+
+    def test_read_events_stops_at_incomplete_event(self):
+        self.write_log(self.events[:2] + [ self.events[3][:-4] ])
+        events, offset = cjm.eventlog.read_events(self.userlog)
+        self.assertEqual([ (e.code, e.proc_id) for e in events ], [ (0, 0), (0, 1) ])
+        self.assertEqual(offset, len(''.join(self.events[:2])))
+        self.write_log([ self.events[3][-4:] ])
+        events, offset = cjm.eventlog.read_events(self.userlog, offset)
+        self.assertEqual([ (e.code, e.proc_id) for e in events ], [ (1, 0) ])
+        self.assertEqual(offset, os.path.getsize(self.userlog))
+
+    def test_update_from_event_log(self):
+        self.write_log(self.events)
+        htcondor.Schedd.return_value.history.reset_mock()
+        queuestates = cjm.eventlog.read_queuestates([ self.todoitem ])
+        new_todoitem = cjm.HTCondorUpdater(self.todoitem, queuestates['63826560']).update()
+        self.assertEqual(new_todoitem.get_state(0), 'running')
+        self.assertEqual(new_todoitem.get_state(1), 'done')
+        # The exit code came from the event log, not from a history query
+        htcondor.Schedd.return_value.history.assert_not_called()
+        self.assertEqual(new_todoitem.userlog_offset, os.path.getsize(self.userlog))
+
+    def test_held_jobs_fall_back_to_polling(self):
+        self.write_log(self.events[:2] + [
+            '012 (63826560.000.000) 01/06 10:01:00 Job was held.\n'
+            '\tMemory usage exceeded\n'
+            '\tCode 34 Subcode 0\n'
+            '...\n'
+            ])
+        self.assertEqual(cjm.eventlog.read_queuestates([ self.todoitem ]), {})
+
+
+class TestSimulator(TestCase):
+
+    def setUp(self):
+        self.schedd_names = cjm.CONFIG.schedd_names
+        self.clock = cjm.simulator.SimulatedClock()
+        self.schedd = cjm.simulator.SimulatedSchedd(
+            'sim', self.clock, seed=1, mean_idle_time=60., mean_run_time=600.
+            )
+        cjm.CONFIG.set_schedds([self.schedd])
+        cjm.todo.HTCondorClusterHistory.clear()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+        cjm.CONFIG.schedd_names = self.schedd_names
+        cjm.CONFIG.init_condor_calls()
+        cjm.todo.HTCondorClusterHistory.clear()
+
+    def make_todofile(self, cluster_id, n_jobs):
+        todofile = osp.join(self.tmpdir, 'todo')
+        todo = cjm.todo.configparser.ConfigParser()
+        todo.read_dict({ str(cluster_id) : {
+            'cluster_id' : str(cluster_id), 'submission_path' : self.tmpdir,
+            'all' : '0-{0}'.format(n_jobs-1), 'idle' : '0-{0}'.format(n_jobs-1)
+            } })
+        cjm.storage.INIFileStorage(todofile).save(todo)
+        return todofile
+
+    def test_constraint(self):
+        Constraint = cjm.simulator.Constraint
+        ad = { 'Owner' : 'me', 'ClusterId' : 2, 'EnteredCurrentStatus' : 100 }
+        self.assertTrue(Constraint('Owner=="me" && (ClusterId==1 || ClusterId==2)').matches(ad))
+        self.assertTrue(Constraint('(owner == "ME") && EnteredCurrentStatus >= 100').matches(ad))
+        self.assertFalse(Constraint('ClusterId == 1 || ClusterId == 3').matches(ad))
+        self.assertFalse(Constraint('!(ClusterId == 2)').matches(ad))
+        # Comparisons with missing attributes are undefined, which does not match
+        self.assertFalse(Constraint('HoldReasonCode == 34').matches(ad))
+        self.assertTrue(Constraint('HoldReasonCode =?= undefined').matches(ad))
+        with self.assertRaises(ValueError):
+            Constraint('ClusterId == (2')
+
+    def test_update_cycles_against_simulator(self):
+        cluster_id = self.schedd.submit(4, memory_usage=[1000, 3000, 1000, 1000], exit_codes=[0, 0, 1, 0])
+        todolist = cjm.TodoList(self.make_todofile(cluster_id, 4))
+        with patch('cjm.email.Email.send_email'):
+            for i in range(5):
+                self.clock.advance(3600.)
+                todolist = todolist.update()
+        # Job 1 was held for exceeding its memory, resubmitted with twice as much, and finished
+        self.assertEqual(self.schedd.calls['edit'], 1)
+        self.assertEqual(self.schedd.count(), 0)
+        job1 = [ ad for ad in self.schedd.history_ads if ad['ProcId'] == 1 ][0]
+        self.assertEqual(job1['RequestMemory'], 4096)
+        self.assertFalse(todolist.todo.has_section(str(cluster_id)))
+
+    def test_update_cycle_metrics(self):
+        import json
+        cluster_id = self.schedd.submit(2, memory_usage=[1000, 3000])
+        todolist = cjm.TodoList(self.make_todofile(cluster_id, 2))
+        prom_file = osp.join(self.tmpdir, 'cjm.prom')
+        jsonl_file = osp.join(self.tmpdir, 'metrics.jsonl')
+        with patch.object(cjm.CONFIG, 'metrics_prom_file', prom_file), \
+                patch.object(cjm.CONFIG, 'metrics_jsonl_file', jsonl_file), \
+                patch('cjm.email.Email.send_email'):
+            for i in range(2):
+                self.clock.advance(36000.)
+                todolist = todolist.update()
+        with open(jsonl_file) as f:
+            cycles = [ json.loads(line) for line in f ]
+        self.assertEqual(len(cycles), 2)
+        self.assertEqual(cycles[0]['clusters'], 1)
+        self.assertEqual(cycles[0]['jobs'], 2)
+        self.assertEqual(cycles[0]['resubmissions'], 1)
+        self.assertEqual(cycles[0]['transitions'], { 'idle->done' : 1 })
+        self.assertIn('write', cycles[0]['phases'])
+        xquery = [ c for c in cycles[0]['schedd_calls'] if c['call'] == 'xquery' ][0]
+        self.assertEqual((xquery['schedd'], xquery['count'], xquery['ads']), ('sim', 1, 1))
+        with open(prom_file) as f:
+            prom = f.read()
+        self.assertIn('cjm_schedd_call_duration_seconds_count{call="xquery",schedd="sim"} 1', prom)
+        self.assertIn('cjm_transitions{from="idle",to="done"} 1', prom)
+
+    def run_scenario(self, io_engine):
+        """
+        Runs a few update cycles on a fixed scenario with `io_engine`, and returns
+        the final todo item and the jobs in the schedd history
+        """
+        self.clock = cjm.simulator.SimulatedClock()
+        self.schedd = cjm.simulator.SimulatedSchedd('sim', self.clock, seed=2, mean_idle_time=60., mean_run_time=600.)
+        cjm.CONFIG.set_schedds([self.schedd])
+        cjm.todo.HTCondorClusterHistory.clear()
+        cluster_id = self.schedd.submit(6, memory_usage=[1000, 3000, 3000, 1000, 1000, 1000], exit_codes=[0, 0, 0, 1, 0, 0])
+        todolist = cjm.TodoList(self.make_todofile(cluster_id, 6))
+        with patch.object(cjm.CONFIG, 'io_engine', io_engine), patch('cjm.email.Email.send_email'):
+            self.clock.advance(600.)
+            todolist = todolist.update()
+            self.clock.advance(1800.)
+            todolist = todolist.update()
+        todo = dict(todolist.todo[str(cluster_id)])
+        history = sorted((ad['ProcId'], ad['RequestMemory'], ad['ExitCode']) for ad in self.schedd.history_ads)
+        return todo, history
+
+    def test_asyncio_engine_is_deterministic(self):
+        self.assertEqual(self.run_scenario('sync'), self.run_scenario('asyncio'))
+
+    def test_asyncio_engine_limits_concurrency(self):
+        import threading
+        lock = threading.Lock()
+        running = { 'now' : 0, 'max' : 0 }
+        def action():
+            with lock:
+                running['now'] += 1
+                running['max'] = max(running['max'], running['now'])
+            time.sleep(.02)
+            with lock: running['now'] -= 1
+        actions = [ cjm.todo.DeferredAction('test', action, schedd=self.schedd) for i in range(6) ]
+        with patch.object(cjm.CONFIG, 'io_concurrency_per_schedd', 2):
+            results = cjm.aio.run_actions(actions)
+        self.assertEqual(results, [ None ] * 6)
+        self.assertEqual(running['max'], 2)
+        # Failures are reported per action
+        actions[0].func = lambda: 1/0
+        results = cjm.aio.run_actions(actions)
+        self.assertIsInstance(results[0], ZeroDivisionError)
+        self.assertEqual(results[1:], [ None ] * 5)
+
+    def test_resubmissions_are_applied_in_bulk(self):
+        cluster_id = self.schedd.submit(20, memory_usage=3000)
+        todolist = cjm.TodoList(self.make_todofile(cluster_id, 20))
+        self.clock.advance(36000.)
+        with patch('cjm.email.Email.send_email'):
+            todolist = todolist.update()
+        self.assertEqual(self.schedd.calls['edit'], 1)
+        self.assertEqual(self.schedd.calls['act'], 1)
+        self.assertEqual(self.schedd.count(cjm.simulator.IDLE), 20)
+        self.assertEqual(todolist.todo[str(cluster_id)]['idle'], '0-19')
+        self.assertEqual(todolist.todo[str(cluster_id)]['total_resubmission_count'], '20')
+
+    def test_failed_bulk_resubmission_is_retried_per_job(self):
+        cluster_id = self.schedd.submit(4, memory_usage=3000)
+        todolist = cjm.TodoList(self.make_todofile(cluster_id, 4))
+        self.clock.advance(36000.)
+        edit = self.schedd.edit
+        def failing_edit(job_spec, attr, value):
+            # Calls by constraint fail, and so do calls for job 2
+            if job_spec != '{0}.2'.format(cluster_id) and job_spec.startswith(str(cluster_id)):
+                return edit(job_spec, attr, value)
+            raise cjm.simulator.SimulatedScheddError('edit failed')
+        with patch.object(self.schedd, 'edit', failing_edit), patch('cjm.email.Email.send_email'):
+            todolist = todolist.update()
+        self.assertEqual(todolist.todo[str(cluster_id)]['idle'], '0-1,3')
+        self.assertEqual(todolist.todo[str(cluster_id)]['held'], '2')
+        self.assertEqual(self.schedd.count(cjm.simulator.HELD), 1)
+
+    def test_partial_bulk_release_is_detected(self):
+        cluster_id = self.schedd.submit(3, memory_usage=3000)
+        todolist = cjm.TodoList(self.make_todofile(cluster_id, 3))
+        self.clock.advance(36000.)
+        act = self.schedd.act
+        def act_after_removal(action, job_spec):
+            # Job 1 is removed between the poll and the release
+            act('Remove', '{0}.1'.format(cluster_id))
+            return act(action, job_spec)
+        with patch.object(self.schedd, 'act', act_after_removal), patch('cjm.email.Email.send_email'):
+            todolist = todolist.update()
+        self.assertEqual(todolist.todo[str(cluster_id)]['idle'], '0,2')
+        self.assertEqual(todolist.todo[str(cluster_id)]['held'], '1')
+        self.assertEqual(todolist.todo[str(cluster_id)]['total_resubmission_count'], '2')
+
+    def test_job_released_without_new_memory_is_not_applied(self):
+        cluster_id = self.schedd.submit(3, memory_usage=3000)
+        todolist = cjm.TodoList(self.make_todofile(cluster_id, 3))
+        self.clock.advance(36000.)
+        act = self.schedd.act
+        def failing_edit(job_spec, attr, value):
+            # Job 1 is released by someone else, then the bulk edit fails
+            act('Release', '{0}.1'.format(cluster_id))
+            raise cjm.simulator.SimulatedScheddError('edit failed')
+        with patch.object(self.schedd, 'edit', failing_edit), patch('cjm.email.Email.send_email'):
+            todolist = todolist.update()
+        # Jobs 0 and 2 are retried per job and fail as well; job 1 is not counted as resubmitted
+        self.assertEqual(todolist.todo[str(cluster_id)]['held'], '0-2')
+        self.assertEqual(todolist.todo[str(cluster_id)]['total_resubmission_count'], '0')
+
+    def test_failed_resubmission_is_retried_with_delta_polling(self):
+        cluster_id = self.schedd.submit(1, memory_usage=3000)
+        todolist = cjm.TodoList(self.make_todofile(cluster_id, 1))
+        def failing_edit(job_spec, attr, value):
+            raise cjm.simulator.SimulatedScheddError('edit failed')
+        with patch.object(cjm.CONFIG, 'delta_polling', True), patch('cjm.email.Email.send_email'):
+            self.clock.advance(600.)
+            todolist = todolist.update()
+            self.clock.advance(36000.)
+            with patch.object(self.schedd, 'edit', failing_edit):
+                todolist = todolist.update()
+            self.assertEqual(todolist.todo[str(cluster_id)]['held'], '0')
+            # The job is still held with the same EnteredCurrentStatus
+            self.clock.advance(600.)
+            todolist = todolist.update()
+        self.assertEqual(todolist.todo[str(cluster_id)]['idle'], '0')
+        self.assertEqual(self.schedd.count(cjm.simulator.IDLE), 1)
+
+    def test_history_timeout_keeps_states_of_affected_jobs(self):
+        other = cjm.simulator.SimulatedSchedd('sim2', self.clock, seed=2, mean_idle_time=60., mean_run_time=600.)
+        cjm.CONFIG.set_schedds([self.schedd, other])
+        self.schedd.submit(2, cluster_id=1)
+        other.submit(2, cluster_id=2, memory_usage=3000)
+        todofile = osp.join(self.tmpdir, 'todo')
+        todo = cjm.todo.configparser.ConfigParser()
+        todo.read_dict({ str(c) : {
+            'cluster_id' : str(c), 'submission_path' : self.tmpdir, 'all' : '0-1', 'idle' : '0-1'
+            } for c in [1, 2] })
+        cjm.storage.INIFileStorage(todofile).save(todo)
+        self.clock.advance(36000.)
+        history = other.history
+        def slow_history(*args, **kwargs):
+            time.sleep(.3)
+            return history(*args, **kwargs)
+        with patch.object(cjm.CONFIG, 'schedd_timeout', .1), patch('cjm.email.Email.send_email'):
+            with patch.object(other, 'history', slow_history):
+                cjm.TodoList(todofile).update()
+            # The finished jobs of cluster 1 wait for the history; cluster 2 is resubmitted
+            todolist = cjm.TodoList(todofile)
+            self.assertEqual(todolist.todo['1']['idle'], '0-1')
+            self.assertEqual(todolist.todo['2']['total_resubmission_count'], '2')
+            self.assertEqual(other.count(cjm.simulator.IDLE), 2)
+            todolist = todolist.update()
+        # Cluster 1 finished and is not tracked anymore
+        self.assertEqual(todolist.get_section_titles(), ['2'])
+
+    def test_make_job_constraint(self):
+        constraint = cjm.utils.make_job_constraint([ (1, 0), (1, 1), (1, 2), (1, 5), (2, 3) ])
+        self.assertEqual(
+            constraint,
+            '(ClusterId == 1 && ((ProcId >= 0 && ProcId <= 2) || ProcId == 5)) || (ClusterId == 2 && (ProcId == 3))'
+            )
+        matches = lambda c, p: cjm.simulator.Constraint(constraint).matches({ 'ClusterId' : c, 'ProcId' : p })
+        self.assertEqual([ p for p in range(7) if matches(1, p) ], [ 0, 1, 2, 5 ])
+        self.assertFalse(matches(2, 0))
+
+    def test_injected_errors_do_not_change_states(self):
+        cluster_id = self.schedd.submit(2)
+        todolist = cjm.TodoList(self.make_todofile(cluster_id, 2))
+        self.schedd.error_rate = 1.
+        self.clock.advance(36000.)
+        with patch('cjm.email.Email.send_email'):
+            todolist = todolist.update()
+        self.assertEqual(self.schedd.calls['history'], 0)
+        self.assertEqual(todolist.todo[str(cluster_id)]['idle'], '0-1')
+        with self.assertRaises(cjm.simulator.SimulatedScheddError):
+            self.schedd.xquery()
+
+
+class TestScheddCache(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        htcondor.Collector.return_value.locate.reset_mock()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def get_config(self):
+        config = cjm.reload_config('test')
+        config.schedd_cache_file = osp.join(self.tmpdir, 'schedds.json')
+        # The test config disables the cache, so nothing is written to CJM_DIR
+        config.schedd_cache_ttl = 86400.
+        return config
+
+    def test_schedds_are_located_lazily_and_cached(self):
+        locate = htcondor.Collector.return_value.locate
+        with patch.dict(sys.modules, { 'classad' : MagicMock() }):
+            config = self.get_config()
+            locate.assert_not_called()
+            self.assertEqual(len(config.schedds), len(config.schedd_names))
+            self.assertEqual(locate.call_count, len(config.schedd_names))
+            # A new process uses the cached ads
+            config = self.get_config()
+            config.schedds
+            self.assertEqual(locate.call_count, len(config.schedd_names))
+            # A failing query against a cached ad triggers locating that schedd again
+            config.mark_schedds_stale(config.schedds[:1])
+            config.refresh_stale_schedds()
+            self.assertEqual(locate.call_count, len(config.schedd_names) + 1)
+            self.assertEqual(locate.call_args[0][1], config.schedd_names[0])
+
+
 class TestUtils(TestCase):
 
     def test_tail(self):
@@ -216,6 +1067,51 @@ class TestUtils(TestCase):
         finally:
             os.remove(path)
 
+    def test_range_encoding_roundtrip(self):
+        ints = [0, 1, 2, 3, 7, 9, 10]
+        self.assertEqual(cjm.utils.encode_ranges(ints), '0-3,7,9-10')
+        self.assertEqual(cjm.utils.decode_ranges('0-3,7,9-10'), ints)
+        # Old plain comma lists still load
+        self.assertEqual(cjm.utils.decode_ranges('0,1,2,3,7,9,10'), ints)
+        self.assertEqual(cjm.utils.encode_ranges([]), '')
+
+    def test_count_encoding_roundtrip(self):
+        counts = {0: 1, 1: 1, 2: 1, 5: 3, 6: 1}
+        self.assertEqual(cjm.utils.encode_counts(counts), '0-2:1,5:3,6:1')
+        self.assertEqual(cjm.utils.decode_counts('0-2:1,5:3,6:1'), counts)
+        self.assertEqual(cjm.utils.decode_counts('0:1,1:1,2:1,5:3,6:1'), counts)
+
+    def test_fanout_schedds_collects_timeouts(self):
+        import time
+        def query(schedd):
+            if schedd == 'slow': time.sleep(1.)
+            return [schedd]
+        errors = []
+        results = list(cjm.utils.fanout_schedds(
+            query, ['fast1', 'slow', 'fast2'], max_workers=3, timeout=.2, errors=errors
+            ))
+        self.assertEqual(sorted(s for s, r in results), ['fast1', 'fast2'])
+        self.assertEqual([ s for s, e in errors ], ['slow'])
+
+    def test_fanout_schedds_timeout_excludes_time_of_caller(self):
+        import time
+        def query(schedd):
+            time.sleep(.05 if schedd == 'a' else .15)
+            return [schedd]
+        errors = []
+        yielded = []
+        for schedd, result in cjm.utils.fanout_schedds(query, ['a', 'b'], max_workers=2, timeout=.25, errors=errors):
+            yielded.append(schedd)
+            time.sleep(.3) # Slow processing of the first answer
+        self.assertEqual(yielded, ['a', 'b'])
+        self.assertEqual(errors, [])
+
+    def test_fanout_schedds_raises_without_error_list(self):
+        def query(schedd):
+            raise RuntimeError('down')
+        with self.assertRaises(cjm.utils.ScheddQueryError):
+            list(cjm.utils.fanout_schedds(query, ['broken'], max_workers=1, timeout=1.))
+
     def test_submit(self):
         try:
             _bu_run_command = cjm.utils.run_command
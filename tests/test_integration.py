@@ -4,10 +4,7 @@ import os, shutil, logging, sys, subprocess
 import os.path as osp
 from unittest import TestCase
 from time import sleep
-try:
-    from mock import Mock, MagicMock, patch
-except ImportError:
-    from unittest.mock import Mock, MagicMock, patch
+from unittest.mock import Mock, MagicMock, patch
 
 # Change the default CJM_DIR to the integration_tests dir
 tests_dir = osp.dirname(osp.abspath(__file__))